@@ -1,6 +1,8 @@
 import numpy as np
-from scipy.spatial import distance
-from common_utils import to_tbs
+from common_utils import get_action_space
+
+# units of the hidden dense ReLU layers shared by the actor and the critic
+HIDDEN_LAYERS = [16, 128, 256, 256, 256, 128]
 
 class DDPGAgent():
     def __init__(self, tf, context_size, action_size) -> None:
@@ -10,6 +12,7 @@ class DDPGAgent():
         self.action_size = action_size
         self.actor = None
         self.critic = None
+        self.compiled_decision = None
 
         self.mcs_prb_min = np.array([0, 1], dtype=np.float32)
         self.mcs_prb_max = np.array([24, 45], dtype=np.float32)
@@ -23,6 +26,9 @@ class DDPGAgent():
             self.weights = np.array([1, 120])
         elif (self.action_size) == 2:
             self.weights = np.array([1, 1])
+        # the weighted euclidean distance sqrt(sum(w * (u - v)^2)) equals the plain euclidean
+        # distance after scaling both points by sqrt(w), so the action space is scaled once
+        self.sqrt_weights = np.sqrt(self.weights).astype(np.float32)
 
     def load_actor_weights(self, path):
         self.actor.load_weights(path)
@@ -32,7 +38,16 @@ class DDPGAgent():
 
     def set_action_array(self, action_array):
         self.action_array = action_array
-        self.l2_norms = np.zeros(shape=(len(self.action_array)))        
+        self.weighted_action_array = self.action_array.astype(np.float32) * self.sqrt_weights
+        self.l2_norms = np.zeros(shape=(len(self.action_array)), dtype=np.float32)
+        self.action_diff = np.zeros(shape=self.weighted_action_array.shape, dtype=np.float32)
+
+    def k_nearest_actions(self, action, k):
+        # squared weighted distances of the proto-action to every action of the action space
+        np.subtract(self.weighted_action_array, np.asarray(action, dtype=np.float32) * self.sqrt_weights, out=self.action_diff)
+        np.einsum('ij,ij->i', self.action_diff, self.action_diff, out=self.l2_norms)
+        partition = np.argpartition(self.l2_norms, k)
+        return self.action_array[partition[:k]]
 
     def normalize_action(self, action):
         if (self.action_size == 1):
@@ -54,9 +69,15 @@ class DDPGAgent():
     def denormalize_context(self, context):
         return context * (self.context_max - self.context_min) + self.context_min
     
+    def to_model_input(self, inputs):
+        # the NumPy inference engine (tf is None) takes the arrays as they are
+        if (self.tf is None):
+            return np.asarray(inputs, dtype=np.float32)
+        return self.tf.convert_to_tensor(inputs, dtype=self.tf.float32)
+
     def tidy_action(self, action):
         if (self.action_size == 1):
-            return np.array([action[0].numpy(), 45])
+            return np.array([float(action[0]), 45])
         elif (self.action_size == 2):
             return action
         raise Exception("Unknown context")
@@ -68,17 +89,45 @@ class DDPGAgent():
             return action
         raise Exception("Unknown context")            
     
-    def __call__(self, context, k=9):
+    def compile_decision(self, k=9, jit_compile=False):
+        # Fuses actor -> k-NN -> critic into a single graph with a fixed input signature.
+        # It is traced here once, so no retracing happens when serving the TTIs.
         tf = self.tf
+        action_array = tf.constant(self.action_array, dtype=tf.int32)
+        weighted_action_array = tf.constant(self.weighted_action_array, dtype=tf.float32)
+        action_array_normalized = self.adjust_action_for_critic(self.normalize_action(self.action_array.astype(np.float32)))
+        action_array_normalized = tf.constant(action_array_normalized, dtype=tf.float32)
+        if (self.action_size == 1):
+            action_min, action_max = self.mcs_min, self.mcs_max
+        elif (self.action_size == 2):
+            action_min, action_max = self.mcs_prb_min, self.mcs_prb_max
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=(self.context_size, ), dtype=tf.float32)], jit_compile=jit_compile)
+        def decision(context):
+            context = tf.expand_dims((context - self.context_min) / (self.context_max - self.context_min), axis=0)
+            action = self.actor(context, training=False)[0] * (action_max - action_min) + action_min
+            if (self.action_size == 1):
+                action = tf.stack([action[0], 45.0])
+            diff = weighted_action_array - action * self.sqrt_weights
+            _, k_closest_idx = tf.math.top_k(-tf.reduce_sum(diff * diff, axis=1), k=k)
+            k_closest_actions_normalized = tf.gather(action_array_normalized, k_closest_idx)
+            q_values = self.critic([tf.repeat(context, k, axis=0), k_closest_actions_normalized], training=False)
+            return tf.gather(action_array, k_closest_idx[tf.argmax(q_values[:, 0])])
+
+        decision(tf.zeros(shape=(self.context_size, ), dtype=tf.float32))
+        self.compiled_decision = decision
+        return decision
+
+    def __call__(self, context, k=9):
+        if (self.compiled_decision is not None):
+            mcs, prb = self.compiled_decision(self.tf.constant(context, dtype=self.tf.float32)).numpy()
+            return None, int(mcs), int(prb)
         context = self.normalize_context(context)
-        context = tf.convert_to_tensor([context], dtype=tf.float32)
+        context = self.to_model_input([context])
         action_normalized = self.actor(context)[0]
         action = self.denormalize_action(action_normalized)
         action = self.tidy_action(action)
-        for i, mcs_prb_comb in enumerate(self.action_array):
-            self.l2_norms[i] = distance.euclidean(action, mcs_prb_comb, self.weights)
-        partition = np.argpartition(self.l2_norms, k)
-        k_closest_actions  = self.action_array[partition[:k]]
+        k_closest_actions  = self.k_nearest_actions(action, k)
         k_closest_actions_normalized = self.normalize_action(k_closest_actions)
         k_closest_actions_normalized = self.adjust_action_for_critic(k_closest_actions_normalized)
         context_extended   = np.broadcast_to(context, (k, context.shape[1]))
@@ -87,32 +136,51 @@ class DDPGAgent():
 
         closest_action     = k_closest_actions[argmin_q_value]
         return str(action_normalized), int(closest_action[0]), int(closest_action[1])
-    
+
+    def tidy_action_batch(self, actions):
+        if (self.action_size == 1):
+            return np.column_stack([actions[:, 0], np.full(len(actions), 45, dtype=np.float32)])
+        elif (self.action_size == 2):
+            return actions
+        raise Exception("Unknown context")
+
+    def decide_batch(self, contexts, k=9):
+        # Same decision as __call__ for a batch of contexts: a single actor and a single critic call
+        total_contexts = len(contexts)
+        contexts = self.normalize_context(np.asarray(contexts, dtype=np.float32))
+        actions_normalized = np.asarray(self.actor(self.to_model_input(contexts)), dtype=np.float32)
+        actions = self.tidy_action_batch(self.denormalize_action(actions_normalized))
+
+        diff = self.weighted_action_array[np.newaxis, :, :] - (actions * self.sqrt_weights)[:, np.newaxis, :]
+        l2_norms = np.einsum('nij,nij->ni', diff, diff)
+        partition = np.argpartition(l2_norms, k, axis=1)[:, :k]
+        k_closest_actions = self.action_array[partition]
+
+        k_closest_actions_normalized = self.normalize_action(k_closest_actions.reshape(-1, k_closest_actions.shape[2]))
+        k_closest_actions_normalized = self.adjust_action_for_critic(k_closest_actions_normalized)
+        contexts_extended = self.to_model_input(np.repeat(contexts, k, axis=0))
+        k_closest_actions_normalized = self.to_model_input(k_closest_actions_normalized)
+        q_values = np.asarray(self.critic([contexts_extended, k_closest_actions_normalized])).reshape(total_contexts, k)
+        closest_actions = k_closest_actions[np.arange(total_contexts), np.argmax(q_values, axis=1)]
+        return closest_actions[:, 0].astype(np.int32), closest_actions[:, 1].astype(np.int32)
+
     def readjust_to_demand(self, mcs, prb, bsr):
         mcs = int(mcs)
         prb = int(prb)
-        tbs = to_tbs(mcs, prb)
+        action_space = get_action_space()
+        tbs = action_space.to_tbs(mcs, prb)
         if (tbs <= bsr):
             return mcs, prb
-        _candidate_mcs = 0
-        while (_candidate_mcs <= mcs):
-            tbs = to_tbs(_candidate_mcs, prb)
-            if (tbs >= bsr):
-                break
-            _candidate_mcs += 1
-        return _candidate_mcs, prb
+        return action_space.min_mcs_for_bsr(bsr, prb, mcs), prb
 
     def load_actor(self):
         keras = self.tf.keras
         layers = keras.layers
 
         context_input = keras.Input(shape = (self.context_size))
-        x = layers.Dense(16, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (context_input)
-        x = layers.Dense(128, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(128, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)    
+        x = context_input
+        for units in HIDDEN_LAYERS:
+            x = layers.Dense(units, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
         norm_params = layers.Dense(self.action_size, activation='sigmoid', kernel_initializer = keras.initializers.HeNormal())(x)
         self.actor = keras.Model(context_input, norm_params)
         return self.actor
@@ -123,12 +191,8 @@ class DDPGAgent():
         context_input = keras.Input(shape = (self.context_size))
         action_input = keras.Input(shape = (self.action_size))
         x = layers.Concatenate()([context_input, action_input])
-        x = layers.Dense(16, activation = 'relu', kernel_initializer     = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(128, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(256, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
-        x = layers.Dense(128, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
+        for units in HIDDEN_LAYERS:
+            x = layers.Dense(units, activation = 'relu', kernel_initializer = keras.initializers.HeNormal()) (x)
         q = layers.Dense(1, kernel_initializer = keras.initializers.HeNormal()) (x)
         self.critic = keras.Model(inputs = [context_input, action_input], outputs=q)
         return self.critic
@@ -1,14 +1,19 @@
 import multiprocessing as mp
 from agent_harq import HarqAgent
 from agent_main import MainAgent
+from inference_server import InferenceServer, InferenceClient
 from config import Config
+from common_utils import StartupTimer, wait_until_ready
 from srsran_env import SrsRanEnv
+from experience_ring import ExperienceRingReader, ExperienceRingWriter
+from numpy_inference import QUANTIZATION_NONE
 
 
 class AgentFactory():
     def __init__(self, config: Config, agent_coordination_lock, stop_flag: mp.Value) -> None:
-        self.total_agents = 8
+        self.total_agents = config.total_agents
         self.main_agent  = None
+        self.inference_server = None
         self.harq_agents = [None] * self.total_agents
         self.actor_memory_name = 'model_actor'
         self.critic_memory_name = 'model_critic'
@@ -21,42 +26,134 @@ class AgentFactory():
         self.actor_path    = config.actor_path
         self.critic_path   = config.critic_path
         self.stop_flag     = stop_flag
+        self.policy_table  = config.policy_table
+        self.policy_table_path = config.policy_table_path
+        self.use_inference_server = config.inference_server
+        self.batch_window_us = config.batch_window_us
+        self.tti_deadline_us = config.tti_deadline_us
+        self.request_memory_name = 'inference_requests'
+        self.numpy_inference = config.numpy_inference
+        self.numpy_dtype   = config.numpy_dtype
+        self.quantization  = config.quantization
+        self.calibration_path = config.calibration_path
+        self.blas_threads  = config.blas_threads
+        self.fused_decision = config.fused_decision
+        self.jit_compile   = config.jit_compile
+        self.train         = config.train
+        self.train_batch_size = config.train_batch_size
+        self.train_every   = config.train_every
+        self.replay_size   = config.replay_size
+        self.publish_every = config.publish_every
+        self.learner_cores = config.learner_cores
+        self.learner_threads = config.learner_threads
+        self.transport     = config.transport
+        self.ring_capacity = config.ring_capacity
+        self.experience_memory_name = 'experience'
+        self.latency_stats = config.latency_stats
+        self.placement     = config.placement
+        self.startup_timeout_s = config.startup_timeout_s
 
     def start(self, inputs = None, results_queue=None):
-        main_initialized = mp.Value('i', 0)
+        ## starts every agent process at once and waits until all of them are initialized
+        timer = StartupTimer('Agent Factory')
+        main_initialized = mp.Event()
+        experience_queue = mp.Queue() if (self.train and self.transport == 'queue') else None
+        experience_ring = None
+        if (self.train and self.transport == 'ring'):
+            experience_ring = ExperienceRingReader(self.total_agents, self.ring_capacity, self.experience_memory_name)
         self.main_agent = MainAgent(
             context_size=self.context_size, action_size=self.action_size,
             load_initial_weights=self.load_weights,
             main_agent_initialized=main_initialized,
             stop_flag=self.stop_flag,
             actor_initial_weights_path=self.actor_path,
-            critic_initial_weights_path=self.critic_path
+            critic_initial_weights_path=self.critic_path,
+            policy_table=self.policy_table,
+            policy_table_path=self.policy_table_path,
+            experience_queue=experience_queue,
+            experience_ring=experience_ring,
+            train_batch_size=self.train_batch_size,
+            train_every=self.train_every,
+            replay_size=self.replay_size,
+            publish_every=self.publish_every,
+            learner_cores=self.learner_cores,
+            learner_threads=self.learner_threads,
+            # the weights of the NumPy workers are quantized once per generation in the master
+            quantization=self.quantization if (self.numpy_inference and not self.use_inference_server) else QUANTIZATION_NONE,
+            calibration_path=self.calibration_path,
+            placement=self.placement
         )
-        self.main_agent.start()
-        while (main_initialized.value == 0):
-            pass
-        
-        print('Main Agent started successfully')
-        harq_agents_initialized = mp.Value('i', 0)
+        startup = [('Main Agent', self.main_agent, main_initialized)]
+        # the workers read the networks published by the master, or those of the inference server
+        models_ready = main_initialized
+        if (self.use_inference_server):
+            server_initialized = mp.Event()
+            self.inference_server = InferenceServer(
+                context_size=self.context_size, action_size=self.action_size,
+                total_workers=self.total_agents,
+                server_initialized=server_initialized,
+                stop_flag=self.stop_flag,
+                batch_window_us=self.batch_window_us,
+                tti_deadline_us=self.tti_deadline_us,
+                actor_memory_name=self.actor_memory_name, critic_memory_name=self.critic_memory_name,
+                request_memory_name=self.request_memory_name,
+                placement=self.placement,
+                master_initialized=main_initialized
+            )
+            startup.append(('Inference Server', self.inference_server, server_initialized))
+            models_ready = server_initialized
+
+        import copy
         for worker_num in range(self.total_agents):
-            import copy
             worker_environment = copy.deepcopy(self.environment)
             worker_environment.presetup(inputs[worker_num])
-            worker = HarqAgent(
+            worker_initialized = mp.Event()
+            self.harq_agents[worker_num] = HarqAgent(
                 environment=worker_environment,
                 worker_num=worker_num,
                 total_workers=self.total_agents,                
                 context_size=self.context_size, action_size=self.action_size,
-                successfully_started_worker=harq_agents_initialized,
+                successfully_started_worker=worker_initialized,
                 results_queue=results_queue, scheduling_mode=self.scheduling_mode,
-                actor_memory_name=self.actor_memory_name, critic_memory_name=self.critic_memory_name
+                actor_memory_name=self.actor_memory_name, critic_memory_name=self.critic_memory_name,
+                policy_table=self.policy_table,
+                inference_client=self.get_inference_client(worker_num),
+                numpy_inference=self.numpy_inference,
+                numpy_dtype=self.numpy_dtype,
+                quantization=self.quantization,
+                blas_threads=self.blas_threads,
+                fused_decision=self.fused_decision,
+                jit_compile=self.jit_compile,
+                experience_queue=experience_queue,
+                experience_ring=self.get_experience_ring(worker_num),
+                latency_stats=self.latency_stats,
+                placement=self.placement,
+                models_ready=models_ready
             )
-            self.harq_agents[worker_num] = worker
-            worker.start()
-        while (harq_agents_initialized.value < self.total_agents):
-            pass
-        print('HARQ Agents started successfully')
-        self.agent_coordination_lock.value = 1
+            startup.append(('HARQ Agent {}'.format(worker_num), self.harq_agents[worker_num], worker_initialized))
+        timer.lap('Create processes')
+
+        # the workers import TensorFlow while the master initializes, they only wait for it to attach its weights
+        for _, process, _ in startup:
+            process.start()
+        timer.lap('Start processes')
+        wait_until_ready(startup, self.startup_timeout_s, timer)
+        print('Main Agent, {}HARQ Agents started successfully'.format('Inference Server, ' if (self.use_inference_server) else ''))
+        timer.report()
+        self.agent_coordination_lock.set()
+
+    def get_inference_client(self, worker_num):
+        if (not self.use_inference_server):
+            return None
+        return InferenceClient(
+            worker_num=worker_num, total_workers=self.total_agents,
+            context_size=self.context_size, memory_name=self.request_memory_name,
+            timeout_us=self.tti_deadline_us)
+
+    def get_experience_ring(self, worker_num):
+        if (self.transport != 'ring'):
+            return None
+        return ExperienceRingWriter(worker_num, self.ring_capacity, self.experience_memory_name)
 
     def kill(self):
         self.stop_flag.value = 1
@@ -65,6 +162,11 @@ class AgentFactory():
             self.main_agent.kill()
             self.main_agent.join()
 
+        print('Killing Inference Server')
+        if (self.inference_server is not None and self.inference_server.is_alive()):
+            self.inference_server.kill()
+            self.inference_server.join()
+
         print('Killing HARQ Agents')
         for worker_process in self.harq_agents:
             if (worker_process is not None and worker_process.is_alive()):
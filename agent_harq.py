@@ -1,23 +1,42 @@
 import multiprocessing as mp
 import numpy as np
 import random
-from common_utils import MODE_SCHEDULING_ATHENA, MODE_SCHEDULING_RANDOM, import_tensorflow, get_shared_memory_ref, map_weights_to_shared_memory_buffer, MCS_SPACE, PRB_SPACE
+from common_utils import MODE_SCHEDULING_ATHENA, MODE_SCHEDULING_RANDOM, StartupTimer, import_tensorflow, MCS_SPACE, PRB_SPACE
 from agent_ddpg import DDPGAgent
 from srsran_env import SrsRanEnv
-
-import copy
+from policy_table import PolicyTable
+from inference_server import InferenceClient
+from numpy_inference import load_numpy_models, limit_blas_threads
+from agent_preload import take_template_models
+from shared_weights import get_model_weights_store, read_weight_pair
+from experience_ring import ExperienceRingWriter
+from latency_stats import LatencyStats, STAGE_INFERENCE
+from placement import Placement, apply_placement, limit_tensorflow_threads, ROLE_HARQ
 
 class HarqAgent(mp.Process):
     def __init__(self, 
                 environment: SrsRanEnv, 
                 worker_num: np.int32, total_workers: np.int32, 
                 context_size: np.int32, action_size: np.int32, 
-                successfully_started_worker: mp.Value,
+                successfully_started_worker: mp.Event,
                 results_queue: mp.Queue,
                 scheduling_mode: str,
                 verbose: int = 0,
                 actor_memory_name: str = 'model_actor',
-                critic_memory_name: str = 'model_critic') -> None:
+                critic_memory_name: str = 'model_critic',
+                policy_table: PolicyTable = None,
+                inference_client: InferenceClient = None,
+                numpy_inference: bool = False,
+                numpy_dtype: str = 'float32',
+                quantization: str = 'none',
+                blas_threads: int = None,
+                fused_decision: bool = False,
+                jit_compile: bool = False,
+                experience_queue: mp.Queue = None,
+                experience_ring: ExperienceRingWriter = None,
+                latency_stats: LatencyStats = None,
+                placement: Placement = None,
+                models_ready: mp.Event = None) -> None:
         super(HarqAgent, self).__init__()
         # environment variables
         self.environment = environment
@@ -32,6 +51,23 @@ class HarqAgent(mp.Process):
         self.scheduling_mode = scheduling_mode
         self.actor_memory_name = actor_memory_name
         self.critic_memory_name = critic_memory_name    
+        self.policy_table = policy_table
+        self.inference_client = inference_client
+        self.numpy_inference = numpy_inference
+        self.numpy_dtype = numpy_dtype
+        self.quantization = quantization
+        self.blas_threads = blas_threads
+        self.fused_decision = fused_decision
+        self.jit_compile = jit_compile
+        self.experience_queue = experience_queue
+        self.experience_ring = experience_ring
+        self.latency_stats = latency_stats
+        self.placement = placement
+        self.models_ready = models_ready
+        self.actor_weights = None
+        self.critic_weights = None
+        self.actor_generation = -1
+        self.critic_generation = -1
 
         self.verbose = verbose
 
@@ -43,77 +79,168 @@ class HarqAgent(mp.Process):
         if (hasattr(self, 'tf')):
             self.tf.random.set_seed(worker_num)
 
-    def get_shared_memory_reference(self, model, memory_name):
-        ## return the reference to the memory and the np.array pointing to the shared memory
-        model_dtype = np.dtype(model.dtype)
-        variables = np.sum([np.prod(v.shape) for v in model.variables])
-        size = variables * model_dtype.itemsize
-        shm, weights_array = get_shared_memory_ref(size, model_dtype, memory_name)
-        return shm, weights_array
-
     def initiate_models(self, associate_with_master=True):
         try:
             stage = 'Creating the neural networks'
             self.ddpg_agent = DDPGAgent(self.tf, self.context_size, self.action_size)
             self.ddpg_agent.set_action_array(self.environment.action_array)
-            self.ddpg_agent.load_actor() 
-            self.ddpg_agent.load_critic()
+            template_models = take_template_models(self.context_size, self.action_size)
+            if (template_models is not None):
+                # started from the forkserver template, the graphs are already built
+                self.ddpg_agent.actor, self.ddpg_agent.critic = template_models
+            else:
+                self.ddpg_agent.load_actor() 
+                self.ddpg_agent.load_critic()
 
             stage = 'Actor memory reference creation'
             if (associate_with_master):
-                self.shm_actor, self.np_array_actor = self.get_shared_memory_reference(self.ddpg_agent.actor, self.actor_memory_name)
-                self.weights_actor = map_weights_to_shared_memory_buffer(self.ddpg_agent.actor.get_weights(), self.np_array_actor)
+                self.actor_weights = get_model_weights_store(self.ddpg_agent.actor, self.actor_memory_name)
 
             stage = 'Action-value critic memory reference creation'
             if (associate_with_master):
-                self.shm_critic, self.np_array_critic = self.get_shared_memory_reference(self.ddpg_agent.critic, self.critic_memory_name)
-                self.weights_critic = map_weights_to_shared_memory_buffer(self.ddpg_agent.critic.get_weights(), self.np_array_critic)
+                self.critic_weights = get_model_weights_store(self.ddpg_agent.critic, self.critic_memory_name)
+        except Exception as e:
+            self.print_verbose('Stage: {}, Error initiating models: {}'.format(stage, e))
+            raise e
+
+    def initiate_numpy_models(self):
+        try:
+            stage = 'Creating the NumPy networks'
+            self.ddpg_agent = DDPGAgent(None, self.context_size, self.action_size)
+            self.ddpg_agent.set_action_array(self.environment.action_array)
+
+            # quantized weights are quantized (and calibrated) once per generation by the MainAgent, only mapped here
+            stage = 'Actor and critic memory reference creation'
+            self.actor_weights, self.critic_weights = load_numpy_models(self.ddpg_agent, self.actor_memory_name, self.critic_memory_name, np.dtype(self.numpy_dtype),
+                                                                        self.quantization)
+
+            if (self.blas_threads is not None):
+                self.blas_limits = limit_blas_threads(self.blas_threads)
         except Exception as e:
             self.print_verbose('Stage: {}, Error initiating models: {}'.format(stage, e))
             raise e
 
+    def uses_tensorflow(self):
+        return self.inference_client is None and not self.numpy_inference
+
+    def weights_changed(self):
+        return (self.actor_weights.generation() != self.actor_generation
+                or self.critic_weights.generation() != self.critic_generation)
+
     def update_weights(self):
-        self.ddpg_agent.actor.set_weights(copy.deepcopy(self.weights_actor))            
-        self.ddpg_agent.critic.set_weights(copy.deepcopy(self.weights_critic))
+        # set_weights copies the arrays out of the shared memory, the generation check discards torn reads
+        generations = read_weight_pair(
+            self.actor_weights, self.ddpg_agent.actor.set_weights, self.critic_weights, self.ddpg_agent.critic.set_weights)
+        if (generations[0] is None):
+            # the publisher stopped mid-publish: the current weights are kept until the next publication
+            generations = (self.actor_weights.generation(), self.critic_weights.generation())
+            print(str(self) + ' -> No complete weights publication (generations {} and {}), keeping the current weights'.format(*generations))
+        self.actor_generation, self.critic_generation = generations
+
+    def decide(self, contexts):
+        ## (mcs, prb) per context: policy table lookups first, then a single batched call for the rest
+        decisions = [None] * len(contexts)
+        if (self.policy_table is not None):
+            decisions = [self.policy_table.lookup(context) for context in contexts]
+        pending = [idx for idx, decision in enumerate(decisions) if decision is None]
+        if (len(pending) > 1 and hasattr(self.ddpg_agent, 'decide_batch')):
+            mcs, prb = self.ddpg_agent.decide_batch(contexts[pending])
+            for idx, pending_idx in enumerate(pending):
+                decisions[pending_idx] = (int(mcs[idx]), int(prb[idx]))
+        else:
+            for idx in pending:
+                _, mcs, prb = self.ddpg_agent(contexts[idx])
+                decisions[idx] = (mcs, prb)
+        return decisions
 
     def run(self):
-        self.tf, _, self.tfp = import_tensorflow('3', False)
+        timer = StartupTimer(str(self))
+        apply_placement(self.placement, ROLE_HARQ, self.worker_num)
+        if (self.uses_tensorflow()):
+            self.tf, _, self.tfp = import_tensorflow('3', False)
+            limit_tensorflow_threads(self.placement, ROLE_HARQ, self.tf)
+            timer.lap('Import tensorflow')
         self.set_process_seeds(self.worker_num)
         try:
             associate_with_master = self.scheduling_mode == MODE_SCHEDULING_ATHENA
-            self.initiate_models(associate_with_master=associate_with_master)
+            if (self.models_ready is not None):
+                # started along with the master, the TensorFlow import above overlaps with its initialization
+                self.models_ready.wait()
+                timer.lap('Wait for the master')
+            if (self.inference_client is not None):
+                # the networks live in the inference server, no TensorFlow in this process
+                self.inference_client.attach()
+                self.ddpg_agent = self.inference_client
+            elif (self.numpy_inference):
+                # the NumPy networks read the weights published by the master, no TensorFlow either
+                self.initiate_numpy_models()
+            else:
+                self.initiate_models(associate_with_master=associate_with_master)
+            timer.lap('Create models')
             self.environment.setup(self.worker_num, self.total_workers)
+            timer.lap('Environment setup')
 
-            if (associate_with_master):
+            # weights published by the master are picked up between TTIs, never during a decision
+            follow_master = self.actor_weights is not None and (associate_with_master or self.numpy_inference)
+            if (follow_master):
                 self.update_weights()
+                timer.lap('Update weights')
+
+            if (self.fused_decision and self.uses_tensorflow()):
+                # traced once here, before the worker reports as initialized
+                self.ddpg_agent.compile_decision(jit_compile=self.jit_compile)
+                timer.lap('Compile decision')
+
+            if (self.policy_table is not None):
+                self.policy_table.attach()
+                timer.lap('Attach policy table')
+
+            if (self.experience_ring is not None):
+                self.experience_ring.attach()
+
+            if (self.latency_stats is not None):
+                self.latency_stats.attach()
             
-            with self.successfully_started_worker.get_lock():
-                self.successfully_started_worker.value += 1
+            self.successfully_started_worker.set()
             print('HARQ Agent ' + str(self.worker_num) + ' initialized')
+            timer.report()
             while (True):
-                environment_context = self.environment.reset()
-                context = environment_context.copy()
-                action, mcs, prb = self.ddpg_agent(context)
+                if (follow_master and self.weights_changed()):
+                    self.update_weights()
+                    self.print_verbose('Updated weights to generation {}'.format(self.actor_generation))
+                # the contexts of every UE scheduled on this HARQ process in the TTI
+                ues, contexts = self.environment.reset()
+                decisions = self.decide(contexts)
+                if (self.latency_stats is not None):
+                    self.latency_stats.record_since(STAGE_INFERENCE, self.worker_num, self.environment.context_ns)
 
                 if (self.scheduling_mode == MODE_SCHEDULING_RANDOM):
-                    mcs = MCS_SPACE[np.random.randint(0, len(MCS_SPACE))]
-                    prb = PRB_SPACE[np.random.randint(0, len(PRB_SPACE))]
+                    decisions = [(MCS_SPACE[np.random.randint(0, len(MCS_SPACE))], PRB_SPACE[np.random.randint(0, len(PRB_SPACE))])
+                                 for _ in range(len(ues))]
                 
-                _, reward, _, info = self.environment.step([mcs, prb])
-                if (reward is None):
-                    # This happens in cases where the srsRAN doesn't apply the decided action
-                    # As a result, no reward is being returned from the environment, and we 
-                    # don't want to record this sample on the record file, neither the MasterAgent
-                    # to learn from this experience.
-                    self.print_verbose('Action not applied.. skipping')
-                    continue
-
-                if (self.environment.is_context_valid()):                    
-                    info['mu'] = mcs
-                    info['sigma'] = prb
-                    self.results_queue.put(info)
-                else:
-                    print('non valid')
+                results = self.environment.step(ues, decisions)
+                for ue, context, (mcs, prb), (_, reward, _, info) in zip(ues, contexts, decisions, results):
+                    if (reward is None):
+                        # This happens in cases where the srsRAN doesn't apply the decided action
+                        # As a result, no reward is being returned from the environment, and we 
+                        # don't want to record this sample on the record file, neither the MasterAgent
+                        # to learn from this experience.
+                        self.print_verbose('Action not applied.. skipping')
+                        continue
+
+                    if (self.environment.is_context_valid(ue)):                    
+                        info['mu'] = mcs
+                        info['sigma'] = prb
+                        if (self.experience_ring is not None):
+                            # read by both the logger and the learner, nothing goes through the queues
+                            self.experience_ring.put(info)
+                        else:
+                            self.results_queue.put(info)
+                        if (self.experience_queue is not None):
+                            # the applied action (as modified by srsRAN) is the one the reward refers to
+                            self.experience_queue.put((context, info['mcs'], info['prb'], info['reward']))
+                    else:
+                        print('non valid')
 
         except Exception as e:
             print(str(self) + str(e))     
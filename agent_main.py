@@ -1,8 +1,15 @@
 import multiprocessing as mp
 import numpy as np
 
-from common_utils import get_shared_memory_ref, import_tensorflow, map_weights_to_shared_memory_buffer, publish_weights_to_shared_memory
+from common_utils import StartupTimer, import_tensorflow, get_action_array, set_process_affinity, set_tensorflow_threads
 from agent_ddpg import DDPGAgent
+from policy_table import PolicyTable
+from agent_preload import take_template_models
+from shared_weights import get_model_weights_store, read_weight_pair
+from numpy_inference import get_quantizers, quantized_memory_name, load_calibration, QUANTIZATION_NONE
+from ddpg_learner import DDPGLearner
+from experience_ring import ExperienceRingReader
+from placement import Placement, apply_placement, limit_tensorflow_threads, ROLE_MAIN
 
 class MainAgent(mp.Process):
     def __init__(self,context_size, action_size,
@@ -11,7 +18,20 @@ class MainAgent(mp.Process):
                 actor_initial_weights_path=None,
                 critic_initial_weights_path=None,
                 actor_memory_name = 'model_actor',
-                critic_memory_name = 'model_critic') -> None:
+                critic_memory_name = 'model_critic',
+                policy_table: PolicyTable = None,
+                policy_table_path = None,
+                experience_queue: mp.Queue = None,
+                experience_ring: ExperienceRingReader = None,
+                train_batch_size = 64,
+                train_every = 8,
+                replay_size = 100000,
+                publish_every = 100,
+                learner_cores = None,
+                learner_threads = 1,
+                quantization = QUANTIZATION_NONE,
+                calibration_path = None,
+                placement: Placement = None) -> None:
         super(MainAgent, self).__init__()
         self.context_size = context_size
         self.action_size = action_size
@@ -22,58 +42,156 @@ class MainAgent(mp.Process):
         self.critic_memory_name = critic_memory_name
         self.main_agent_initialized = main_agent_initialized
         self.stop_flag = stop_flag
+        self.policy_table = policy_table
+        self.policy_table_path = policy_table_path
+        # online training: the HARQ agents send (context, mcs, prb, reward) through the experience queue,
+        # or write their samples to the shared memory experience rings
+        self.experience_queue = experience_queue
+        self.experience_ring = experience_ring
+        self.train = experience_queue is not None or experience_ring is not None
+        self.train_batch_size = train_batch_size
+        self.train_every = train_every
+        self.replay_size = replay_size
+        self.publish_every = publish_every
+        self.learner_cores = learner_cores
+        self.learner_threads = learner_threads
+        # the NumPy workers map the quantized weights, quantized here once per published generation
+        self.quantization = quantization
+        self.calibration_path = calibration_path
+        self.actor_quantizer = None
+        self.critic_quantizer = None
+        self.quantized_generation = -1
+        self.placement = placement
 
     def run(self):
         import signal
         signal.signal(signal.SIGINT , self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        timer = StartupTimer(str(self))
+        apply_placement(self.placement, ROLE_MAIN)
         self.tf, _, _ = import_tensorflow('3', False)
+        limit_tensorflow_threads(self.placement, ROLE_MAIN, self.tf)
+        timer.lap('Import tensorflow')
         try:
+            if (self.train):
+                self.limit_learner_resources()
             self.initialize_models()
+            timer.lap('Create models')
             self.load_weights()           
+            timer.lap('Load weights')
             self.publish_weights()
-            self.main_agent_initialized.value = 1
+            timer.lap('Publish weights')
+            self.compile_policy(self.policy_table_path)
+            timer.lap('Compile policy')
+            self.main_agent_initialized.set()
+            timer.report()
+            if (self.train):
+                self.learn()
             import time
             while(self.stop_flag.value == 0):
                 time.sleep(3)
+                self.follow_published_weights()
         finally:
             print(str(self) + ' -> Exiting...')
 
     def exit_gracefully(self, signum, frame):
         self.stop_flag.value = 1
 
-    def compute_model_size(self, model):
-        model_dtype = np.dtype(model.dtype)
-        variables = int(np.sum([np.prod(v.shape) for v in model.variables]))
-        size = variables * model_dtype.itemsize
-        return size, model_dtype
+    def limit_learner_resources(self):
+        # the learner must not steal cycles from the HARQ agents: fixed thread pools on its own cores
+        set_tensorflow_threads(self.tf, self.learner_threads, 1, str(self))
+        cores = set_process_affinity(self.learner_cores)
+        print(str(self) + ' -> Learner limited to {} intra-op threads, cores {}'.format(self.learner_threads, cores))
 
-    def get_shared_memory_reference(self, model, memory_name):
-        ## return the reference to the memory and the np.array pointing to the shared memory
-        size, model_dtype = self.compute_model_size(model)
-        shm, weights_array = get_shared_memory_ref(size, model_dtype, memory_name)
-        return shm, weights_array
+    def receive_transitions(self, learner, max_transitions = 1024):
+        if (self.experience_ring is not None):
+            return self.read_transitions(learner)
+        import queue
+        received = 0
+        try:
+            # block briefly when idle, then drain whatever has accumulated
+            transition = self.experience_queue.get(timeout=0.1)
+            while (True):
+                learner.add(*transition)
+                received += 1
+                if (received >= max_transitions):
+                    break
+                transition = self.experience_queue.get_nowait()
+        except queue.Empty:
+            pass
+        return received
+
+    def read_transitions(self, learner):
+        received = 0
+        # everything published is consumed (records left in the rings would be lapped), and counted
+        for records in self.experience_ring.wait(timeout=0.1):
+            # batches copied out of the rings, added to the replay buffer
+            contexts = np.column_stack([records['cpu'], records['snr']])
+            learner.add_batch(contexts, records['mcs'], records['prb'], records['reward'])
+            received += len(records)
+        return received
+
+    def learn(self):
+        if (self.experience_ring is not None):
+            self.experience_ring.attach()
+        learner = DDPGLearner(self.ddpg_agent, batch_size=self.train_batch_size, replay_size=self.replay_size)
+        print(str(self) + ' -> Online training, batch {}, one update every {} transitions, publishing every {} updates'.format(
+            self.train_batch_size, self.train_every, self.publish_every))
+        pending_transitions = 0
+        updates_since_publish = 0
+        last_losses = None
+        while (self.stop_flag.value == 0):
+            pending_transitions += self.receive_transitions(learner)
+            # at most one batch worth of updates per drain, the learner never builds a backlog
+            pending_transitions = min(pending_transitions, self.train_batch_size * self.train_every)
+            while (pending_transitions >= self.train_every):
+                pending_transitions -= self.train_every
+                losses = learner.update()
+                if (losses is None):
+                    break
+                last_losses = losses
+                updates_since_publish += 1
+            if (updates_since_publish >= self.publish_every):
+                print(str(self) + ' -> Update {}, critic loss {:.4f}, actor loss {:.4f}'.format(learner.total_updates, *last_losses))
+                self.publish_weights()
+                if (self.policy_table is not None):
+                    self.compile_policy()
+                updates_since_publish = 0
 
     def initialize_models(self):
         try:
             print('Creating neural networks...', end='')
             stage = 'Creating the neural networks'
             self.ddpg_agent = DDPGAgent(self.tf, self.context_size, self.action_size)
-            self.ddpg_agent.load_actor()
-            self.ddpg_agent.load_critic()
+            template_models = take_template_models(self.context_size, self.action_size)
+            if (template_models is not None):
+                self.ddpg_agent.actor, self.ddpg_agent.critic = template_models
+            else:
+                self.ddpg_agent.load_actor()
+                self.ddpg_agent.load_critic()
             print('Done')
 
             print('Actor memory reference creation...', end='')
             stage = 'Actor memory reference creation'
-            self.shm_actor, self.np_array_actor = self.get_shared_memory_reference(self.ddpg_agent.actor, self.actor_memory_name)
-            self.weights_actor = map_weights_to_shared_memory_buffer(self.ddpg_agent.actor.get_weights(), self.np_array_actor)
+            self.actor_weights = get_model_weights_store(self.ddpg_agent.actor, self.actor_memory_name)
             print('Done')
 
             print('Critic memory reference creation...', end='')
             stage = 'Critic memory reference creation'
-            self.shm_critic, self.np_array_critic = self.get_shared_memory_reference(self.ddpg_agent.critic, self.critic_memory_name)
-            self.weights_critic = map_weights_to_shared_memory_buffer(self.ddpg_agent.critic.get_weights(), self.np_array_critic)
+            self.critic_weights = get_model_weights_store(self.ddpg_agent.critic, self.critic_memory_name)
             print('Done')
+
+            if (self.quantization != QUANTIZATION_NONE):
+                print('Quantized weights memory reference creation...', end='')
+                stage = 'Quantized weights memory reference creation'
+                calibration = None if (self.calibration_path is None) else load_calibration(self.calibration_path)
+                self.actor_quantizer, self.critic_quantizer = get_quantizers(self.ddpg_agent, self.quantization, calibration)
+                self.actor_quantized = self.actor_quantizer.get_store(quantized_memory_name(self.actor_memory_name)).attach()
+                self.critic_quantized = self.critic_quantizer.get_store(quantized_memory_name(self.critic_memory_name)).attach()
+                print('Done')
+
+            if (self.policy_table is not None):
+                self.policy_table.attach()
         except Exception as e:
             print(str(self) + ' -> Stage: {}, Error initiating models: {}'.format(stage, e))
             raise e
@@ -86,12 +204,50 @@ class MainAgent(mp.Process):
                 self.ddpg_agent.load_critic_weights(self.critic_initial_weights_path)
 
     def publish_weights(self):
+        # the HARQ agents pick up the new generation between TTIs
+        actor_weights, critic_weights = self.ddpg_agent.actor.get_weights(), self.ddpg_agent.critic.get_weights()
         print(str(self) + ' -> Publishing actor weights to shared memory...', end='')
-        publish_weights_to_shared_memory(self.ddpg_agent.actor.get_weights(), self.np_array_actor)                
-        print('Done')
+        generation = self.actor_weights.publish(actor_weights)
+        print('Done (generation {})'.format(generation))
         
-        print(str(self) + ' -> Publishing critic weights to shared memory', end='')   
-        publish_weights_to_shared_memory(self.ddpg_agent.critic.get_weights(), self.np_array_critic)
+        print(str(self) + ' -> Publishing critic weights to shared memory...', end='')   
+        generation = self.critic_weights.publish(critic_weights)
+        print('Done (generation {})'.format(generation))
+        self.publish_quantized_weights(actor_weights, critic_weights, generation)
+
+    def publish_quantized_weights(self, actor_weights, critic_weights, generation):
+        if (self.actor_quantizer is None):
+            return
+        print(str(self) + ' -> Publishing {} weights to shared memory...'.format(self.quantization), end='')
+        self.actor_quantized.publish(self.actor_quantizer(actor_weights))
+        self.critic_quantized.publish(self.critic_quantizer(critic_weights))
+        self.quantized_generation = generation
+        print('Done ({} bytes instead of {})'.format(self.actor_quantized.nbytes() + self.critic_quantized.nbytes(),
+                                                    self.actor_weights.nbytes() + self.critic_weights.nbytes()))
+
+    def follow_published_weights(self):
+        # weights published by shared_weights.py while running are quantized here for the NumPy workers
+        if (self.actor_quantizer is None or self.critic_weights.generation() == self.quantized_generation):
+            return
+        weights = {}
+        generation, _ = read_weight_pair(self.actor_weights, lambda arrays: weights.update(actor=arrays),
+                                         self.critic_weights, lambda arrays: weights.update(critic=arrays))
+        if (generation is None):
+            # the publisher stopped mid-publish, the quantized weights are left as they are
+            return
+        self.publish_quantized_weights(weights['actor'], weights['critic'], generation)
+
+    def compile_policy(self, policy_table_path=None):
+        if (self.policy_table is None):
+            return
+        if (policy_table_path is not None):
+            print(str(self) + ' -> Loading compiled policy from ' + policy_table_path + '...', end='')
+            self.policy_table.load(policy_table_path)
+        else:
+            print(str(self) + ' -> Compiling policy over {}x{} contexts...'.format(*self.policy_table.grid_size), end='')
+            self.ddpg_agent.set_action_array(get_action_array())
+            self.policy_table.build(self.ddpg_agent)
+        self.policy_table.publish()
         print('Done')
 
     def __str__(self) -> str:
@@ -0,0 +1,51 @@
+'''
+    Template for the agent processes when they are started by a forkserver
+    (multiprocessing.set_forkserver_preload). The forkserver imports this module once:
+    TensorFlow is imported and the actor/critic graphs are built here, and every agent
+    process forked afterwards inherits them instead of building its own.
+'''
+import os
+from common_utils import StartupTimer, import_tensorflow, get_action_space, set_tensorflow_threads
+from agent_ddpg import DDPGAgent
+
+FORKSERVER_PRELOAD_ENV = 'ATHENA_FORKSERVER_PRELOAD'
+PRELOAD_CONTEXT_SIZE_ENV = 'ATHENA_PRELOAD_CONTEXT_SIZE'
+PRELOAD_ACTION_SIZE_ENV  = 'ATHENA_PRELOAD_ACTION_SIZE'
+PRELOAD_INTRA_OP_THREADS_ENV = 'ATHENA_PRELOAD_INTRA_OP_THREADS'
+PRELOAD_INTER_OP_THREADS_ENV = 'ATHENA_PRELOAD_INTER_OP_THREADS'
+
+tf = None
+template_agent = None
+
+def preload():
+    global tf, template_agent
+    timer = StartupTimer('Forkserver template')
+    tf, _, _ = import_tensorflow('3', False)
+    # the thread pools are fixed once the models below initialize the runtime, for every forked agent
+    intra_op_threads = os.environ.get(PRELOAD_INTRA_OP_THREADS_ENV)
+    inter_op_threads = os.environ.get(PRELOAD_INTER_OP_THREADS_ENV)
+    if (intra_op_threads is not None and inter_op_threads is not None):
+        set_tensorflow_threads(tf, int(intra_op_threads), int(inter_op_threads), 'Forkserver template')
+    timer.lap('Import tensorflow')
+    get_action_space()
+    timer.lap('Action space')
+    context_size = os.environ.get(PRELOAD_CONTEXT_SIZE_ENV)
+    action_size  = os.environ.get(PRELOAD_ACTION_SIZE_ENV)
+    if (context_size is not None and action_size is not None):
+        template_agent = DDPGAgent(tf, int(context_size), int(action_size))
+        template_agent.load_actor()
+        template_agent.load_critic()
+        timer.lap('Build actor and critic')
+    timer.report()
+
+def take_template_models(context_size, action_size):
+    ## the forked process owns a (copy-on-write) copy of the template, so it can adopt its models once
+    global template_agent
+    if (template_agent is None or template_agent.context_size != context_size or template_agent.action_size != action_size):
+        return None
+    models = template_agent.actor, template_agent.critic
+    template_agent = None
+    return models
+
+if (os.environ.get(FORKSERVER_PRELOAD_ENV) == '1'):
+    preload()
@@ -6,15 +6,26 @@ from srsran_env import SrsRanEnv
 from config import Config
 from agent_factory import AgentFactory
 from coordinator import Coordinator
+from coordinator_async import AsyncCoordinator
 from log_process import LogProcess
+from policy_table import PolicyTable
+from common_utils import parse_cores
+from experience_ring import ExperienceRingReader
+from notifier import Notifier
+from latency_stats import LatencyStats
+from fallback import FallbackPolicy
+from ue_slots import UeSlots
+from namespace import set_cell, lock_cell, unlink_segments
+from placement import Placement, apply_placement, ROLE_PARENT, ROLE_HARQ
 
 
 coordinator = None
 agent_factory = None
-stop_flag   = mp.Value('i', 0)
+stop_flag   = None
 
 def exit_gracefully(signal, frame):
-    stop_flag.value = 1
+    if (stop_flag is not None):
+        stop_flag.value = 1
     if (agent_factory is not None):
         agent_factory.kill()
     
@@ -29,6 +40,41 @@ def get_config() -> Config:
     parser.add_argument('--actor_weights', dest='actor_weights')
     parser.add_argument('--critic_weights', dest='critic_weights')
     parser.add_argument('--verbose', type=int, choices=range(0,2), dest='verbose', default=0)
+    parser.add_argument('--compiled_policy', action='store_true', dest='compiled_policy')
+    parser.add_argument('--policy_table', dest='policy_table')
+    parser.add_argument('--cpu_step', type=float, dest='cpu_step', default=5)
+    parser.add_argument('--snr_step', type=float, dest='snr_step', default=0.25)
+    parser.add_argument('--inference_server', action='store_true', dest='inference_server')
+    parser.add_argument('--batch_window_us', type=int, dest='batch_window_us', default=200)
+    parser.add_argument('--tti_deadline_us', type=int, dest='tti_deadline_us', default=1000)
+    parser.add_argument('--numpy_inference', action='store_true', dest='numpy_inference')
+    parser.add_argument('--numpy_dtype', choices=['float32', 'float64'], dest='numpy_dtype', default='float32')
+    parser.add_argument('--quantization', choices=['none', 'float16', 'int8'], dest='quantization', default='none')
+    parser.add_argument('--calibration', dest='calibration', help='dataset_builder.py dataset the int8 quantization is calibrated on')
+    parser.add_argument('--blas_threads', type=int, dest='blas_threads', default=1)
+    parser.add_argument('--fused_decision', action='store_true', dest='fused_decision')
+    parser.add_argument('--xla', action='store_true', dest='jit_compile')
+    parser.add_argument('--startup', choices=['fork', 'forkserver'], dest='startup', default='fork')
+    parser.add_argument('--train', action='store_true', dest='train')
+    parser.add_argument('--train_batch', type=int, dest='train_batch', default=64)
+    parser.add_argument('--train_every', type=int, dest='train_every', default=8)
+    parser.add_argument('--replay_size', type=int, dest='replay_size', default=100000)
+    parser.add_argument('--publish_every', type=int, dest='publish_every', default=100)
+    parser.add_argument('--learner_cores', dest='learner_cores')
+    parser.add_argument('--learner_threads', type=int, dest='learner_threads', default=1)
+    parser.add_argument('--transport', choices=['queue', 'ring'], dest='transport', default='queue')
+    parser.add_argument('--ring_capacity', type=int, dest='ring_capacity', default=4096)
+    parser.add_argument('--log_format', choices=['text', 'npy'], dest='log_format', default='text')
+    parser.add_argument('--coordinator', choices=['processes', 'asyncio'], dest='coordinator', default='processes')
+    parser.add_argument('--latency_stats', action='store_true', dest='latency_stats')
+    parser.add_argument('--decision_budget_us', type=int, dest='decision_budget_us')
+    parser.add_argument('--fallback', choices=['last', 'table', 'rule'], dest='fallback', default='last')
+    parser.add_argument('--max_ues', type=int, dest='max_ues', default=1)
+    parser.add_argument('--ue_timeout_ms', type=int, dest='ue_timeout_ms', default=1000)
+    parser.add_argument('--cell', dest='cell')
+    parser.add_argument('--agents', type=int, dest='agents', default=8)
+    parser.add_argument('--placement', dest='placement', help='JSON placement of the processes on the cores (see placement.py)')
+    parser.add_argument('--startup_timeout_s', type=int, dest='startup_timeout_s', default=900, help='0 waits for the agents as long as they take')
     
     scheduling_mode = None
     path_results = None
@@ -38,6 +84,8 @@ def get_config() -> Config:
     
     args = parser.parse_args()
     print(args)
+    # before any process or segment is created, every name below is resolved in the namespace of the cell
+    set_cell(args.cell)
     path_results = args.path_results
     mode = args.mode
     verbose = 0
@@ -66,61 +114,166 @@ def get_config() -> Config:
     config.critic_path = path_critic_weights
     config.result_path = path_results
     config.verbose     = verbose
+    if (scheduling_mode == MODE_SCHEDULING_ATHENA and (args.compiled_policy or args.policy_table is not None)):
+        config.policy_table = PolicyTable(cpu_step=args.cpu_step, snr_step=args.snr_step)
+        config.policy_table_path = args.policy_table
+    config.inference_server = scheduling_mode == MODE_SCHEDULING_ATHENA and args.inference_server
+    config.batch_window_us  = args.batch_window_us
+    config.tti_deadline_us  = args.tti_deadline_us
+    config.numpy_inference  = scheduling_mode == MODE_SCHEDULING_ATHENA and args.numpy_inference
+    config.numpy_dtype      = args.numpy_dtype
+    config.quantization     = args.quantization
+    config.calibration_path = args.calibration
+    if (config.quantization != 'none' and not config.numpy_inference):
+        print('--quantization only applies to --numpy_inference, ignored')
+    config.blas_threads     = args.blas_threads
+    config.fused_decision   = args.fused_decision or args.jit_compile
+    config.jit_compile      = args.jit_compile
+    config.startup          = args.startup
+    config.train            = scheduling_mode == MODE_SCHEDULING_ATHENA and args.train
+    config.train_batch_size = args.train_batch
+    config.train_every      = args.train_every
+    config.replay_size      = args.replay_size
+    config.publish_every    = args.publish_every
+    config.learner_cores    = parse_cores(args.learner_cores)
+    config.learner_threads  = args.learner_threads
+    config.transport        = args.transport
+    config.ring_capacity    = args.ring_capacity
+    config.log_format       = args.log_format
+    config.coordinator      = args.coordinator
+    config.max_ues          = args.max_ues
+    config.cell             = args.cell
+    config.total_agents     = args.agents
+    config.ue_timeout_ms    = args.ue_timeout_ms
+    config.startup_timeout_s = args.startup_timeout_s if (args.startup_timeout_s > 0) else None
+    if (args.placement is not None):
+        config.placement = Placement.load(args.placement)
+    if (args.latency_stats):
+        # decision, verify and inference are bound by the TTI deadline, the reward loop is not
+        tti_deadline_us = args.tti_deadline_us
+        config.latency_stats = LatencyStats(args.agents, deadlines_us=(tti_deadline_us, tti_deadline_us, 0, tti_deadline_us))
+    if (args.decision_budget_us is not None):
+        if (args.fallback == 'table' and config.policy_table is None):
+            raise Exception('--fallback table needs --compiled_policy or --policy_table')
+        # the coordinator reads the published policy table through its own PolicyTable
+        fallback_table = PolicyTable(cpu_step=args.cpu_step, snr_step=args.snr_step) if (args.fallback == 'table') else None
+        config.decision_budget_us = args.decision_budget_us
+        config.fallback = FallbackPolicy(args.agents * args.max_ues, mode=args.fallback, policy_table=fallback_table)
     config.environment = SrsRanEnv(
             context_size=2, action_size=action_size, 
             penalty=1, title = 'srsRAN', verbose=verbose,
-            decode_deadline=3000, scheduling_mode=scheduling_mode)
+            decode_deadline=3000, scheduling_mode=scheduling_mode,
+            max_ues=args.max_ues)
     return config
 
+def configure_forkserver(config: Config):
+    # The forkserver imports TensorFlow and builds the actor/critic graphs once (agent_preload),
+    # and the agent processes are forked from it. Must run before any multiprocessing object is created.
+    import os
+    import agent_preload
+    os.environ[agent_preload.FORKSERVER_PRELOAD_ENV]   = '1'
+    os.environ[agent_preload.PRELOAD_CONTEXT_SIZE_ENV] = str(config.context_size)
+    os.environ[agent_preload.PRELOAD_ACTION_SIZE_ENV]  = str(config.action_size)
+    # the agents share the runtime of the template, its thread pools are sized there: for the learner,
+    # or as placed for the HARQ agents, the most numerous processes forked from it
+    harq_threads = None if (config.placement is None) else config.placement.threads_of(ROLE_HARQ)
+    if (config.train):
+        os.environ[agent_preload.PRELOAD_INTRA_OP_THREADS_ENV] = str(config.learner_threads)
+        os.environ[agent_preload.PRELOAD_INTER_OP_THREADS_ENV] = '1'
+    elif (harq_threads is not None):
+        os.environ[agent_preload.PRELOAD_INTRA_OP_THREADS_ENV] = str(harq_threads)
+        os.environ[agent_preload.PRELOAD_INTER_OP_THREADS_ENV] = str(harq_threads)
+    mp.set_start_method('forkserver')
+    mp.set_forkserver_preload(['__main__', 'agent_preload'])
+
 if __name__== '__main__':
     import signal
     signal.signal(signal.SIGINT , exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
     config:Config = get_config()
+    if (config.startup == 'forkserver'):
+        configure_forkserver(config)
+    stop_flag = mp.Value('i', 0)
+    total_agents = config.total_agents
+    if (config.placement is not None):
+        print(config.placement.describe(total_agents, config.coordinator, config.inference_server))
+        # the processes of the roles left out of the placement inherit the affinity of athena_ml.py
+        apply_placement(config.placement, ROLE_PARENT)
+    # only the owner of the cell lock may touch its segments, those of a running instance are left alone
+    cell_lock = lock_cell()
+    # segments left by a crashed run of the cell would be silently reattached
+    unlink_segments(total_agents, 'Removing stale')
 
     results_queue = mp.Queue()
+    experience_ring = None
+    if (config.transport == 'ring'):
+        experience_ring = ExperienceRingReader(total_agents, config.ring_capacity)
     log_process = LogProcess(
         log_queue=results_queue, 
         scheduling_mode=config.scheduling_mode, 
         log_file=config.result_path,
-        stop_flag=stop_flag)
+        stop_flag=stop_flag,
+        experience_ring=experience_ring,
+        log_format=config.log_format,
+        placement=config.placement)
     log_process.start()
 
-    total_agents = 8    
-    cond_observations = [mp.Condition() for _ in range(total_agents)]
-    cond_actions      = [mp.Condition() for _ in range(total_agents)]
-    cond_verify_action= [mp.Condition() for _ in range(total_agents)]
-    cond_rewards      = [mp.Condition() for _ in range(total_agents)]
-    agent_coordination_lock = mp.Value('i', 0)
-
-    coordinator = Coordinator(
-        observation_locks=cond_observations, 
-        action_locks=cond_actions, 
-        reward_locks=cond_rewards, 
-        verify_action_locks=cond_verify_action,
+    notify_observations  = [Notifier() for _ in range(total_agents)]
+    notify_actions       = [Notifier() for _ in range(total_agents)]
+    notify_verify_action = [Notifier() for _ in range(total_agents)]
+    notify_rewards       = [Notifier() for _ in range(total_agents)]
+    agent_coordination_lock = mp.Event()
+
+    if (config.latency_stats is not None):
+        config.latency_stats.attach().reset()
+    if (config.fallback is not None):
+        config.fallback.attach().reset()
+
+    coordinator_class = AsyncCoordinator if (config.coordinator == 'asyncio') else Coordinator
+    coordinator = coordinator_class(
+        observation_notifiers=notify_observations, 
+        action_notifiers=notify_actions, 
+        reward_notifiers=notify_rewards, 
+        verify_action_notifiers=notify_verify_action,
         agent_coordination_lock=agent_coordination_lock,
-        verbose=config.verbose
+        verbose=config.verbose,
+        latency_stats=config.latency_stats,
+        decision_budget_us=config.decision_budget_us,
+        fallback=config.fallback,
+        ue_slots=UeSlots(config.max_ues, total_agents, config.ue_timeout_ms),
+        total_agents=total_agents,
+        placement=config.placement
     )
     coordinator.start()
 
     inputs = []
     for idx in range(total_agents):
         input = {}
-        input['cond_observation'] = cond_observations[idx]
-        input['cond_action']      = cond_actions[idx]
-        input['cond_verify_action']     = cond_verify_action[idx]
-        input['cond_reward'] = cond_rewards[idx]
+        input['notify_observation'] = notify_observations[idx]
+        input['notify_action']      = notify_actions[idx]
+        input['notify_verify_action']     = notify_verify_action[idx]
+        input['notify_reward'] = notify_rewards[idx]
         inputs.append(input)
     agent_factory = AgentFactory(
         config=config, 
         agent_coordination_lock=agent_coordination_lock,
         stop_flag=stop_flag)
-    agent_factory.start(
-        inputs=inputs,
-        results_queue=results_queue
-    )
+    startup_failed = False
+    try:
+        agent_factory.start(
+            inputs=inputs,
+            results_queue=results_queue
+        )
+    except Exception as e:
+        # an agent that failed to initialize would leave srsENB waiting on the others forever
+        print('Startup aborted: {}'.format(e))
+        startup_failed = True
+        exit_gracefully(None, None)
 
     log_process.join()
+    unlink_segments(total_agents)
+    if (startup_failed):
+        raise SystemExit(1)
 
 
     
\ No newline at end of file
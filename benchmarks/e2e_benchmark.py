@@ -0,0 +1,96 @@
+'''
+    End-to-end throughput benchmark: starts athena_ml.py in its own cell for every configuration,
+    drives it with the srsENB stand-in at every TTI rate and reports the sustained decisions per second,
+    the context -> action latency percentiles and the late/behind/rejected counts.
+
+        python3 benchmarks/e2e_benchmark.py --run random="-m random" \
+            --run numpy="-m athena --actions 2 --actor_weights a.h5 --critic_weights c.h5 --numpy_inference" \
+            --rates 500 1000 2000 --duration 10 -o e2e.json
+'''
+import os
+import sys
+import json
+import shlex
+import signal
+import argparse
+import subprocess
+import tempfile
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_PATH))
+from namespace import set_cell
+from enb_emulator import add_emulator_arguments, get_cell, run_emulator
+
+def parse_run(run):
+    ## 'name=athena_ml arguments'
+    if ('=' not in run):
+        raise Exception('--run expects name="athena_ml arguments", got {}'.format(run))
+    name, arguments = run.split('=', 1)
+    return name, shlex.split(arguments)
+
+def run_configuration(name, arguments, rate, args, work_path):
+    cell = 'bench_{}'.format(name)
+    set_cell(cell)
+    results_path = os.path.join(work_path, '{}_{}.log'.format(name, int(rate)))
+    command = [sys.executable, os.path.join(os.path.dirname(BENCHMARKS_PATH), 'athena_ml.py'),
+               '-r', results_path, '--cell', cell, '--max_ues', str(args.ues)] + arguments
+    log_path = os.path.join(work_path, '{}_{}.out'.format(name, int(rate)))
+    print('[{} @ {} TTI/s] {}'.format(name, rate, ' '.join(command)))
+    with open(log_path, 'w') as log_file:
+        scheduler = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            stats = run_emulator(get_cell(args), total_ues=args.ues, rate=rate, duration=args.duration,
+                                 deadline_us=args.deadline_us, reward_delay=args.reward_delay,
+                                 stall_timeout=args.stall_timeout, connect_timeout=args.connect_timeout,
+                                 is_alive=lambda: scheduler.poll() is None)
+        except Exception as e:
+            if (scheduler.poll() is not None):
+                e = '{} (exit code {}, see {})'.format(e, scheduler.returncode, log_path)
+            stats = {'rate': rate, 'error': str(e)}
+        finally:
+            scheduler.send_signal(signal.SIGINT)
+            try:
+                scheduler.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                scheduler.kill()
+                scheduler.wait()
+    stats['name'] = name
+    stats['scheduler_log'] = log_path
+    return stats
+
+def format_report(results):
+    lines = ['{:<12} {:>8} {:>10} {:>12} {:>9} {:>9} {:>9} {:>10} {:>8} {:>8} {:>8}'.format(
+        'run', 'rate', 'decisions', 'decisions/s', 'p50_us', 'p99_us', 'p99.9_us', 'max_us', 'late', 'behind', 'rejected')]
+    for stats in results:
+        if ('error' in stats):
+            lines.append('{:<12} {:>8} error: {}'.format(stats['name'], stats['rate'], stats['error']))
+            continue
+        latency = stats['latency_us']
+        lines.append('{:<12} {:>8} {:>10} {:>12.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>8} {:>8} {:>8}'.format(
+            stats['name'], stats['rate'], stats['decisions'], stats['decisions_per_s'],
+            latency['p50'], latency['p99'], latency['p99.9'], latency['max'],
+            stats['late'], stats['behind'], stats['rejected']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark of the ATHENA scheduler')
+    add_emulator_arguments(parser)
+    parser.add_argument('--run', action='append', dest='runs', help='name="athena_ml arguments", repeatable')
+    parser.add_argument('--rates', type=float, nargs='+', dest='rates', default=[1000])
+    parser.add_argument('--work_path', dest='work_path', help='where the results files and scheduler logs are kept')
+    parser.add_argument('-o', '--output', dest='output')
+    args = parser.parse_args()
+    runs = args.runs if (args.runs is not None) else ['random=-m random']
+
+    work_path = args.work_path if (args.work_path is not None) else tempfile.mkdtemp(prefix='athena_e2e_')
+    os.makedirs(work_path, exist_ok=True)
+    results = []
+    for run in runs:
+        name, arguments = parse_run(run)
+        for rate in args.rates:
+            results.append(run_configuration(name, arguments, rate, args, work_path))
+    print(format_report(results))
+    if (args.output is not None):
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
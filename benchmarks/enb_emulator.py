@@ -0,0 +1,279 @@
+'''
+    srsENB stand-in speaking the FIFO protocol of the Coordinator, to load-test the Python
+    scheduler without the srsENB + srsUE + GNU Radio + EPC stack.
+    Every TTI it writes the context packets of its UEs to actor_in, reads one action per context
+    from actor_out, answers each with a verify word, and writes the reward packets to return_in
+    reward_delay TTIs later. The contexts and decoding results come from a synthetic channel and
+    decoder model, or from a replayed LogProcess results file (text or npy).
+'''
+import os
+import sys
+import time
+import select
+import json
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common_utils import get_action_space
+from coordinator import FROM_MAC_CONTEXT, TO_MAC_ACTION, FROM_MAC_VERIFY, FROM_PHY_REWARD
+from fifo_packets import CONTEXT_PACKET_DTYPE, REWARD_PACKET_DTYPE, VERIFY_PACKET_DTYPE
+from namespace import namespaced_path, set_cell
+from results_format import MAGIC, load_results
+
+FIRST_RNTI = 0x46
+TTI_WRAP = 10240
+
+class SyntheticCell():
+    '''
+        Random walk of the context of every UE (cpu load beta, snr in dB, gain) and a simple decoder:
+        the transport block is decoded if its MCS is supported by the snr, and the decoding time grows
+        with the tbs and the cpu load.
+    '''
+
+    def __init__(self, total_ues, seed = 0, bsr = 100000) -> None:
+        self.random = np.random.default_rng(seed)
+        self.action_space = get_action_space()
+        self.bsr = bsr
+        self.cpu  = self.random.uniform(0, 1000, size=total_ues)
+        self.snr  = self.random.uniform(18, 49, size=total_ues)
+        self.gain = np.full(shape=(total_ues, ), fill_value=100)
+
+    def next_contexts(self):
+        ## (beta, snr x1000, bsr, gain) per UE
+        self.cpu = np.clip(self.cpu + self.random.normal(0, 5, size=len(self.cpu)), 0, 1000)
+        self.snr = np.clip(self.snr + self.random.normal(0, 0.05, size=len(self.snr)), 18, 49)
+        return [(int(cpu), int(snr * 1000), self.bsr, int(gain)) for cpu, snr, gain in zip(self.cpu, self.snr, self.gain)]
+
+    def decode(self, ue, cpu, snr, mcs, prb):
+        ## (crc, dec_time in us, dec_bits) of the transport block
+        tbs = self.action_space.to_tbs(mcs, prb)
+        max_mcs = (snr / 1000 - 18) * 24 / 31
+        crc = int(mcs <= max_mcs + self.random.normal(0, 0.5))
+        dec_time = int(50 + tbs * (1 + cpu / 1000) / 20 + self.random.exponential(20))
+        return crc, dec_time, tbs
+
+class ReplayCell(SyntheticCell):
+    '''
+        Replays the contexts of a results file, in the order they were logged, one row per UE and TTI.
+        When the action matches the logged one, the logged crc and decoding time are returned.
+    '''
+
+    def __init__(self, total_ues, path, seed = 0, bsr = 100000) -> None:
+        super(ReplayCell, self).__init__(total_ues, seed, bsr)
+        self.columns = load_replay(path)
+        self.total_rows = len(self.columns['cpu'])
+        if (self.total_rows == 0):
+            raise Exception('No samples to replay in {}'.format(path))
+        self.row = 0
+        self.rows = [0] * total_ues
+        self.decoding_time = self.columns['decoding_time' if ('decoding_time' in self.columns) else 'dec_time']
+
+    def next_contexts(self):
+        contexts = []
+        for ue in range(len(self.rows)):
+            row = self.row % self.total_rows
+            self.rows[ue] = row
+            self.row += 1
+            gain = self.columns['gain'][row] if ('gain' in self.columns) else 100
+            contexts.append((int(self.columns['cpu'][row]), int(self.columns['snr'][row] * 1000), self.bsr, int(gain)))
+        return contexts
+
+    def decode(self, ue, cpu, snr, mcs, prb):
+        row = self.rows[ue]
+        if (self.columns['mcs'][row] == mcs and self.columns['prb'][row] == prb):
+            return int(self.columns['crc'][row]), int(self.decoding_time[row]), self.action_space.to_tbs(mcs, prb)
+        return super(ReplayCell, self).decode(ue, cpu, snr, mcs, prb)
+
+def load_replay(path):
+    ## {column: array} of a LogProcess results file, binary or pipe-delimited text
+    with open(path, 'rb') as file:
+        is_binary = file.read(len(MAGIC)) == MAGIC
+    if (is_binary):
+        return load_results(path)[1]
+    with open(path, 'r') as file:
+        names = file.readline().strip().split('|')
+    values = np.loadtxt(path, delimiter='|', skiprows=1, ndmin=2)
+    return {name: values[:, idx] for idx, name in enumerate(names)}
+
+def check_alive(is_alive):
+    if (is_alive is not None and not is_alive()):
+        raise Exception('Scheduler exited')
+
+def open_fifo(path, mode, connect_timeout = None, is_alive = None, poll_interval = 0.1):
+    ## opens a FIFO end without blocking on a scheduler that never opens the other one
+    if (not os.path.exists(path)):
+        os.mkfifo(path)
+    deadline = None if (connect_timeout is None) else time.monotonic() + connect_timeout
+    flags = os.O_RDONLY if (mode == 'rb') else os.O_WRONLY
+    while (True):
+        try:
+            # a read end opens at once, a write end fails with ENXIO until the scheduler opens the read end
+            fd = os.open(path, flags | os.O_NONBLOCK)
+            break
+        except OSError:
+            check_alive(is_alive)
+            if (deadline is not None and time.monotonic() > deadline):
+                raise Exception('Scheduler did not open {} within {} s'.format(path, connect_timeout))
+            time.sleep(poll_interval)
+    os.set_blocking(fd, True)
+    return open(fd, mode, buffering=0)
+
+def read_exactly(file, size, timeout, is_alive = None, poll_interval = 0.5):
+    ## blocking read of size bytes, raises if the scheduler does not answer within timeout seconds or exits
+    data = b''
+    while (len(data) < size):
+        deadline = time.monotonic() + timeout
+        ready = []
+        # select only reports the FIFO once the scheduler has connected and written to it
+        while (len(ready) == 0 and time.monotonic() < deadline):
+            ready, _, _ = select.select([file], [], [], min(poll_interval, max(deadline - time.monotonic(), 0)))
+            if (len(ready) == 0):
+                check_alive(is_alive)
+        if (len(ready) == 0):
+            raise Exception('Scheduler stalled: no answer within {} s'.format(timeout))
+        chunk = file.read(size - len(data))
+        if (len(chunk) == 0):
+            raise Exception('Scheduler closed {}'.format(file.name))
+        data += chunk
+    return data
+
+def run_emulator(cell, total_ues = 1, rate = 1000, duration = 10, deadline_us = 1000,
+                 reward_delay = 4, first_tti = 0, stall_timeout = 5, verbose = False,
+                 connect_timeout = None, is_alive = None):
+    ## drives the scheduler at rate TTIs per second for duration seconds, returns the statistics;
+    ## is_alive() tells whether the scheduler process still runs, a dead scheduler raises instead of blocking
+    context_fifo = namespaced_path(FROM_MAC_CONTEXT)
+    action_fifo  = namespaced_path(TO_MAC_ACTION)
+    verify_fifo  = namespaced_path(FROM_MAC_VERIFY)
+    reward_fifo  = namespaced_path(FROM_PHY_REWARD)
+    for path in [context_fifo, action_fifo, verify_fifo, reward_fifo]:
+        if (not os.path.exists(path)):
+            os.mkfifo(path)
+    print('Waiting for the scheduler on {}...'.format(context_fifo))
+    # same order as the scheduler interface of the Coordinator opens them
+    context_file = open_fifo(context_fifo, 'wb', connect_timeout, is_alive)
+    verify_file  = open_fifo(verify_fifo, 'wb', connect_timeout, is_alive)
+    action_file  = open_fifo(action_fifo, 'rb', connect_timeout, is_alive)
+    reward_file  = open_fifo(reward_fifo, 'wb', connect_timeout, is_alive)
+    print('Scheduler connected')
+
+    action_space = get_action_space()
+    rntis = [FIRST_RNTI + ue for ue in range(total_ues)]
+    total_ttis = int(rate * duration)
+    tti_period = 1.0 / rate
+    contexts = np.zeros(shape=(total_ues, ), dtype=CONTEXT_PACKET_DTYPE)
+    rewards = np.zeros(shape=(total_ues, ), dtype=REWARD_PACKET_DTYPE)
+    verify = np.zeros(shape=(1, ), dtype=VERIFY_PACKET_DTYPE)
+    pending_rewards = {}
+    latencies = np.zeros(shape=(total_ttis * total_ues, ), dtype=np.int64)
+    decisions = 0
+    late = 0
+    rejected = 0
+    behind = 0
+
+    start = time.perf_counter()
+    for tti_idx in range(total_ttis):
+        tti_start = start + tti_idx * tti_period
+        now = time.perf_counter()
+        if (now - tti_start > tti_period):
+            # the scheduler answered too slowly to keep the rate, this TTI starts late
+            behind += 1
+        while (now < tti_start):
+            if (tti_start - now > 0.0002):
+                time.sleep(tti_start - now - 0.0001)
+            now = time.perf_counter()
+
+        tti = (first_tti + tti_idx) % TTI_WRAP
+        reward_packets = pending_rewards.pop(tti_idx, None)
+        if (reward_packets is not None):
+            reward_file.write(reward_packets)
+
+        ue_contexts = cell.next_contexts()
+        for ue, (beta, snr, bsr, gain) in enumerate(ue_contexts):
+            contexts[ue] = (tti, rntis[ue], bsr, snr, beta, gain)
+        context_file.write(contexts.tobytes())
+        sent = time.perf_counter_ns()
+
+        total_rewards = 0
+        for ue, (beta, snr, bsr, gain) in enumerate(ue_contexts):
+            mcs, prb = read_exactly(action_file, 2, stall_timeout, is_alive)
+            latency = time.perf_counter_ns() - sent
+            latencies[decisions] = latency
+            decisions += 1
+            if (latency > deadline_us * 1000):
+                late += 1
+            applied = not action_space.is_prohibited(mcs, prb)
+            verify['verified'] = int(applied)
+            verify_file.write(verify.tobytes())
+            if (not applied):
+                rejected += 1
+                continue
+            crc, dec_time, dec_bits = cell.decode(ue, beta, snr, mcs, prb)
+            rewards[total_rewards] = (tti, rntis[ue], dec_time, crc, b'', dec_bits, mcs, prb, snr, -90000, snr)
+            total_rewards += 1
+            if (verbose):
+                print('TTI {} UE 0x{:x} -> mcs {} prb {} ({} us)'.format(tti, rntis[ue], mcs, prb, latency // 1000))
+        if (total_rewards > 0):
+            pending_rewards[tti_idx + reward_delay] = rewards[:total_rewards].tobytes()
+    elapsed = time.perf_counter() - start
+
+    for reward_packets in pending_rewards.values():
+        reward_file.write(reward_packets)
+    for file in [context_file, verify_file, action_file, reward_file]:
+        file.close()
+
+    latencies_us = latencies[:decisions] / 1000
+    percentiles = np.percentile(latencies_us, [50, 90, 99, 99.9]) if (decisions > 0) else [0, 0, 0, 0]
+    return {
+        'rate': rate,
+        'ues': total_ues,
+        'ttis': total_ttis,
+        'decisions': decisions,
+        'elapsed_s': elapsed,
+        'decisions_per_s': decisions / elapsed,
+        'latency_us': {
+            'mean': float(latencies_us.mean()) if (decisions > 0) else 0,
+            'p50': float(percentiles[0]), 'p90': float(percentiles[1]),
+            'p99': float(percentiles[2]), 'p99.9': float(percentiles[3]),
+            'max': float(latencies_us.max()) if (decisions > 0) else 0
+        },
+        'late': late,
+        'behind': behind,
+        'rejected': rejected
+    }
+
+def get_cell(args):
+    if (args.replay is not None):
+        return ReplayCell(args.ues, args.replay, seed=args.seed, bsr=args.bsr)
+    return SyntheticCell(args.ues, seed=args.seed, bsr=args.bsr)
+
+def add_emulator_arguments(parser):
+    parser.add_argument('--rate', type=float, dest='rate', default=1000, help='TTIs per second')
+    parser.add_argument('--duration', type=float, dest='duration', default=10, help='seconds')
+    parser.add_argument('--ues', type=int, dest='ues', default=1)
+    parser.add_argument('--replay', dest='replay', help='LogProcess results file (text or npy) to replay')
+    parser.add_argument('--deadline_us', type=int, dest='deadline_us', default=1000, help='actions later than this are counted as late')
+    parser.add_argument('--reward_delay', type=int, dest='reward_delay', default=4, help='TTIs between an action and its reward')
+    parser.add_argument('--stall_timeout', type=float, dest='stall_timeout', default=5)
+    parser.add_argument('--connect_timeout', type=float, dest='connect_timeout', default=900, help='seconds the scheduler has to open the FIFOs')
+    parser.add_argument('--bsr', type=int, dest='bsr', default=100000)
+    parser.add_argument('--seed', type=int, dest='seed', default=0)
+    parser.add_argument('--cell', dest='cell')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='srsENB stand-in for the ATHENA Coordinator FIFO protocol')
+    add_emulator_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', dest='verbose')
+    parser.add_argument('-o', '--output', dest='output', help='write the statistics as JSON')
+    args = parser.parse_args()
+    set_cell(args.cell)
+
+    stats = run_emulator(get_cell(args), total_ues=args.ues, rate=args.rate, duration=args.duration,
+                         deadline_us=args.deadline_us, reward_delay=args.reward_delay,
+                         stall_timeout=args.stall_timeout, verbose=args.verbose, connect_timeout=args.connect_timeout)
+    print(json.dumps(stats, indent=2))
+    if (args.output is not None):
+        with open(args.output, 'w') as file:
+            json.dump(stats, file, indent=2)
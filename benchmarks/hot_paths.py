@@ -0,0 +1,294 @@
+'''
+    Microbenchmarks of the per-TTI hot paths of the scheduler, offline on a plain CPU box (no srsRAN).
+    Every benchmark reports the median (and minimum) ns per call over several repeats, as JSON.
+    The results are compared against the baseline stored in benchmarks/baseline.json (or another one):
+
+        python3 benchmarks/hot_paths.py --compare --threshold 0.2
+        python3 benchmarks/hot_paths.py --save                       # measure the stored baseline again
+
+    The comparison is made on the minimum ns per call, the least noisy estimate. A baseline is measured over
+    several runs (--baseline_runs), each in its own interpreter: it keeps the fastest minimum of every benchmark
+    and its spread, the noise within and across these runs. The allowed slowdown is the threshold, or the spread of the baseline when
+    that is larger; the run being compared never widens its own tolerance. The benchmarks flagged as slower
+    are measured again in a fresh interpreter (--reruns) before being reported, and the comparison exits with status 1 when a
+    benchmark is still slower than allowed after that.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+from multiprocessing import shared_memory
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common_utils import get_action_space, to_tbs, map_weights_to_shared_memory_buffer, publish_weights_to_shared_memory
+from agent_ddpg import DDPGAgent
+from numpy_inference import NumpyMLP, mlp_weight_shapes, ACTIVATION_SIGMOID, ACTIVATION_LINEAR
+from srsran_env import SrsRanEnv
+from fifo_packets import PacketReader, CONTEXT_PACKET_DTYPE, REWARD_PACKET_DTYPE
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+K_VALUES = [3, 9, 27]
+ACTION_SIZES = [1, 2]
+
+def measure(function, repeats = 7, min_time = 0.05):
+    ## (median, minimum) ns per call, every repeat runs the function for about min_time seconds
+    function() # warm up the caches and any lazily built state
+    calls = 1
+    while (True):
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if (elapsed >= min_time * 1e9):
+            break
+        calls *= 2
+    timings = [elapsed / calls]
+    for _ in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            function()
+        timings.append((time.perf_counter_ns() - start) / calls)
+    return float(np.median(timings)), float(np.min(timings)), calls
+
+class BurstFile():
+    '''
+        Stands in for an unbuffered FIFO that always has the same burst of packets ready.
+    '''
+
+    def __init__(self, burst) -> None:
+        self.burst = memoryview(burst)
+
+    def readinto(self, view):
+        size = min(len(view), len(self.burst))
+        view[:size] = self.burst[:size]
+        return size
+
+def random_weights(shapes, seed):
+    random = np.random.default_rng(seed)
+    return [random.normal(0, 0.1, size=shape).astype(np.float32) for shape in shapes]
+
+def numpy_ddpg_agent(action_size):
+    ddpg_agent = DDPGAgent(None, 2, action_size)
+    ddpg_agent.set_action_array(get_action_space().action_array.copy())
+    actor_shapes  = mlp_weight_shapes(2, action_size)
+    critic_shapes = mlp_weight_shapes(2 + action_size, 1)
+    ddpg_agent.actor  = NumpyMLP(actor_shapes, ACTIVATION_SIGMOID)
+    ddpg_agent.critic = NumpyMLP(critic_shapes, ACTIVATION_LINEAR)
+    ddpg_agent.actor.set_weights(random_weights(actor_shapes, 0))
+    ddpg_agent.critic.set_weights(random_weights(critic_shapes, 1))
+    return ddpg_agent
+
+def tensorflow_ddpg_agent(tf, action_size):
+    ddpg_agent = DDPGAgent(tf, 2, action_size)
+    ddpg_agent.set_action_array(get_action_space().action_array.copy())
+    ddpg_agent.load_actor()
+    ddpg_agent.load_critic()
+    return ddpg_agent
+
+def ddpg_benchmarks(backends):
+    ## numpy: NumpyMLP networks, tf: eager Keras networks, tf_graph: compile_decision graph (one per k)
+    context = np.array([500, 30], dtype=np.float32)
+    benchmarks = []
+    tf = None
+    if ('tf' in backends or 'tf_graph' in backends):
+        from common_utils import import_tensorflow
+        tf, _, _ = import_tensorflow('3', False)
+    for backend in backends:
+        for action_size in ACTION_SIZES:
+            for k in K_VALUES:
+                if (backend == 'numpy'):
+                    ddpg_agent = numpy_ddpg_agent(action_size)
+                else:
+                    ddpg_agent = tensorflow_ddpg_agent(tf, action_size)
+                    if (backend == 'tf_graph'):
+                        ddpg_agent.compile_decision(k)
+                benchmarks.append(('ddpg_call_{}_a{}_k{}'.format(backend, action_size, k),
+                                   lambda ddpg_agent=ddpg_agent, k=k: ddpg_agent(context, k)))
+    return benchmarks
+
+def action_space_benchmarks():
+    action_space = get_action_space()
+    ddpg_agent = DDPGAgent(None, 2, 2)
+    environment = SrsRanEnv()
+    return [
+        ('to_tbs', lambda: to_tbs(17, 25)),
+        ('readjust_to_demand_fits', lambda: ddpg_agent.readjust_to_demand(17, 25, 100000)),
+        ('readjust_to_demand_reduce', lambda: ddpg_agent.readjust_to_demand(24, 45, 500)),
+        ('is_prohibited', lambda: action_space.is_prohibited(2, 1)),
+        ('get_reward', lambda: environment.get_reward(17, 25, 1, 300)),
+        ('get_reward_prohibited', lambda: environment.get_reward(0, 1, 1, 300)),
+    ]
+
+def weights_benchmarks(shms):
+    benchmarks = []
+    for name, shapes in [('actor', mlp_weight_shapes(2, 2)), ('critic', mlp_weight_shapes(4, 1))]:
+        weights = random_weights(shapes, 2)
+        total_variables = int(np.sum([w.size for w in weights]))
+        shm = shared_memory.SharedMemory(create=True, size=total_variables * np.dtype(np.float32).itemsize)
+        shms.append(shm)
+        shared_ndarray = np.ndarray(shape=(total_variables, ), dtype=np.float32, buffer=shm.buf)
+        benchmarks.append(('publish_weights_{}'.format(name), lambda weights=weights, shared_ndarray=shared_ndarray: publish_weights_to_shared_memory(weights, shared_ndarray)))
+        benchmarks.append(('map_weights_{}'.format(name), lambda weights=weights, shared_ndarray=shared_ndarray: map_weights_to_shared_memory_buffer(list(weights), shared_ndarray)))
+    return benchmarks
+
+def packet_benchmarks():
+    benchmarks = []
+    for name, dtype, total_packets in [('contexts', CONTEXT_PACKET_DTYPE, 1), ('contexts', CONTEXT_PACKET_DTYPE, 8),
+                                       ('rewards', REWARD_PACKET_DTYPE, 1), ('rewards', REWARD_PACKET_DTYPE, 8)]:
+        packets = np.zeros(shape=(total_packets, ), dtype=dtype)
+        packets['tti'] = np.arange(total_packets)
+        reader = PacketReader(BurstFile(packets.tobytes()), dtype, total_packets)
+        benchmarks.append(('decode_{}_{}'.format(name, total_packets), lambda reader=reader: reader.read().tolist()))
+    return benchmarks
+
+def get_benchmarks(backends, shms):
+    ## (name, function) of every benchmark, the shared memory segments they use are appended to shms
+    return ddpg_benchmarks(backends) + action_space_benchmarks() + weights_benchmarks(shms) + packet_benchmarks()
+
+def run_benchmarks(benchmarks, selected = None, repeats = 7, min_time = 0.05):
+    results = {}
+    for name, function in benchmarks:
+        if (selected is not None and not any(pattern in name for pattern in selected)):
+            continue
+        median, minimum, calls = measure(function, repeats, min_time)
+        results[name] = {'ns_per_call': median, 'ns_min': minimum, 'calls': calls, 'repeats': repeats}
+        print('{:<32} {:>14.1f} ns/call (min {:.1f})'.format(name, median, minimum))
+    return results
+
+def run_in_subprocess(args, selected = None):
+    ## the results of a fresh interpreter: the state of a process (memory layout, allocator, page placement)
+    ## moves the timings too, and stays the same for all the measurements of that process
+    import subprocess
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'results.json')
+        command = [sys.executable, os.path.abspath(__file__), '--backends'] + args.backends
+        command += ['--repeats', str(args.repeats), '--min_time', str(args.min_time), '-o', output]
+        if (selected is not None):
+            command += ['--only'] + list(selected)
+        subprocess.run(command, check=True)
+        with open(output, 'r') as file:
+            return json.load(file)['results']
+
+def library_version(name):
+    from importlib import metadata
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'tensorflow': library_version('tensorflow'),
+        'keras': library_version('keras'),
+        'tf_keras': library_version('tf_keras'),
+        'legacy_keras': os.environ.get('TF_USE_LEGACY_KERAS')
+    }
+
+def spread(result):
+    ## relative noise of a measurement: how far the median of the repeats is above their minimum,
+    ## or the spread recorded by merge_runs for a baseline
+    if ('spread' in result):
+        return result['spread']
+    return result['ns_per_call'] / result['ns_min'] - 1
+
+def merge_runs(runs):
+    ## the baseline of several runs: the fastest result of every benchmark, with a spread covering both
+    ## the noise within the runs and how much the minimum moved from one run to the other
+    merged = {}
+    for name in runs[0]:
+        results = [run[name] for run in runs]
+        fastest = min(results, key=lambda result: result['ns_min'])
+        slowest_min = max(result['ns_min'] for result in results)
+        merged[name] = dict(fastest, runs=len(runs),
+                            spread=max(max(spread(result) for result in results), slowest_min / fastest['ns_min'] - 1))
+    return merged
+
+def compare(results, baseline, threshold):
+    ## (name, baseline ns_min, current ns_min, ratio, allowed ratio) of every benchmark in both, and the names of the regressions
+    rows = []
+    regressions = []
+    for name, result in results.items():
+        if (name not in baseline):
+            continue
+        ratio = result['ns_min'] / baseline[name]['ns_min']
+        # only the baseline sets the tolerance, a noisy run must not widen its own
+        allowed = 1 + max(threshold, spread(baseline[name]))
+        rows.append((name, baseline[name]['ns_min'], result['ns_min'], ratio, allowed))
+        if (ratio > allowed):
+            regressions.append(name)
+    return rows, regressions
+
+def format_comparison(rows, results):
+    lines = ['{:<32} {:>14} {:>14} {:>8} {:>8}'.format('benchmark', 'baseline_min', 'current_min', 'ratio', 'allowed')]
+    for name, baseline_ns, current_ns, ratio, allowed in rows:
+        lines.append('{:<32} {:>14.1f} {:>14.1f} {:>8.2f} {:>8.2f}{}'.format(
+            name, baseline_ns, current_ns, ratio, allowed, ' REGRESSION' if (ratio > allowed) else ''))
+    compared = set(row[0] for row in rows)
+    for name in results:
+        if (name not in compared):
+            lines.append('{:<32} {:>14} {:>14.1f} {:>8}'.format(name, '-', results[name]['ns_min'], 'new'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the ATHENA scheduler hot paths')
+    parser.add_argument('--backends', nargs='+', choices=['numpy', 'tf', 'tf_graph'], dest='backends', default=['numpy', 'tf', 'tf_graph'])
+    parser.add_argument('--only', nargs='+', dest='only', help='run the benchmarks whose name contains any of these')
+    parser.add_argument('--repeats', type=int, dest='repeats', default=7)
+    parser.add_argument('--min_time', type=float, dest='min_time', default=0.05, help='seconds per repeat')
+    parser.add_argument('-o', '--output', dest='output', help='write the results as JSON')
+    parser.add_argument('--save', nargs='?', const=BASELINE_PATH, dest='save', help='store the results as the baseline (benchmarks/baseline.json by default)')
+    parser.add_argument('--baseline_runs', type=int, dest='baseline_runs', default=3, help='runs merged into a saved baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, dest='compare', help='baseline to compare the results with (benchmarks/baseline.json by default)')
+    parser.add_argument('--threshold', type=float, dest='threshold', default=0.2, help='allowed slowdown over the baseline (0.2 = 20%%)')
+    parser.add_argument('--reruns', type=int, dest='reruns', default=2, help='times the benchmarks flagged as slower are measured again')
+    args = parser.parse_args()
+
+    shms = []
+    regressions = []
+    try:
+        benchmarks = get_benchmarks(args.backends, shms)
+        report = {'machine': machine_info(), 'results': run_benchmarks(benchmarks, args.only, args.repeats, args.min_time)}
+        if (args.save is not None and args.baseline_runs > 1):
+            runs = [report['results']]
+            for run in range(1, args.baseline_runs):
+                print('Baseline run {}/{}'.format(run + 1, args.baseline_runs))
+                runs.append(run_in_subprocess(args, args.only))
+            report['results'] = merge_runs(runs)
+        if (args.compare is not None):
+            with open(args.compare, 'r') as file:
+                baseline = json.load(file)
+            if (baseline['machine'] != report['machine']):
+                print('Warning: the baseline was measured on a different machine or library versions: {}'.format(baseline['machine']))
+            rows, regressions = compare(report['results'], baseline['results'], args.threshold)
+            for rerun in range(args.reruns):
+                if (len(regressions) == 0):
+                    break
+                # a single slow measurement is often noise (another process, frequency scaling, the state of this
+                # process), the best one is kept
+                print('Measuring again {} benchmarks flagged as slower ({}/{})'.format(len(regressions), rerun + 1, args.reruns))
+                for name, result in run_in_subprocess(args, regressions).items():
+                    if (name in regressions and result['ns_min'] < report['results'][name]['ns_min']):
+                        report['results'][name] = result
+                rows, regressions = compare(report['results'], baseline['results'], args.threshold)
+            print(format_comparison(rows, report['results']))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    for path in [args.output, args.save]:
+        if (path is not None):
+            with open(path, 'w') as file:
+                json.dump(report, file, indent=2)
+    if (len(regressions) > 0):
+        print('{} regressions: {}'.format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
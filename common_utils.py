@@ -1,5 +1,7 @@
 import numpy as np
+import time
 from multiprocessing import shared_memory
+from namespace import namespaced
 
 MODE_SCHEDULING_SRS = 0
 MODE_SCHEDULING_ATHENA = 1
@@ -34,13 +36,47 @@ def import_tensorflow(debug_level: str, import_tfp = False):
         import tensorflow_probability as tfp
     return tf, os, tfp
 
+def set_tensorflow_threads(tf, intra_op_threads, inter_op_threads, owner):
+    ## sizes the thread pools of TensorFlow, False if its runtime was already initialized with other sizes
+    # (the agents forked from the forkserver template inherit its runtime, sized by agent_preload)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        return True
+    except RuntimeError:
+        print('{} -> Warning: TensorFlow already initialized, keeping {} intra-op and {} inter-op threads instead of {} and {}'.format(
+            owner, tf.config.threading.get_intra_op_parallelism_threads(), tf.config.threading.get_inter_op_parallelism_threads(),
+            intra_op_threads, inter_op_threads))
+        return False
+
+def set_process_affinity(cores):
+    ## pins the calling process to the given cores (None leaves it to the OS)
+    import os
+    if (cores is None or not hasattr(os, 'sched_setaffinity')):
+        return None
+    os.sched_setaffinity(0, set(cores))
+    return os.sched_getaffinity(0)
+
+def parse_cores(cores):
+    ## '2,3' or '4-7' -> [2, 3] or [4, 5, 6, 7]
+    if (cores is None):
+        return None
+    parsed = []
+    for part in str(cores).split(','):
+        if ('-' in part):
+            first, last = part.split('-')
+            parsed += list(range(int(first), int(last) + 1))
+        else:
+            parsed.append(int(part))
+    return parsed
+
 def get_shared_memory_ref(
         size, dtype, share_memory_name):
         total_variables = int( size / dtype.itemsize )
         try:
-            shm = shared_memory.SharedMemory(name=share_memory_name, create=True, size=size)        
+            shm = shared_memory.SharedMemory(name=namespaced(share_memory_name), create=True, size=size)        
         except:
-            shm = shared_memory.SharedMemory(name=share_memory_name, create=False, size=size)        
+            shm = shared_memory.SharedMemory(name=namespaced(share_memory_name), create=False, size=size)        
         shared_weights_array = np.ndarray(
                                 shape = (total_variables, ),
                                 dtype = dtype,
@@ -63,45 +99,146 @@ def map_weights_to_shared_memory_buffer(weights, shared_memory_buf):
 def publish_weights_to_shared_memory(weights, shared_ndarray):
         buffer_idx = 0
         for weight in weights:
-            flattened = weight.flatten().tolist()
-            size = len(flattened)
-            shared_ndarray[buffer_idx: (buffer_idx + size)] = flattened
+            size = weight.size
+            np.copyto(shared_ndarray[buffer_idx: (buffer_idx + size)], weight.reshape(-1), casting='same_kind')
             buffer_idx += size
+
+def untrack_shared_memory(shm):
+        # Before python 3.13 attaching also registers the segment with the resource tracker, which
+        # unlinks it when the process exits. Standalone tools attaching to a running scheduler must opt out.
+        from multiprocessing import resource_tracker
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
  
-tbs_table_path = 'resources/cpp_tbs.json'
-import json
-with open(tbs_table_path) as tbs_json:
-    tbs_table = json.load(tbs_json)
+class StartupTimer():
+    '''
+        Records the duration of the consecutive startup phases of a process
+    '''
+
+    def __init__(self, name) -> None:
+        self.name = name
+        self.phases = []
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        lines = ['{} startup: {:.3f}s'.format(self.name, self.total())]
+        for phase, duration in self.phases:
+            lines.append('    {:<40} {:8.3f}s'.format(phase, duration))
+        print('\n'.join(lines))
+
+def wait_until_ready(processes, timeout = None, timer = None, poll_interval = 0.1):
+    ## waits for the readiness event of every (name, process, event), in the order they come;
+    ## raises as soon as a process exits before setting its event, or when the timeout expires
+    from multiprocessing.connection import wait
+    deadline = None if (timeout is None) else time.monotonic() + timeout
+    pending = list(processes)
+    while (len(pending) > 0):
+        for name, process, ready in [entry for entry in pending if entry[2].is_set()]:
+            pending.remove((name, process, ready))
+            if (timer is not None):
+                timer.lap(name)
+        for name, process, ready in pending:
+            if (process.exitcode is not None and not ready.is_set()):
+                raise Exception('{} exited with code {} before initializing'.format(name, process.exitcode))
+        if (len(pending) == 0):
+            break
+        if (deadline is not None and time.monotonic() > deadline):
+            raise Exception('{} not initialized after {}s'.format(', '.join(name for name, _, _ in pending), timeout))
+        # sleeps until a pending process exits, the events are checked every poll_interval
+        wait([process.sentinel for _, process, _ in pending], timeout=poll_interval)
+
+TBS_TABLE_PATH       = 'resources/cpp_tbs.json'
+TBS_TABLE_CACHE_PATH = 'resources/cpp_tbs.npy'
+
+def load_tbs_table():
+    ## the json table is parsed once and cached in binary form next to it
+    import os
+    if (os.path.exists(TBS_TABLE_CACHE_PATH) and os.path.getmtime(TBS_TABLE_CACHE_PATH) >= os.path.getmtime(TBS_TABLE_PATH)):
+        return np.load(TBS_TABLE_CACHE_PATH)
+    import json
+    with open(TBS_TABLE_PATH) as tbs_json:
+        tbs_rows = json.load(tbs_json)
+    # the rows of the highest i_tbs are shorter, they are padded with 0
+    tbs_table = np.zeros(shape=(len(tbs_rows), max([len(row) for row in tbs_rows])), dtype=np.int32)
+    for i_tbs, row in enumerate(tbs_rows):
+        tbs_table[i_tbs, :len(row)] = row
+    # written aside and renamed, a process started at the same time never loads a partial cache
+    temporary_path = '{}.{}.tmp'.format(TBS_TABLE_CACHE_PATH, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as cache:
+            np.save(cache, tbs_table)
+        os.replace(temporary_path, TBS_TABLE_CACHE_PATH)
+    except OSError:
+        if (os.path.exists(temporary_path)):
+            os.remove(temporary_path)
+    return tbs_table
+
+class ActionSpace():
+    '''
+        Precomputed view of the MCS/PRB action space:
+        - tbs[mcs, prb]: transport block size of every combination (0 for prb = 0)
+        - prohibited[mcs, prb]: combinations listed in PROHIBITED_COMBOS
+        - action_array: allowed (mcs, prb) of MCS_SPACE x PRB_SPACE, sorted by tbs/mcs
+        - action_array_normalized: action_array scaled to [0, 1]
+        - tbs_by_prb[prb]: running maximum of the tbs per mcs, used as the bsr -> minimal mcs index
+    '''
+
+    def __init__(self, tbs_table) -> None:
+        total_mcs = len(I_MCS_TO_I_TBS)
+        total_prb = tbs_table.shape[1] + 1
+        self.tbs = np.zeros(shape=(total_mcs, total_prb), dtype=np.int32)
+        self.tbs[:, 1:] = tbs_table[I_MCS_TO_I_TBS]
+        # running maximum over the mcs: the first mcs whose running maximum reaches a bsr is the
+        # first mcs whose tbs reaches it, and the running maximum can be binary searched
+        self.tbs_by_prb = np.ascontiguousarray(np.maximum.accumulate(self.tbs, axis=0).T)
+
+        # PROHIBITED_COMBOS are expressed as (i_tbs, prb - 1)
+        self.prohibited = np.zeros(shape=(total_mcs, total_prb), dtype=bool)
+        for i_tbs, prb_idx in PROHIBITED_COMBOS:
+            self.prohibited[I_MCS_TO_I_TBS == i_tbs, prb_idx + 1] = True
+
+        mcs_grid, prb_grid = np.meshgrid(MCS_SPACE, PRB_SPACE, indexing='ij')
+        mcs_grid, prb_grid = mcs_grid.ravel(), prb_grid.ravel()
+        allowed = ~self.prohibited[mcs_grid.astype(np.int32), prb_grid.astype(np.int32)]
+        mcs_grid, prb_grid = mcs_grid[allowed], prb_grid[allowed]
+        order = np.lexsort((mcs_grid, self.tbs[mcs_grid.astype(np.int32), prb_grid.astype(np.int32)])) # sort by tbs/mcs
+        self.action_array = np.stack([mcs_grid[order], prb_grid[order]], axis=1)
+
+        action_min = np.array([MCS_SPACE.min(), PRB_SPACE.min()], dtype=np.float32)
+        action_max = np.array([MCS_SPACE.max(), PRB_SPACE.max()], dtype=np.float32)
+        self.action_array_normalized = (self.action_array.astype(np.float32) - action_min) / (action_max - action_min)
+
+    def to_tbs(self, mcs, prb):
+        return int(self.tbs[mcs, prb])
+
+    def is_prohibited(self, mcs, prb):
+        return bool(self.prohibited[mcs, prb])
+
+    def min_mcs_for_bsr(self, bsr, prb, max_mcs):
+        ## lowest mcs up to max_mcs whose tbs covers the bsr (max_mcs + 1 if none does)
+        return int(np.searchsorted(self.tbs_by_prb[prb, :max_mcs + 1], bsr, side='left'))
+
+action_space = None
+
+def get_action_space() -> ActionSpace:
+    global action_space
+    if (action_space is None):
+        action_space = ActionSpace(load_tbs_table())
+    return action_space
 
 def to_tbs(mcs, prb):
-    tbs = 0
-    if (prb > 0):
-        i_tbs = I_MCS_TO_I_TBS[mcs]
-        tbs = tbs_table[i_tbs][prb - 1]
-    return tbs
-
+    return get_action_space().to_tbs(mcs, prb)
 
 def get_action_array():
-    mapping_array = []
-    for mcs in MCS_SPACE:
-        for prb in PRB_SPACE:
-            combo = ( I_MCS_TO_I_TBS[int(mcs)], int(prb) - 1)
-            if combo in PROHIBITED_COMBOS:
-                continue
-            mapping_array.append(
-                {   
-                    'tbs': to_tbs(int(mcs), int(prb)),
-                    'mcs': mcs,
-                    'prb': prb
-                }
-            )
-
-    mapping_array = sorted(mapping_array, key = lambda el: (el['tbs'], el['mcs']))
-    action_array = [np.array([x['mcs'], x['prb']]) for x in mapping_array] # sort by tbs/mcs
-    action_array = np.array(action_array)
-    return action_array
-
-
-
-
-
+    return get_action_space().action_array.copy()
@@ -8,4 +8,37 @@ class Config(object):
         self.actor_path = None
         self.critic_path = None
         self.result_path = None
-        self.verbose     = None
\ No newline at end of file
+        self.verbose     = None
+        self.policy_table = None
+        self.policy_table_path = None
+        self.inference_server = False
+        self.batch_window_us = 200
+        self.tti_deadline_us = 1000
+        self.numpy_inference = False
+        self.numpy_dtype = 'float32'
+        self.quantization = 'none'
+        self.calibration_path = None
+        self.blas_threads = None
+        self.fused_decision = False
+        self.jit_compile = False
+        self.startup = 'fork'
+        self.train = False
+        self.train_batch_size = 64
+        self.train_every = 8
+        self.replay_size = 100000
+        self.publish_every = 100
+        self.learner_cores = None
+        self.learner_threads = 1
+        self.transport = 'queue'
+        self.ring_capacity = 4096
+        self.log_format = 'text'
+        self.coordinator = 'processes'
+        self.latency_stats = None
+        self.decision_budget_us = None
+        self.fallback = None
+        self.max_ues = 1
+        self.ue_timeout_ms = 1000
+        self.total_agents = 8
+        self.cell = None
+        self.placement = None
+        self.startup_timeout_s = 900
@@ -2,38 +2,86 @@ from srsran_env import SrsRanEnv
 import multiprocessing as mp
 from multiprocessing import shared_memory
 import numpy as np
+import time
+from fifo_packets import PacketReader, CONTEXT_PACKET_DTYPE, REWARD_PACKET_DTYPE, VERIFY_PACKET_DTYPE
+from latency_stats import LatencyStats, STAGE_DECISION, STAGE_VERIFY, STAGE_REWARD
+from fallback import FallbackPolicy, conservative_action
+from ue_slots import UeSlots
+from namespace import namespaced, namespaced_path
+from placement import Placement, apply_placement, ROLE_SCHEDULER, ROLE_DECODER
 
 FROM_MAC_CONTEXT = '/tmp/actor_in'
 TO_MAC_ACTION    = '/tmp/actor_out'
 FROM_MAC_VERIFY  = '/tmp/verify_action'
 FROM_PHY_REWARD  = '/tmp/return_in'
 
+# reward packet fields in the order of the result slot, after the flag
+RESULT_FIELDS = ['crc', 'dec_time', 'dec_bits', 'mcs', 'prb', 'snr', 'noise', 'snr_custom']
+
+def group_by_tti(contexts):
+    ## splits the decoded contexts into runs of the same TTI, one context per UE
+    start = 0
+    for idx in range(1, len(contexts) + 1):
+        if (idx == len(contexts) or contexts[idx][0] != contexts[start][0]):
+            yield contexts[start: idx]
+            start = idx
+
 class Coordinator():
     def __init__(self,
-                 observation_locks,  action_locks,  reward_locks, verify_action_locks,
-                 observation_size=6, action_size=3, reward_size=9, verify_action_size=2,
-                 agent_coordination_lock=None, verbose=0):
-        self.total_agents = 8
-        self.cond_observations = observation_locks
-        self.cond_actions      = action_locks
-        self.cond_rewards      = reward_locks
-        self.cond_verify_action = verify_action_locks
+                 observation_notifiers, action_notifiers, reward_notifiers, verify_action_notifiers,
+                 observation_size=7, action_size=4, reward_size=9, verify_action_size=2,
+                 agent_coordination_lock=None, verbose=0,
+                 latency_stats: LatencyStats = None,
+                 decision_budget_us=None, fallback: FallbackPolicy = None,
+                 ue_slots: UeSlots = None, total_agents=8,
+                 placement: Placement = None):
+        self.total_agents = total_agents
+        self.placement = placement
+        # one slot per (UE, HARQ process), the HARQ agent of a process serves all its UE slots
+        self.ue_slots = UeSlots(1, self.total_agents) if (ue_slots is None) else ue_slots
+        self.total_slots = self.ue_slots.total_slots()
+        # a Notifier per HARQ agent wakes up the waiting side as soon as a flag is set
+        self.notify_observations = observation_notifiers
+        self.notify_actions      = action_notifiers
+        self.notify_rewards      = reward_notifiers
+        self.notify_verify_action = verify_action_notifiers
         self.observation_size=observation_size
         self.action_size=action_size
         self.reward_size=reward_size
         self.verify_action_size=verify_action_size
         self.verbose = 0
+        self.latency_stats = latency_stats
+        # without a budget the scheduler interface waits for the agents as long as they take
+        if (decision_budget_us is not None and fallback is None):
+            raise Exception('A decision budget needs a fallback policy')
+        self.decision_budget_ns = None if (decision_budget_us is None) else decision_budget_us * 1000
+        self.fallback = fallback
+        # FIFO paths in the namespace of the cell, shared with the srsENB of the cell
+        self.context_fifo = namespaced_path(FROM_MAC_CONTEXT)
+        self.action_fifo  = namespaced_path(TO_MAC_ACTION)
+        self.verify_fifo  = namespaced_path(FROM_MAC_VERIFY)
+        self.reward_fifo  = namespaced_path(FROM_PHY_REWARD)
 
         self.sched_proc = mp.Process(target=self.func_scheduler, name= 'scheduler_intf')        
         self.decod_proc = mp.Process(target=self.func_decoder, name='decoder_intf')
         
         self.agent_coordination_lock = agent_coordination_lock
 
+        self.ue_slots.attach().reset()
         self.get_observation_memory()
+        self.get_context_batch_memory()
         self.get_action_memory()
         self.get_verify_action_memory()
         self.get_reward_memory()
 
+    def __getstate__(self):
+        # the interface processes are pickled along with their target under the forkserver/spawn
+        # start methods, they must not carry the (started) process objects with them
+        state = self.__dict__.copy()
+        state['sched_proc'] = None
+        state['decod_proc'] = None
+        return state
+
     def kill(self):
         print('Killing Coordinator')        
         if (self.decod_proc.is_alive()):
@@ -47,143 +95,230 @@ class Coordinator():
         self.sched_proc.start()
         self.decod_proc.start()
 
+    def attach_latency_stats(self):
+        if (self.latency_stats is not None):
+            self.latency_stats.attach()
+        return self.latency_stats
+
+    def attach_fallback(self):
+        if (self.fallback is not None):
+            self.fallback.attach()
+        return self.fallback
+
+    def publish_contexts(self, observation_matrix, context_batch, contexts, now):
+        ## publishes the contexts of one TTI in the slots of their UEs, returns the slots (-1 for UEs without a slot)
+        agent_idx = contexts[0][0] % self.total_agents
+        slots = []
+        for tti, rnti, bsr, snr, beta, gain in contexts:
+            ue = self.ue_slots.assign(rnti, now)
+            if (ue < 0):
+                slots.append(-1)
+                continue
+            slot = ue * self.total_agents + agent_idx
+            if (self.verbose == 1):
+                print('Obs {} - {}'.format(slot, [1, tti, beta, snr, bsr, gain, rnti]))
+            observation_matrix[slot, 1:] = (tti, beta, snr, bsr, gain, rnti)
+            observation_matrix[slot, 0] = 1
+            slots.append(slot)
+        total_published = len(slots) - slots.count(-1)
+        if (total_published > 0):
+            # the agent takes all the flagged slots at once, when the size of the batch is set
+            context_batch[agent_idx] = total_published
+            self.notify_observations[agent_idx].notify()
+        return slots
+
+    def take_action(self, action_matrix, slot, tti):
+        ## the answer of the agent to the context of tti, None while there is none
+        if (action_matrix[slot, 0] == 0):
+            return None
+        action_matrix[slot, 0] = 0
+        mcs, prb, action_tti = action_matrix[slot, 1:4].tolist()
+        if (action_tti != tti):
+            # the answer to a context already served with a fallback action
+            if (self.fallback is not None):
+                self.fallback.discard_late(slot)
+            return None
+        if (self.fallback is not None):
+            self.fallback.accept(slot, mcs, prb)
+        return mcs, prb
+
+    def wait_action(self, action_matrix, slot, tti, beta, snr, context_published):
+        if (slot < 0):
+            # more UEs than slots, the coordinator answers by itself
+            return self.unserved_action
+        notify_action = self.notify_actions[slot % self.total_agents]
+        while (True):
+            action = self.take_action(action_matrix, slot, tti)
+            if (action is not None):
+                return action
+            if (self.decision_budget_ns is None):
+                notify_action.wait()
+                continue
+            remaining = context_published + self.decision_budget_ns - time.monotonic_ns()
+            if (remaining <= 0):
+                return self.fallback.decide(slot, beta, snr)
+            notify_action.wait(remaining / 1e9)
+
+    def publish_verify(self, verify_action_matrix, slot, action_verified):
+        if (slot < 0):
+            return
+        verify_action_matrix[slot, 1] = action_verified
+        verify_action_matrix[slot, 0] = 1
+        self.notify_verify_action[slot % self.total_agents].notify()
+
     def wait_agents_to_finish_init(self):
         if (self.agent_coordination_lock is not None):
-            while (self.agent_coordination_lock.value == 0):
-                pass
+            # set by the AgentFactory once every agent is initialized
+            self.agent_coordination_lock.wait()
     
-    def func_decoder(self, reward_packet_size=32):
-        shm_reward = shared_memory.SharedMemory(create = False,  name = 'result')
-        reward_nd_array = np.ndarray(shape=(self.reward_size * self.total_agents), dtype= np.int32, buffer = shm_reward.buf)
+    def func_decoder(self, max_packets=64):
+        apply_placement(self.placement, ROLE_DECODER)
+        shm_reward = shared_memory.SharedMemory(create = False,  name = namespaced('result'))
+        reward_nd_array = np.ndarray(shape=(self.reward_size * self.total_slots), dtype= np.int32, buffer = shm_reward.buf)
+        reward_matrix = reward_nd_array.reshape(self.total_slots, self.reward_size)
+        results = np.zeros(shape=(max_packets, len(RESULT_FIELDS)), dtype=np.int32)
+        self.attach_latency_stats()
+        self.ue_slots.attach()
         self.wait_agents_to_finish_init()    
         print('Receive result thread waiting for all processes to start...OK')
         is_file_open = False
         while (not is_file_open):
             try:
-                with open(FROM_PHY_REWARD, mode='rb') as file_read:
+                with open(self.reward_fifo, mode='rb', buffering=0) as file_read:
                     is_file_open = True
                     print('Opening receive reward socket...')
+                    reader = PacketReader(file_read, REWARD_PACKET_DTYPE, max_packets)
                     while (True):
-                        content = file_read.read(reward_packet_size)
-                        if (len(content) <= 0):
+                        # every reward packet available is decoded and scattered at once
+                        packets = reader.read()
+                        if (packets is None):
                             print('EOF')
                             break
-                        tti      = int.from_bytes(  content[0:2], "little")
-                        rnti     = int.from_bytes(  content[2:4], "little")
-                        dec_time = int.from_bytes(  content[4:8],   "little")
-                        crc      = int.from_bytes(  content[8:9],   "little")
-                        dec_bits = int.from_bytes(  content[12:16], "little")
-                        mcs      = int.from_bytes(  content[16:18], "little")
-                        prb      = int.from_bytes(  content[18:20], "little")
-                        snr      = int.from_bytes(  content[20:24], "little")
-                        noise    = int.from_bytes(  content[24:28], "little")
-                        snr_custom = int.from_bytes(content[28:32], "little")
-
-                        result_buffer = np.array([tti, crc, dec_time, dec_bits, mcs, prb, snr, noise, snr_custom], dtype = np.int32)
-                        agent_idx = tti % self.total_agents
-                        if (self.verbose == 1):
-                            print('Res {} - {}'.format(agent_idx, result_buffer))
-                        cond_reward = self.cond_rewards[agent_idx]
-                        result_buffer[0] = 1
-                        with cond_reward:
-                            reward_nd_array[agent_idx * self.reward_size: (agent_idx + 1) * self.reward_size] = result_buffer
-                            cond_reward.notify()
+                        self.publish_rewards(reward_matrix, packets, results)
             except FileNotFoundError as e:
-                pass               
+                time.sleep(0.1)
+
 
+    def publish_rewards(self, reward_matrix, packets, results):
+        ## scatters a burst of reward packets into the result slots of the agents, flags last
+        ues = self.ue_slots.lookup(packets['rnti'])
+        if (not (ues >= 0).all()):
+            # rewards of UEs that never had a slot, their action came from the coordinator
+            packets, ues = packets[ues >= 0], ues[ues >= 0]
+        total_packets = len(packets)
+        for column, field in enumerate(RESULT_FIELDS):
+            results[:total_packets, column] = packets[field]
+        agent_idx = packets['tti'] % self.total_agents
+        slots = ues * self.total_agents + agent_idx
+        reward_matrix[slots, 1:] = results[:total_packets]
+        if (self.verbose == 1):
+            for idx in range(total_packets):
+                print('Res {} - {}'.format(slots[idx], results[idx]))
+        reward_matrix[slots, 0] = 1
+        for idx in np.unique(agent_idx):
+            self.notify_rewards[idx].notify()
+            if (self.latency_stats is not None):
+                self.latency_stats.record_since_context(STAGE_REWARD, idx)
 
-    def func_scheduler(self, context_packet_size=16, verify_packet_size=4):
-        shm_observation = shared_memory.SharedMemory(create = False,  name = 'observation')
-        shm_action = shared_memory.SharedMemory(create = False,  name = 'action')        
-        shm_verify_action = shared_memory.SharedMemory(create = False, name = 'verify_action')
-        observation_nd_array = np.ndarray(shape=(self.observation_size * self.total_agents), dtype= np.int32, buffer = shm_observation.buf)        
-        action_nd_array = np.ndarray(shape=(self.action_size * self.total_agents), dtype= np.int32, buffer = shm_action.buf)
-        verify_action_nd_array = np.ndarray(shape=(self.verify_action_size * self.total_agents), dtype= np.int32, buffer = shm_verify_action.buf)
+    def func_scheduler(self, max_packets=64):
+        apply_placement(self.placement, ROLE_SCHEDULER)
+        shm_observation = shared_memory.SharedMemory(create = False,  name = namespaced('observation'))
+        shm_action = shared_memory.SharedMemory(create = False,  name = namespaced('action'))        
+        shm_verify_action = shared_memory.SharedMemory(create = False, name = namespaced('verify_action'))
+        shm_context_batch = shared_memory.SharedMemory(create = False, name = namespaced('context_batch'))
+        observation_nd_array = np.ndarray(shape=(self.observation_size * self.total_slots), dtype= np.int32, buffer = shm_observation.buf)        
+        action_nd_array = np.ndarray(shape=(self.action_size * self.total_slots), dtype= np.int32, buffer = shm_action.buf)
+        verify_action_nd_array = np.ndarray(shape=(self.verify_action_size * self.total_slots), dtype= np.int32, buffer = shm_verify_action.buf)
+        context_batch = np.ndarray(shape=(self.total_agents), dtype= np.int32, buffer = shm_context_batch.buf)
+        observation_matrix = observation_nd_array.reshape(self.total_slots, self.observation_size)
+        action_matrix = action_nd_array.reshape(self.total_slots, self.action_size)
+        verify_action_matrix = verify_action_nd_array.reshape(self.total_slots, self.verify_action_size)
+        latency_stats = self.attach_latency_stats()
+        self.attach_fallback()
+        self.ue_slots.attach()
+        self.unserved_action = conservative_action()
         
         self.wait_agents_to_finish_init()
         print('Receive obs thread waiting for all processes to start... OK')
         is_actor_in_open = False
         while (not is_actor_in_open):
             try:                
-                with open(FROM_MAC_CONTEXT, mode='rb') as file_read:
+                with open(self.context_fifo, mode='rb', buffering=0) as file_read:
                     is_actor_in_open = True
                     is_verify_action_open = False
                     while (not is_verify_action_open):
                         try:
-                            with open(FROM_MAC_VERIFY, mode = 'rb') as verify_action_fd:
+                            with open(self.verify_fifo, mode = 'rb', buffering=0) as verify_action_fd:
                                 is_verify_action_open = True
-                                with open(TO_MAC_ACTION,  mode='wb') as file_write:
+                                with open(self.action_fifo,  mode='wb') as file_write:
                                     print('Opening receive context socket...')
-                                    while (True):
-                                        content = file_read.read(context_packet_size)
-                                        if (len(content) <= 0):
-                                            print('EOF')
-                                            break
-                                        tti  = int.from_bytes(content[0:2], "little")
-                                        rnti = int.from_bytes(content[2:4], "little")
-                                        bsr =  int.from_bytes(content[4:8], "little")
-                                        snr =  int.from_bytes(content[8:12], "little", signed = True)
-                                        beta = int.from_bytes(content[12:14], "little")
-                                        gain = int.from_bytes(content[14:], "little")
-                                        
-                                        agent_idx = tti % self.total_agents
-                                        observation = np.array([1, tti, beta, snr, bsr, gain], dtype = np.int32)
-                                        if (self.verbose == 1):
-                                            print('Obs {} - {}'.format(agent_idx, observation))
-                                        cond_observation   = self.cond_observations[agent_idx]
-                                        cond_action        = self.cond_actions[agent_idx]
-
-                                        with cond_observation:
-                                            observation_nd_array[agent_idx * self.observation_size: (agent_idx + 1) * self.observation_size] = observation
-                                            cond_observation.notify()
-
-                                        with cond_action:
-                                            while action_nd_array[agent_idx * self.action_size]  == 0:
-                                                cond_action.wait(0.001)
-
-                                        action_nd_array[agent_idx * self.action_size ] = 0
-                                        mcs, prb = action_nd_array[agent_idx * self.action_size + 1].item(), action_nd_array[agent_idx * self.action_size + 2].item()
-                                        if (self.verbose == 1):
-                                            print('Act {} - {}'.format(agent_idx, [tti, mcs, prb]))
-
-                                        action_mcs = mcs.to_bytes(1, byteorder="little")
-                                        action_prb = prb.to_bytes(1, byteorder="little")
-                                        ext_byte_arr = action_mcs +  action_prb
-                                        file_write.write(ext_byte_arr)
-                                        file_write.flush()
-
-                                        cond_verify_action = self.cond_verify_action[agent_idx]
-                                        verify_action_content = verify_action_fd.read(verify_packet_size)
-                                        if (len(verify_action_content) < 0):
+                                    context_reader = PacketReader(file_read, CONTEXT_PACKET_DTYPE, max_packets)
+                                    # one verify word per action, never read ahead
+                                    verify_reader  = PacketReader(verify_action_fd, VERIFY_PACKET_DTYPE, 1)
+                                    is_eof = False
+                                    while (not is_eof):
+                                        packets = context_reader.read()
+                                        if (packets is None):
                                             print('EOF')
                                             break
-                                        action_verified = int.from_bytes(verify_action_content[0: 4], "little")
-                                        with cond_verify_action:
-                                            verify_action_nd_array[agent_idx * self.verify_action_size: (agent_idx + 1) * self.verify_action_size] = np.array([1, action_verified], dtype = np.int32)
-                                            cond_verify_action.notify()
+                                        # the contexts of the UEs of a TTI are published together, the agent decides them in one batch;
+                                        # the MAC waits for the action of every context, so they are answered in order
+                                        for contexts in group_by_tti(packets.tolist()):
+                                            agent_idx = contexts[0][0] % self.total_agents
+                                            context_published = time.monotonic_ns()
+                                            slots = self.publish_contexts(observation_matrix, context_batch, contexts, context_published)
+                                            if (latency_stats is not None):
+                                                latency_stats.context_published(agent_idx, context_published)
+
+                                            for (tti, rnti, bsr, snr, beta, gain), slot in zip(contexts, slots):
+                                                # bounded by the decision budget, if any, the MAC gets a fallback action otherwise
+                                                mcs, prb = self.wait_action(action_matrix, slot, tti, beta, snr, context_published)
+                                                if (self.verbose == 1):
+                                                    print('Act {} - {}'.format(slot, [tti, mcs, prb, rnti]))
+
+                                                file_write.write(bytes((mcs, prb)))
+                                                file_write.flush()
+                                                if (latency_stats is not None):
+                                                    action_written = latency_stats.record_since(STAGE_DECISION, agent_idx, context_published)
+
+                                                verify_packets = verify_reader.read()
+                                                if (verify_packets is None):
+                                                    print('EOF')
+                                                    is_eof = True
+                                                    break
+                                                self.publish_verify(verify_action_matrix, slot, int(verify_packets['verified'][0]))
+                                                if (latency_stats is not None):
+                                                    latency_stats.record_since(STAGE_VERIFY, agent_idx, action_written)
+                                            if (is_eof):
+                                                break
                         except FileNotFoundError as e:
                             if (is_actor_in_open and is_verify_action_open):
                                 raise e
-                            pass
+                            time.sleep(0.1)
             except FileNotFoundError as e:
                 if (is_actor_in_open):
                     raise e
-                pass
+                time.sleep(0.1)
 
-    def get_memory_buffer(self, buffer_size_per_agent, buffer_name):
+    def get_memory_buffer(self, buffer_size_per_slot, buffer_name, total_slots = None):
         int_size = 4
-        size = buffer_size_per_agent * int_size * self.total_agents
+        total_slots = self.total_slots if (total_slots is None) else total_slots
+        size = buffer_size_per_slot * int_size * total_slots
         try:
-            shm = shared_memory.SharedMemory(create = True,  name=buffer_name, size=size)
+            shm = shared_memory.SharedMemory(create = True,  name=namespaced(buffer_name), size=size)
         except Exception:
-            shm = shared_memory.SharedMemory(create = False, name=buffer_name, size=size)
-        nd_array = np.ndarray(shape=(buffer_size_per_agent * self.total_agents), dtype=np.int32, buffer=shm.buf)
-        nd_array[:] = np.full(shape=(buffer_size_per_agent * self.total_agents), fill_value=0)
+            shm = shared_memory.SharedMemory(create = False, name=namespaced(buffer_name), size=size)
+        nd_array = np.ndarray(shape=(buffer_size_per_slot * total_slots), dtype=np.int32, buffer=shm.buf)
+        nd_array[:] = np.full(shape=(buffer_size_per_slot * total_slots), fill_value=0)
         return nd_array
 
     def get_observation_memory(self):
         return self.get_memory_buffer(self.observation_size, 'observation')
 
+    def get_context_batch_memory(self):
+        # per HARQ agent, the number of contexts published in its slots
+        return self.get_memory_buffer(1, 'context_batch', self.total_agents)
+
     def get_action_memory(self):
         return self.get_memory_buffer(self.action_size, 'action')
 
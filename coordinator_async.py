@@ -0,0 +1,218 @@
+import asyncio
+import errno
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+import numpy as np
+import time
+
+from coordinator import Coordinator, RESULT_FIELDS, group_by_tti
+from fallback import conservative_action
+from namespace import namespaced
+from placement import apply_placement, ROLE_COORDINATOR
+from fifo_packets import PacketReader, CONTEXT_PACKET_DTYPE, REWARD_PACKET_DTYPE, VERIFY_PACKET_DTYPE
+from latency_stats import STAGE_DECISION, STAGE_VERIFY
+
+async def wait_readable(loop, fd):
+    future = loop.create_future()
+    loop.add_reader(fd, future.set_result, None)
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+
+async def wait_writable(loop, fd):
+    future = loop.create_future()
+    loop.add_writer(fd, future.set_result, None)
+    try:
+        await future
+    finally:
+        loop.remove_writer(fd)
+
+class FifoStream():
+    '''
+        Non-blocking packet stream over a FIFO written by srsENB. It waits for the FIFO to be
+        created, and on EOF (srsENB closed its end) it reopens the FIFO and waits for the next writer,
+        instead of spinning on a closed pipe.
+    '''
+
+    def __init__(self, path, packet_dtype, max_packets = 64) -> None:
+        self.path = path
+        self.packet_dtype = packet_dtype
+        self.max_packets = max_packets
+        self.file = None
+
+    async def open(self):
+        while (self.file is None):
+            try:
+                fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            except FileNotFoundError:
+                await asyncio.sleep(0.1)
+                continue
+            self.file = open(fd, mode='rb', buffering=0)
+            self.reader = PacketReader(self.file, self.packet_dtype, self.max_packets)
+            # a read before any writer has connected returns EOF, wait for the FIFO to become readable first
+            self.connected = False
+
+    def close(self):
+        if (self.file is not None):
+            self.file.close()
+            self.file = None
+
+    async def read(self):
+        ## the complete packets available, waiting for at least one
+        loop = asyncio.get_running_loop()
+        while (True):
+            await self.open()
+            if (self.connected):
+                packets = self.reader.read()
+                if (packets is None):
+                    print('EOF ' + self.path)
+                    self.close()
+                    continue
+                if (len(packets) > 0):
+                    return packets
+            await wait_readable(loop, self.file.fileno())
+            self.connected = True
+
+class AsyncCoordinator(Coordinator):
+    '''
+        Coordinator running the scheduler and decoder interfaces as tasks of one asyncio event loop
+        in a single process: the context, verify and reward FIFOs and the action notifiers of the
+        agents are all multiplexed on the loop, instead of two processes blocking on their FIFOs.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncCoordinator, self).__init__(*args, **kwargs)
+        self.sched_proc = None
+        self.decod_proc = None
+        self.event_proc = mp.Process(target=self.func_event_loop, name='coordinator_intf')
+
+    def __getstate__(self):
+        state = super(AsyncCoordinator, self).__getstate__()
+        state['event_proc'] = None
+        return state
+
+    def start(self):
+        self.event_proc.start()
+
+    def kill(self):
+        print('Killing Coordinator')
+        if (self.event_proc.is_alive()):
+            self.event_proc.kill()
+            self.event_proc.join()
+
+    def func_event_loop(self):
+        apply_placement(self.placement, ROLE_COORDINATOR)
+        asyncio.run(self.serve())
+
+    def attach_memory(self):
+        self.shms = {}
+        matrices = {}
+        for name, size in [('observation', self.observation_size), ('action', self.action_size),
+                           ('verify_action', self.verify_action_size), ('result', self.reward_size)]:
+            self.shms[name] = shared_memory.SharedMemory(create = False, name = namespaced(name))
+            matrices[name] = np.ndarray(shape=(self.total_slots, size), dtype=np.int32, buffer=self.shms[name].buf)
+        self.shms['context_batch'] = shared_memory.SharedMemory(create = False, name = namespaced('context_batch'))
+        matrices['context_batch'] = np.ndarray(shape=(self.total_agents, ), dtype=np.int32, buffer=self.shms['context_batch'].buf)
+        return matrices
+
+    async def serve(self):
+        matrices = self.attach_memory()
+        self.attach_latency_stats()
+        self.attach_fallback()
+        self.ue_slots.attach()
+        self.unserved_action = conservative_action()
+        # the agents are waited for off the loop, nothing else can run before they are up anyway
+        await asyncio.get_running_loop().run_in_executor(None, self.wait_agents_to_finish_init)
+        print('Coordinator waiting for all processes to start... OK')
+        await asyncio.gather(
+            self.serve_contexts(matrices['observation'], matrices['context_batch'], matrices['action'], matrices['verify_action']),
+            self.serve_rewards(matrices['result']))
+
+    async def serve_rewards(self, reward_matrix, max_packets = 64):
+        results = np.zeros(shape=(max_packets, len(RESULT_FIELDS)), dtype=np.int32)
+        rewards = FifoStream(self.reward_fifo, REWARD_PACKET_DTYPE, max_packets)
+        while (True):
+            self.publish_rewards(reward_matrix, await rewards.read(), results)
+
+    async def open_action_fifo(self):
+        # opening the write end without a reader fails with ENXIO, srsENB opens its read end at startup
+        while (True):
+            try:
+                return os.open(self.action_fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if (e.errno not in (errno.ENXIO, errno.ENOENT)):
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def write_action(self, action_fd, mcs, prb):
+        ## writes the action and returns the action fd, reopened if srsENB restarted
+        loop = asyncio.get_running_loop()
+        while (True):
+            try:
+                # 2 bytes, below PIPE_BUF: written whole or not at all
+                os.write(action_fd, bytes((mcs, prb)))
+                return action_fd
+            except BlockingIOError:
+                # srsENB is not reading, the loop keeps serving the rewards meanwhile
+                await wait_writable(loop, action_fd)
+            except BrokenPipeError:
+                # srsENB restarted, the action goes to its new read end
+                print('EOF ' + self.action_fifo)
+                os.close(action_fd)
+                action_fd = await self.open_action_fifo()
+
+    async def wait_action(self, action_matrix, slot, tti, beta, snr, context_published):
+        if (slot < 0):
+            # more UEs than slots, the coordinator answers by itself
+            return self.unserved_action
+        loop = asyncio.get_running_loop()
+        notify_action = self.notify_actions[slot % self.total_agents]
+        while (True):
+            action = self.take_action(action_matrix, slot, tti)
+            if (action is not None):
+                return action
+            if (self.decision_budget_ns is None):
+                await wait_readable(loop, notify_action.fileno())
+            else:
+                remaining = context_published + self.decision_budget_ns - time.monotonic_ns()
+                if (remaining <= 0):
+                    return self.fallback.decide(slot, beta, snr)
+                try:
+                    await asyncio.wait_for(wait_readable(loop, notify_action.fileno()), remaining / 1e9)
+                except asyncio.TimeoutError:
+                    continue
+            notify_action.clear()
+
+    async def serve_contexts(self, observation_matrix, context_batch, action_matrix, verify_action_matrix, max_packets = 64):
+        contexts = FifoStream(self.context_fifo, CONTEXT_PACKET_DTYPE, max_packets)
+        # one verify word per action, never read ahead
+        verifications = FifoStream(self.verify_fifo, VERIFY_PACKET_DTYPE, 1)
+        await contexts.open()
+        await verifications.open()
+        action_fd = await self.open_action_fifo()
+        print('Opening receive context socket...')
+        latency_stats = self.latency_stats
+        while (True):
+            packets = await contexts.read()
+            # the contexts of the UEs of a TTI are published together, the agent decides them in one batch
+            for tti_contexts in group_by_tti(packets.tolist()):
+                agent_idx = tti_contexts[0][0] % self.total_agents
+                context_published = time.monotonic_ns()
+                slots = self.publish_contexts(observation_matrix, context_batch, tti_contexts, context_published)
+                if (latency_stats is not None):
+                    latency_stats.context_published(agent_idx, context_published)
+
+                for (tti, rnti, bsr, snr, beta, gain), slot in zip(tti_contexts, slots):
+                    mcs, prb = await self.wait_action(action_matrix, slot, tti, beta, snr, context_published)
+                    if (self.verbose == 1):
+                        print('Act {} - {}'.format(slot, [tti, mcs, prb, rnti]))
+                    action_fd = await self.write_action(action_fd, mcs, prb)
+                    if (latency_stats is not None):
+                        action_written = latency_stats.record_since(STAGE_DECISION, agent_idx, context_published)
+
+                    action_verified = int((await verifications.read())['verified'][0])
+                    self.publish_verify(verify_action_matrix, slot, action_verified)
+                    if (latency_stats is not None):
+                        latency_stats.record_since(STAGE_VERIFY, agent_idx, action_written)
@@ -0,0 +1,236 @@
+'''
+    Builds a memory-mapped training dataset out of the results files of the random scheduling mode
+    (pipe-delimited text or the binary --log_format npy files). The files are streamed chunk_size rows
+    at a time, so the memory use does not depend on their size.
+    Every row becomes the (context, action, reward) tuple of SrsRanEnv.get_reward:
+
+        <output>/contexts.npy      (rows, 2) float32   cpu, snr
+        <output>/actions.npy       (rows, 2) int32     mcs, prb
+        <output>/rewards.npy       (rows, )  float32
+        <output>/tbs.npy           (rows, )  int32     0 for the prohibited actions
+        <output>/context_bins.npy  (rows, )  int32     cpu_bin * total_snr_bins + snr_bin
+        <output>/bin_order.npy     (rows, )  int64     row indexes grouped by context bin
+        <output>/bin_offsets.npy   (bins + 1, ) int64  rows of bin b: bin_order[bin_offsets[b]: bin_offsets[b + 1]]
+        <output>/dataset.json      rows, sources, penalty, decode_deadline and the context bin grid
+'''
+import os
+import json
+import itertools
+import numpy as np
+from numpy.lib.format import open_memmap
+from results_format import MAGIC, load_header, iter_chunks
+from srsran_env import SrsRanEnv
+
+DATASET_COLUMNS = ['cpu', 'snr', 'mcs', 'prb', 'crc', 'decoding_time']
+# the inference results files name the decoding time dec_time
+COLUMN_ALIASES = {'dec_time': 'decoding_time'}
+
+def is_binary(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def count_rows(path, block_size = 1 << 20):
+    ## upper bound of the samples of a results file: its lines (minus the header) or its chunk lengths
+    if (is_binary(path)):
+        name = load_header(path)['columns'][0][0]
+        return sum(len(chunk[name]) for chunk in iter_chunks(path))
+    total_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as file:
+        while (True):
+            block = file.read(block_size)
+            if (len(block) == 0):
+                break
+            total_lines += block.count(b'\n')
+            last = block[-1:]
+    if (last != b'\n'):
+        total_lines += 1
+    return max(total_lines - 1, 0)
+
+def parse_lines(lines, usecols):
+    ## float64 (rows, columns) of the text lines, dropping the malformed ones (e.g. the last line of an interrupted run)
+    try:
+        return np.loadtxt(lines, delimiter='|', usecols=usecols, ndmin=2)
+    except ValueError:
+        rows = []
+        for line in lines:
+            try:
+                rows.append(np.loadtxt([line], delimiter='|', usecols=usecols, ndmin=2))
+            except ValueError:
+                pass
+        print('Skipped {} malformed lines'.format(len(lines) - len(rows)))
+        if (len(rows) == 0):
+            return np.zeros(shape=(0, len(usecols)))
+        return np.concatenate(rows)
+
+def iter_text_chunks(path, chunk_size):
+    with open(path, 'r') as file:
+        names = [COLUMN_ALIASES.get(name, name) for name in file.readline().strip().split('|')]
+        missing = [name for name in DATASET_COLUMNS if name not in names]
+        if (len(missing) > 0):
+            raise Exception('{} has no {} columns'.format(path, ', '.join(missing)))
+        usecols = [names.index(name) for name in DATASET_COLUMNS]
+        while (True):
+            lines = [line for line in itertools.islice(file, chunk_size) if line.strip()]
+            if (len(lines) == 0):
+                break
+            values = parse_lines(lines, usecols)
+            yield {name: values[:, idx] for idx, name in enumerate(DATASET_COLUMNS)}
+
+def iter_binary_chunks(path, chunk_size):
+    for chunk in iter_chunks(path):
+        chunk = {COLUMN_ALIASES.get(name, name): values for name, values in chunk.items()}
+        missing = [name for name in DATASET_COLUMNS if name not in chunk]
+        if (len(missing) > 0):
+            raise Exception('{} has no {} columns'.format(path, ', '.join(missing)))
+        for start in range(0, len(chunk['cpu']), chunk_size):
+            yield {name: chunk[name][start: start + chunk_size] for name in DATASET_COLUMNS}
+
+def iter_samples(path, chunk_size = 100000):
+    ## yields {column: array} chunks of at most chunk_size rows
+    if (is_binary(path)):
+        return iter_binary_chunks(path, chunk_size)
+    return iter_text_chunks(path, chunk_size)
+
+class ContextBins():
+    '''
+        Grid of (cpu, snr) context bins, cpu_step x snr_step wide, over the context range of the DDPGAgent.
+        Contexts outside the range are clipped into the first or the last bin.
+    '''
+
+    def __init__(self, cpu_step = 100, snr_step = 1, context_min = (0, 18), context_max = (1000, 49)) -> None:
+        self.grid_min  = np.array(context_min, dtype=np.float32)
+        self.grid_max  = np.array(context_max, dtype=np.float32)
+        self.grid_step = np.array([cpu_step, snr_step], dtype=np.float32)
+        self.grid_size = np.ceil((self.grid_max - self.grid_min) / self.grid_step).astype(np.int32)
+
+    def total_bins(self):
+        return int(self.grid_size[0] * self.grid_size[1])
+
+    def bin_of(self, contexts):
+        ## context bin of every row of a (rows, 2) array of contexts
+        idx = np.floor((np.asarray(contexts, dtype=np.float32) - self.grid_min) / self.grid_step).astype(np.int32)
+        idx = np.clip(idx, 0, self.grid_size - 1)
+        return idx[:, 0] * self.grid_size[1] + idx[:, 1]
+
+    def to_json(self):
+        return {'grid_min': self.grid_min.tolist(), 'grid_max': self.grid_max.tolist(), 'grid_step': self.grid_step.tolist()}
+
+    @staticmethod
+    def from_json(grid):
+        return ContextBins(grid['grid_step'][0], grid['grid_step'][1], grid['grid_min'], grid['grid_max'])
+
+def build_bin_index(context_bins, total_bins, bin_order, chunk_size):
+    ## counting sort of the rows by context bin, chunk by chunk; returns the bin offsets
+    counts = np.zeros(shape=(total_bins, ), dtype=np.int64)
+    for start in range(0, len(context_bins), chunk_size):
+        counts += np.bincount(context_bins[start: start + chunk_size], minlength=total_bins)
+    bin_offsets = np.concatenate([[0], np.cumsum(counts)])
+    cursor = bin_offsets[:-1].copy()
+    for start in range(0, len(context_bins), chunk_size):
+        bins = np.asarray(context_bins[start: start + chunk_size])
+        order = np.argsort(bins, kind='stable')
+        sorted_bins = bins[order]
+        chunk_counts = np.bincount(bins, minlength=total_bins)
+        first = np.concatenate([[0], np.cumsum(chunk_counts)])[:-1]
+        positions = cursor[sorted_bins] + np.arange(len(bins)) - first[sorted_bins]
+        bin_order[positions] = start + order
+        cursor += chunk_counts
+    return bin_offsets
+
+def build_dataset(paths, output_path, environment = None, context_bins = None, chunk_size = 100000):
+    ## streams the results files into the memory-mapped dataset at output_path, returns its metadata
+    environment = SrsRanEnv() if (environment is None) else environment
+    context_bins = ContextBins() if (context_bins is None) else context_bins
+    os.makedirs(output_path, exist_ok=True)
+
+    max_rows = sum(count_rows(path) for path in paths)
+    print('Building dataset of up to {} samples from {} files...'.format(max_rows, len(paths)))
+    contexts = open_memmap(os.path.join(output_path, 'contexts.npy'), mode='w+', dtype=np.float32, shape=(max_rows, 2))
+    actions  = open_memmap(os.path.join(output_path, 'actions.npy'), mode='w+', dtype=np.int32, shape=(max_rows, 2))
+    rewards  = open_memmap(os.path.join(output_path, 'rewards.npy'), mode='w+', dtype=np.float32, shape=(max_rows, ))
+    tbs      = open_memmap(os.path.join(output_path, 'tbs.npy'), mode='w+', dtype=np.int32, shape=(max_rows, ))
+    bins     = open_memmap(os.path.join(output_path, 'context_bins.npy'), mode='w+', dtype=np.int32, shape=(max_rows, ))
+
+    rows = 0
+    for path in paths:
+        for chunk in iter_samples(path, chunk_size):
+            total = len(chunk['cpu'])
+            end = rows + total
+            contexts[rows: end, 0] = chunk['cpu']
+            contexts[rows: end, 1] = chunk['snr']
+            actions[rows: end, 0] = chunk['mcs']
+            actions[rows: end, 1] = chunk['prb']
+            rewards[rows: end], tbs[rows: end] = environment.get_rewards(chunk['mcs'], chunk['prb'], chunk['crc'], chunk['decoding_time'])
+            bins[rows: end] = context_bins.bin_of(contexts[rows: end])
+            rows = end
+        print('{}: {} samples'.format(path, rows))
+    for array in [contexts, actions, rewards, tbs, bins]:
+        array.flush()
+
+    # the arrays are sized by the line count, only the first rows samples are valid
+    bin_order = open_memmap(os.path.join(output_path, 'bin_order.npy'), mode='w+', dtype=np.int64, shape=(rows, ))
+    bin_offsets = build_bin_index(bins[:rows], context_bins.total_bins(), bin_order, chunk_size)
+    bin_order.flush()
+    np.save(os.path.join(output_path, 'bin_offsets.npy'), bin_offsets)
+
+    metadata = {
+        'rows': rows,
+        'sources': [os.path.abspath(path) for path in paths],
+        'penalty': environment.penalty,
+        'decode_deadline': environment.decode_deadline,
+        'context_bins': context_bins.to_json()
+    }
+    with open(os.path.join(output_path, 'dataset.json'), 'w') as file:
+        json.dump(metadata, file, indent=2)
+    print('Dataset of {} samples in {} context bins written to {}'.format(rows, int(np.count_nonzero(np.diff(bin_offsets))), output_path))
+    return metadata
+
+class ResultsDataset():
+    '''
+        Read-only view of a dataset written by build_dataset. The arrays are memory-mapped,
+        so opening is instant and the pages are only read when a training job touches them.
+    '''
+
+    def __init__(self, path) -> None:
+        with open(os.path.join(path, 'dataset.json'), 'r') as file:
+            self.metadata = json.load(file)
+        self.rows = self.metadata['rows']
+        self.context_bins = ContextBins.from_json(self.metadata['context_bins'])
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.contexts = load('contexts')[:self.rows]
+        self.actions  = load('actions')[:self.rows]
+        self.rewards  = load('rewards')[:self.rows]
+        self.tbs      = load('tbs')[:self.rows]
+        self.bins     = load('context_bins')[:self.rows]
+        self.bin_order = load('bin_order')
+        self.bin_offsets = np.load(os.path.join(path, 'bin_offsets.npy'))
+
+    def __len__(self):
+        return self.rows
+
+    def rows_in_bin(self, bin_idx):
+        return self.bin_order[self.bin_offsets[bin_idx]: self.bin_offsets[bin_idx + 1]]
+
+    def rows_near(self, cpu, snr):
+        ## row indexes of the samples in the context bin of (cpu, snr)
+        return self.rows_in_bin(int(self.context_bins.bin_of([[cpu, snr]])[0]))
+
+    def bin_sizes(self):
+        return np.diff(self.bin_offsets)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build a memory-mapped training dataset from ATHENA random mode results files')
+    parser.add_argument('inputs', nargs='+', help='results files (pipe-delimited text or npy)')
+    parser.add_argument('-o', '--output', dest='output', required=True, help='dataset directory')
+    parser.add_argument('--penalty', type=float, dest='penalty', default=1)
+    parser.add_argument('--decode_deadline', type=int, dest='decode_deadline', default=3000, help='us')
+    parser.add_argument('--cpu_step', type=float, dest='cpu_step', default=100)
+    parser.add_argument('--snr_step', type=float, dest='snr_step', default=1)
+    parser.add_argument('--chunk_size', type=int, dest='chunk_size', default=100000, help='rows parsed at a time')
+    args = parser.parse_args()
+
+    environment = SrsRanEnv(penalty=args.penalty, decode_deadline=args.decode_deadline)
+    build_dataset(args.inputs, args.output, environment, ContextBins(args.cpu_step, args.snr_step), args.chunk_size)
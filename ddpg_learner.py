@@ -0,0 +1,78 @@
+import numpy as np
+
+class DDPGLearner():
+    '''
+        Batched actor/critic updates of a DDPGAgent. Every TTI is an independent decision
+        (contextual bandit), so the critic regresses the observed reward of (context, action)
+        and the actor ascends the critic: loss = -Q(context, actor(context)).
+        Transitions are kept in a preallocated replay buffer of normalized arrays.
+    '''
+
+    def __init__(self, ddpg_agent, batch_size = 64, replay_size = 100000,
+                 actor_learning_rate = 1e-4, critic_learning_rate = 1e-3) -> None:
+        self.ddpg_agent = ddpg_agent
+        self.tf = ddpg_agent.tf
+        self.batch_size = batch_size
+        self.replay_size = replay_size
+        self.contexts = np.zeros(shape=(replay_size, ddpg_agent.context_size), dtype=np.float32)
+        # the actor output and the critic action input have action_size columns (mcs, or mcs and prb)
+        self.actions  = np.zeros(shape=(replay_size, ddpg_agent.action_size), dtype=np.float32)
+        self.rewards  = np.zeros(shape=(replay_size, 1), dtype=np.float32)
+        self.total_transitions = 0
+        self.total_updates = 0
+        self.actor_optimizer  = self.tf.keras.optimizers.Adam(learning_rate=actor_learning_rate)
+        self.critic_optimizer = self.tf.keras.optimizers.Adam(learning_rate=critic_learning_rate)
+        self.train_step = self.compile_train_step()
+
+    def size(self):
+        return min(self.total_transitions, self.replay_size)
+
+    def add(self, context, mcs, prb, reward):
+        idx = self.total_transitions % self.replay_size
+        self.contexts[idx] = self.ddpg_agent.normalize_context(np.asarray(context, dtype=np.float32))
+        self.actions[idx] = self.ddpg_agent.normalize_action(np.array([mcs, prb], dtype=np.float32)[:self.ddpg_agent.action_size])
+        self.rewards[idx] = reward
+        self.total_transitions += 1
+
+    def normalize_batch(self, contexts, mcs, prb):
+        ## network inputs of a batch of transitions: normalized contexts and actions (action_size columns)
+        contexts = self.ddpg_agent.normalize_context(np.asarray(contexts, dtype=np.float32))
+        actions = np.column_stack([mcs, prb]).astype(np.float32)[:, :self.ddpg_agent.action_size]
+        return contexts, self.ddpg_agent.normalize_action(actions)
+
+    def add_batch(self, contexts, mcs, prb, rewards):
+        total = len(contexts)
+        idx = np.arange(self.total_transitions, self.total_transitions + total) % self.replay_size
+        self.contexts[idx], self.actions[idx] = self.normalize_batch(contexts, mcs, prb)
+        self.rewards[idx, 0] = rewards
+        self.total_transitions += total
+
+    def compile_train_step(self):
+        tf = self.tf
+        actor, critic = self.ddpg_agent.actor, self.ddpg_agent.critic
+
+        @tf.function
+        def train_step(contexts, actions, rewards):
+            with tf.GradientTape() as tape:
+                q_values = critic([contexts, actions], training=True)
+                critic_loss = tf.reduce_mean(tf.square(rewards - q_values))
+            critic_gradients = tape.gradient(critic_loss, critic.trainable_variables)
+            self.critic_optimizer.apply_gradients(zip(critic_gradients, critic.trainable_variables))
+
+            with tf.GradientTape() as tape:
+                actor_actions = actor(contexts, training=True)
+                actor_loss = -tf.reduce_mean(critic([contexts, actor_actions], training=False))
+            actor_gradients = tape.gradient(actor_loss, actor.trainable_variables)
+            self.actor_optimizer.apply_gradients(zip(actor_gradients, actor.trainable_variables))
+            return critic_loss, actor_loss
+
+        return train_step
+
+    def update(self):
+        ## one batched update sampled from the replay buffer, returns (critic loss, actor loss)
+        if (self.size() < self.batch_size):
+            return None
+        idx = np.random.randint(0, self.size(), size=self.batch_size)
+        critic_loss, actor_loss = self.train_step(self.contexts[idx], self.actions[idx], self.rewards[idx])
+        self.total_updates += 1
+        return float(critic_loss), float(actor_loss)
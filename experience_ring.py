@@ -0,0 +1,134 @@
+import numpy as np
+import time
+from multiprocessing import shared_memory
+from namespace import namespaced
+
+# The record fields carry the same names as the info dict returned by SrsRanEnv.step,
+# so a record can be used wherever a sample dict was read field by field.
+EXPERIENCE_DTYPE = np.dtype([
+    ('timestamp', np.int64),
+    ('tti', np.int32),
+    ('hrq', np.int32),
+    ('rnti', np.int32),
+    ('cpu', np.float32),
+    ('snr', np.float32),
+    ('bsr', np.int32),
+    ('gain', np.int32),
+    ('mu', np.int32),
+    ('sigma', np.int32),
+    ('mcs', np.int32),
+    ('prb', np.int32),
+    ('crc', np.int32),
+    ('dec_time', np.int32),
+    ('tbs', np.int32),
+    ('reward', np.float64),
+    ('snr_decode', np.float64),
+    ('noise_decode', np.float64),
+    ('snr_custom', np.float64),
+    ('modified', np.bool_)
+])
+
+# the write counter sits alone in the first cache line
+HEADER_BYTES = 64
+
+def get_ring_memory_name(memory_name, worker_num):
+    return '{}_{}'.format(memory_name, worker_num)
+
+def get_ring(worker_num, capacity, memory_name):
+    ## returns the shared memory, the write counter and the records of the ring of worker_num
+    size = HEADER_BYTES + capacity * EXPERIENCE_DTYPE.itemsize
+    ring_memory_name = get_ring_memory_name(memory_name, worker_num)
+    try:
+        shm = shared_memory.SharedMemory(name=namespaced(ring_memory_name), create=True, size=size)
+    except FileExistsError:
+        shm = shared_memory.SharedMemory(name=namespaced(ring_memory_name), create=False, size=size)
+    write_count = np.ndarray(shape=(1, ), dtype=np.int64, buffer=shm.buf)
+    records = np.ndarray(shape=(capacity, ), dtype=EXPERIENCE_DTYPE, buffer=shm.buf, offset=HEADER_BYTES)
+    return shm, write_count, records
+
+class ExperienceRingWriter():
+    '''
+        Producer side of the experience ring of one HARQ worker. Each worker owns its ring,
+        so there is a single writer per ring and no lock: the record is written first and
+        the write counter is advanced after, which publishes it to the readers.
+    '''
+
+    def __init__(self, worker_num, capacity = 4096, memory_name = 'experience') -> None:
+        self.worker_num = worker_num
+        self.capacity = capacity
+        self.memory_name = memory_name
+
+    def attach(self):
+        self.shm, self.write_count, self.records = get_ring(self.worker_num, self.capacity, self.memory_name)
+        self.names = EXPERIENCE_DTYPE.names
+        return self
+
+    def put(self, info):
+        count = int(self.write_count[0])
+        self.records[count % self.capacity] = tuple([info[name] for name in self.names])
+        self.write_count[0] = count + 1
+
+class ExperienceRingReader():
+    '''
+        Consumer side over the rings of all the HARQ workers. Every reader keeps its own cursors,
+        so the learner and the logger read the same records independently.
+        read() copies the records out of the rings and checks the write counter again afterwards:
+        the records the writer lapped in the meantime may be torn, they are dropped and counted as lost.
+        A reader that fell more than capacity - margin records behind restarts margin records behind
+        the writer, the records skipped are counted as lost too.
+    '''
+
+    def __init__(self, total_workers, capacity = 4096, memory_name = 'experience', margin = None) -> None:
+        self.total_workers = total_workers
+        self.capacity = capacity
+        self.memory_name = memory_name
+        self.margin = max(1, capacity // 16) if (margin is None) else margin
+        self.lost = 0
+
+    def attach(self):
+        rings = [get_ring(worker_num, self.capacity, self.memory_name) for worker_num in range(self.total_workers)]
+        self.shms = [ring[0] for ring in rings]
+        self.write_counts = [ring[1] for ring in rings]
+        self.records = [ring[2] for ring in rings]
+        # records published before attaching (e.g. by a previous run) are not replayed
+        self.cursors = [int(write_count[0]) for write_count in self.write_counts]
+        return self
+
+    def read(self, max_records = None):
+        ## list of record arrays with everything published since the last read
+        arrays = []
+        for worker_num in range(self.total_workers):
+            write_count = int(self.write_counts[worker_num][0])
+            cursor = self.cursors[worker_num]
+            if (write_count - cursor > self.capacity - self.margin):
+                skipped = write_count - cursor - (self.capacity - self.margin)
+                self.lost += skipped
+                cursor += skipped
+            if (max_records is not None):
+                write_count = min(write_count, cursor + max_records)
+            self.cursors[worker_num] = write_count
+            if (write_count == cursor):
+                continue
+            start, end = cursor % self.capacity, write_count % self.capacity
+            records = self.records[worker_num]
+            if (start < end):
+                copied = records[start: end].copy()
+            else:
+                copied = np.concatenate((records[start:], records[:end]))
+            # record i shares its slot with record i + capacity, which the writer may have started
+            overwritten = min(int(self.write_counts[worker_num][0]) - self.capacity + 1 - cursor, len(copied))
+            if (overwritten > 0):
+                self.lost += overwritten
+                copied = copied[overwritten:]
+            if (len(copied) > 0):
+                arrays.append(copied)
+        return arrays
+
+    def wait(self, timeout, poll_interval = 0.001):
+        ## read(), waiting up to timeout seconds for at least one record
+        deadline = time.perf_counter() + timeout
+        arrays = self.read()
+        while (len(arrays) == 0 and time.perf_counter() < deadline):
+            time.sleep(poll_interval)
+            arrays = self.read()
+        return arrays
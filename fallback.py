@@ -0,0 +1,125 @@
+import numpy as np
+from multiprocessing import shared_memory
+from common_utils import get_action_space
+from policy_table import PolicyTable
+from namespace import namespaced
+
+# Counters per HARQ slot, written by the Coordinator only
+COUNTER_DECISIONS      = 0 # actions of the agents written to srsENB
+COUNTER_FALLBACK_LAST  = 1 # budget expired, last decision of the HARQ process written instead
+COUNTER_FALLBACK_TABLE = 2 # budget expired, compiled policy table answer written instead
+COUNTER_FALLBACK_RULE  = 3 # budget expired, conservative rule written instead
+COUNTER_LATE           = 4 # answers of the agents that arrived after a fallback, discarded
+COUNTER_NAMES = ['decisions', 'fallback_last', 'fallback_table', 'fallback_rule', 'late']
+
+FALLBACK_LAST  = 'last'
+FALLBACK_TABLE = 'table'
+FALLBACK_RULE  = 'rule'
+
+def conservative_action():
+    ## the lowest allowed MCS with the most PRBs: the most robust transmission, cheapest to decode
+    action_array = get_action_space().action_array
+    lowest_mcs = action_array[action_array[:, 0] == action_array[:, 0].min()]
+    mcs, prb = lowest_mcs[np.argmax(lowest_mcs[:, 1])]
+    return int(mcs), int(prb)
+
+class FallbackPolicy():
+    '''
+        Action written by the Coordinator when an agent misses the decision budget of its TTI, so
+        srsENB never waits on the Python side for longer than the budget.
+        The sources are tried in order: the compiled policy table (mode 'table'), the last decision
+        of the same HARQ process (modes 'table' and 'last'), and the conservative rule.
+        The counters live in shared memory so the fallback rate can be followed while running.
+    '''
+
+    def __init__(self, total_workers, mode = FALLBACK_LAST, policy_table: PolicyTable = None, memory_name = 'fallback_stats') -> None:
+        if (mode == FALLBACK_TABLE and policy_table is None):
+            raise Exception('The table fallback needs a compiled policy table')
+        self.total_workers = total_workers
+        self.mode = mode
+        self.policy_table = policy_table if (mode == FALLBACK_TABLE) else None
+        self.memory_name = memory_name
+        self.shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['shm', 'counters', 'last_decisions']:
+            state.pop(name, None)
+        state['shm'] = None
+        return state
+
+    def attach(self):
+        size = self.total_workers * len(COUNTER_NAMES) * np.dtype(np.int64).itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=True, size=size)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=False, size=size)
+        self.counters = np.ndarray(shape=(self.total_workers, len(COUNTER_NAMES)), dtype=np.int64, buffer=self.shm.buf)
+        # the last decisions are private to the process running the scheduler interface
+        self.last_decisions = np.full(shape=(self.total_workers, 2), fill_value=-1, dtype=np.int32)
+        self.rule_action = conservative_action()
+        if (self.policy_table is not None):
+            self.policy_table.attach()
+        return self
+
+    def reset(self):
+        self.counters[:] = 0
+        return self
+
+    def accept(self, worker_num, mcs, prb):
+        self.last_decisions[worker_num] = (mcs, prb)
+        self.counters[worker_num, COUNTER_DECISIONS] += 1
+
+    def discard_late(self, worker_num):
+        self.counters[worker_num, COUNTER_LATE] += 1
+
+    def decide(self, worker_num, beta, snr):
+        ## beta and snr as found in the context packet, snr x1000
+        if (self.policy_table is not None and self.policy_table.store.generation() > 0):
+            decision = self.policy_table.lookup(np.array([beta, snr / 1000], dtype=np.float32))
+            if (decision is not None):
+                self.counters[worker_num, COUNTER_FALLBACK_TABLE] += 1
+                return decision
+        mcs, prb = self.last_decisions[worker_num]
+        if (self.mode != FALLBACK_RULE and mcs >= 0):
+            self.counters[worker_num, COUNTER_FALLBACK_LAST] += 1
+            return int(mcs), int(prb)
+        self.counters[worker_num, COUNTER_FALLBACK_RULE] += 1
+        return self.rule_action
+
+def format_counters(counters, per_worker = False):
+    lines = ['{:>6} '.format('worker') + ' '.join('{:>14}'.format(name) for name in COUNTER_NAMES) + ' {:>14}'.format('fallback_rate')]
+    rows = [('all', counters.sum(axis=0))]
+    if (per_worker):
+        rows += [(str(worker), counters[worker]) for worker in range(len(counters))]
+    for worker, worker_counters in rows:
+        fallbacks = worker_counters[COUNTER_FALLBACK_LAST: COUNTER_FALLBACK_RULE + 1].sum()
+        total = worker_counters[COUNTER_DECISIONS] + fallbacks
+        rate = fallbacks / total if (total > 0) else 0
+        lines.append('{:>6} '.format(worker) + ' '.join('{:>14}'.format(value) for value in worker_counters) + ' {:>14.6f}'.format(rate))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from common_utils import untrack_shared_memory
+    parser = argparse.ArgumentParser(description='Show the fallback counters of a running ATHENA scheduler')
+    parser.add_argument('--per_worker', action='store_true', dest='per_worker')
+    parser.add_argument('--watch', type=float, dest='watch', help='refresh every WATCH seconds')
+    args = parser.parse_args()
+
+    try:
+        shm = shared_memory.SharedMemory(name=namespaced('fallback_stats'), create=False)
+    except FileNotFoundError:
+        raise Exception('No fallback counters found, is athena_ml.py running with --decision_budget_us?')
+    untrack_shared_memory(shm)
+    # one row per HARQ slot (agents x max UEs of the running scheduler), as many as the segment holds
+    total_slots = shm.size // (len(COUNTER_NAMES) * np.dtype(np.int64).itemsize)
+    counters = np.ndarray(shape=(total_slots, len(COUNTER_NAMES)), dtype=np.int64, buffer=shm.buf)
+    while (True):
+        print(format_counters(counters.copy(), args.per_worker))
+        if (args.watch is None):
+            break
+        time.sleep(args.watch)
+        print()
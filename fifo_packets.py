@@ -0,0 +1,73 @@
+import numpy as np
+
+# Wire formats of the FIFOs between srsENB and the Coordinator (little endian, packed)
+CONTEXT_PACKET_DTYPE = np.dtype([
+    ('tti', '<u2'),
+    ('rnti', '<u2'),
+    ('bsr', '<u4'),
+    ('snr', '<i4'),
+    ('beta', '<u2'),
+    ('gain', '<u2')
+])
+
+# snr, noise and snr_custom are signed (x1000) values, they end up in the int32 result slots
+REWARD_PACKET_DTYPE = np.dtype([
+    ('tti', '<u2'),
+    ('rnti', '<u2'),
+    ('dec_time', '<u4'),
+    ('crc', 'u1'),
+    ('pad', 'V3'),
+    ('dec_bits', '<u4'),
+    ('mcs', '<u2'),
+    ('prb', '<u2'),
+    ('snr', '<i4'),
+    ('noise', '<i4'),
+    ('snr_custom', '<i4')
+])
+
+ACTION_PACKET_DTYPE = np.dtype([
+    ('mcs', 'u1'),
+    ('prb', 'u1')
+])
+
+VERIFY_PACKET_DTYPE = np.dtype([
+    ('verified', '<u4')
+])
+
+class PacketReader():
+    '''
+        Reads fixed size packets from a FIFO opened unbuffered (buffering=0).
+        Every read() decodes all the complete packets available in one readinto into a reusable buffer;
+        the bytes of an incomplete packet are kept for the next read.
+        On a non-blocking FIFO, read() returns no packets when nothing complete is available yet.
+    '''
+
+    def __init__(self, file, packet_dtype, max_packets = 64) -> None:
+        self.file = file
+        self.packet_dtype = packet_dtype
+        self.packet_size = packet_dtype.itemsize
+        self.buffer = bytearray(self.packet_size * max_packets)
+        self.view = memoryview(self.buffer)
+        self.packets = np.zeros(shape=(max_packets, ), dtype=packet_dtype)
+        self.filled = 0
+
+    def read(self):
+        ## decoded packets (valid until the next read), or None on EOF
+        while (True):
+            received = self.file.readinto(self.view[self.filled:])
+            if (received is None):
+                return self.packets[:0]
+            if (received == 0):
+                return None
+            self.filled += received
+            total_packets = self.filled // self.packet_size
+            if (total_packets > 0):
+                break
+        size = total_packets * self.packet_size
+        packets = self.packets[:total_packets]
+        packets[:] = np.frombuffer(self.buffer, dtype=self.packet_dtype, count=total_packets)
+        leftover = self.filled - size
+        if (leftover > 0):
+            self.view[:leftover] = self.view[size: self.filled]
+        self.filled = leftover
+        return packets
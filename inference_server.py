@@ -0,0 +1,202 @@
+import multiprocessing as mp
+import numpy as np
+import time
+
+from common_utils import get_shared_memory_ref, import_tensorflow, get_action_array
+from agent_ddpg import DDPGAgent
+from agent_preload import take_template_models
+from shared_weights import get_model_weights_store, read_weight_pair
+from placement import Placement, apply_placement, limit_tensorflow_threads, ROLE_INFERENCE
+
+REQUEST_IDLE     = 0
+REQUEST_PENDING  = 1
+RESPONSE_READY   = 2
+
+def get_request_dtype(context_size):
+    return np.dtype([
+        ('state', np.int32),
+        ('context', np.float32, (context_size, )),
+        ('request_id', np.int64),
+        ('mcs', np.int32),
+        ('prb', np.int32),
+        ('response_id', np.int64)
+    ])
+
+def get_request_ring(total_workers, context_size, memory_name):
+    ## one request slot per HARQ worker, each worker has at most one outstanding request
+    request_dtype = get_request_dtype(context_size)
+    shm, requests = get_shared_memory_ref(total_workers * request_dtype.itemsize, request_dtype, memory_name)
+    return shm, requests
+
+class InferenceClient():
+    '''
+        Drop-in replacement of the DDPGAgent decision for the HARQ workers when a central
+        InferenceServer owns the networks. The worker does not need to import TensorFlow.
+        A request not answered within the TTI deadline (server dead or stuck) is answered locally
+        with the last decision of the server, or the conservative rule of fallback.py before the first one.
+    '''
+
+    def __init__(self, worker_num, total_workers, context_size,
+                 memory_name = 'inference_requests', poll_interval = 0.00002, timeout_us = 1000) -> None:
+        self.worker_num = worker_num
+        self.total_workers = total_workers
+        self.context_size = context_size
+        self.memory_name = memory_name
+        self.poll_interval = poll_interval
+        self.timeout = timeout_us / 1e6
+        self.request_id = 0
+        self.last_decision = None
+        self.timeouts = 0
+
+    def attach(self):
+        self.shm, requests = get_request_ring(self.total_workers, self.context_size, self.memory_name)
+        self.state       = requests['state']
+        self.context     = requests['context']
+        self.request_ids = requests['request_id']
+        self.mcs         = requests['mcs']
+        self.prb         = requests['prb']
+        self.response_ids = requests['response_id']
+
+    def __call__(self, context, k=9):
+        worker_num = self.worker_num
+        self.request_id += 1
+        self.context[worker_num] = context
+        self.request_ids[worker_num] = self.request_id
+        self.state[worker_num] = REQUEST_PENDING
+        deadline = time.perf_counter() + self.timeout
+        while (True):
+            if (self.state[worker_num] == RESPONSE_READY):
+                if (self.response_ids[worker_num] == self.request_id):
+                    mcs, prb = int(self.mcs[worker_num]), int(self.prb[worker_num])
+                    self.state[worker_num] = REQUEST_IDLE
+                    self.last_decision = (mcs, prb)
+                    return None, mcs, prb
+                # the late answer of a request given up on, this one is still to be answered
+                self.state[worker_num] = REQUEST_PENDING
+            if (time.perf_counter() > deadline):
+                return (None, ) + self.local_decision()
+            time.sleep(self.poll_interval)
+
+    def local_decision(self):
+        # the request stays pending: a late answer is recognized by its id and discarded
+        if (self.timeouts == 0):
+            print('Worker {} -> Inference server did not answer within {:.0f}us, deciding locally'.format(self.worker_num, self.timeout * 1e6))
+        self.timeouts += 1
+        if (self.last_decision is None):
+            from fallback import conservative_action
+            self.last_decision = conservative_action()
+        return self.last_decision
+
+class InferenceServer(mp.Process):
+    '''
+        Owns the single copy of the actor and critic networks and answers the requests of all
+        the HARQ workers. Concurrent requests are micro-batched into one actor and one critic call.
+        The batching window is bounded by the TTI deadline minus the (smoothed) inference time,
+        so a request is never held back long enough to miss its TTI.
+    '''
+
+    def __init__(self, context_size, action_size, total_workers,
+                 server_initialized: mp.Event, stop_flag: mp.Value,
+                 batch_window_us = 200, tti_deadline_us = 1000,
+                 actor_memory_name = 'model_actor',
+                 critic_memory_name = 'model_critic',
+                 request_memory_name = 'inference_requests',
+                 poll_interval = 0.00002,
+                 placement: Placement = None,
+                 master_initialized: mp.Event = None) -> None:
+        super(InferenceServer, self).__init__()
+        self.context_size = context_size
+        self.action_size = action_size
+        self.total_workers = total_workers
+        self.server_initialized = server_initialized
+        self.master_initialized = master_initialized
+        self.stop_flag = stop_flag
+        self.batch_window = batch_window_us / 1e6
+        self.tti_deadline = tti_deadline_us / 1e6
+        self.actor_memory_name = actor_memory_name
+        self.critic_memory_name = critic_memory_name
+        self.request_memory_name = request_memory_name
+        self.poll_interval = poll_interval
+        self.placement = placement
+
+    def run(self):
+        import signal
+        signal.signal(signal.SIGINT , self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+        apply_placement(self.placement, ROLE_INFERENCE)
+        self.tf, _, _ = import_tensorflow('3', False)
+        limit_tensorflow_threads(self.placement, ROLE_INFERENCE, self.tf)
+        try:
+            if (self.master_initialized is not None):
+                # the TensorFlow import above overlaps with the initialization of the master
+                self.master_initialized.wait()
+            self.initialize_models()
+            self.shm_requests, requests = get_request_ring(self.total_workers, self.context_size, self.request_memory_name)
+            requests['state'][:] = REQUEST_IDLE
+            self.server_initialized.set()
+            print(str(self) + ' -> Serving {} HARQ workers'.format(self.total_workers))
+            self.serve(requests)
+        finally:
+            print(str(self) + ' -> Exiting...')
+
+    def exit_gracefully(self, signum, frame):
+        self.stop_flag.value = 1
+
+    def initialize_models(self):
+        self.ddpg_agent = DDPGAgent(self.tf, self.context_size, self.action_size)
+        self.ddpg_agent.set_action_array(get_action_array())
+        template_models = take_template_models(self.context_size, self.action_size)
+        if (template_models is not None):
+            self.ddpg_agent.actor, self.ddpg_agent.critic = template_models
+        else:
+            self.ddpg_agent.load_actor()
+            self.ddpg_agent.load_critic()
+
+        self.actor_weights = get_model_weights_store(self.ddpg_agent.actor, self.actor_memory_name)
+        self.critic_weights = get_model_weights_store(self.ddpg_agent.critic, self.critic_memory_name)
+        self.update_weights()
+
+    def update_weights(self):
+        generations = read_weight_pair(
+            self.actor_weights, self.ddpg_agent.actor.set_weights, self.critic_weights, self.ddpg_agent.critic.set_weights)
+        if (generations[0] is None):
+            # the publisher stopped mid-publish: the current weights are kept until the next publication
+            generations = (self.actor_weights.generation(), self.critic_weights.generation())
+            print(str(self) + ' -> No complete weights publication (generations {} and {}), keeping the current weights'.format(*generations))
+        self.actor_generation, self.critic_generation = generations
+
+    def weights_changed(self):
+        return (self.actor_weights.generation() != self.actor_generation
+                or self.critic_weights.generation() != self.critic_generation)
+
+    def serve(self, requests):
+        state = requests['state']
+        inference_time = 0
+        while (self.stop_flag.value == 0):
+            pending = np.flatnonzero(state == REQUEST_PENDING)
+            if (len(pending) == 0):
+                # new weights are only swapped in between batches
+                if (self.weights_changed()):
+                    self.update_weights()
+                time.sleep(self.poll_interval)
+                continue
+
+            # wait for the requests of the other HARQ workers, but never past the TTI deadline
+            batch_window = min(self.batch_window, max(self.tti_deadline - inference_time, 0))
+            window_end = time.perf_counter() + batch_window
+            while (len(pending) < self.total_workers and time.perf_counter() < window_end):
+                time.sleep(self.poll_interval)
+                pending = np.flatnonzero(state == REQUEST_PENDING)
+
+            start = time.perf_counter()
+            # the ids are read along with the contexts, an answer is only taken for the request it was computed for
+            request_ids = requests['request_id'][pending]
+            mcs, prb = self.ddpg_agent.decide_batch(requests['context'][pending])
+            requests['mcs'][pending] = mcs
+            requests['prb'][pending] = prb
+            requests['response_id'][pending] = request_ids
+            state[pending] = RESPONSE_READY
+            inference_time = 0.9 * inference_time + 0.1 * (time.perf_counter() - start)
+
+    def __str__(self) -> str:
+        return 'Inference Server'
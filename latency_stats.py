@@ -0,0 +1,164 @@
+import numpy as np
+import time
+from multiprocessing import shared_memory
+from namespace import namespaced
+
+# Stages of a TTI, timed with time.monotonic_ns() (one clock for all the processes)
+STAGE_DECISION  = 0 # Coordinator: context published -> action of the agent written to srsENB
+STAGE_VERIFY    = 1 # Coordinator: action written to srsENB -> verify word received
+STAGE_REWARD    = 2 # Coordinator: context published -> reward of the TTI received
+STAGE_INFERENCE = 3 # HARQ agent: context received -> decision taken
+STAGE_NAMES = ['decision', 'verify', 'reward', 'inference']
+
+# Log-linear buckets (as in HDR histograms): values below 2^SUB_BITS have their own bucket,
+# above that every power of two is split in 2^SUB_BITS buckets, i.e. ~3% relative resolution.
+SUB_BITS      = 5
+SUB_BUCKETS   = 1 << SUB_BITS
+MAX_EXPONENT  = 40 # up to ~18 minutes in ns
+TOTAL_BUCKETS = SUB_BUCKETS + (MAX_EXPONENT - SUB_BITS) * SUB_BUCKETS
+
+COUNTER_TOTAL  = 0
+COUNTER_SUM    = 1
+COUNTER_MAX    = 2
+COUNTER_MISSES = 3
+TOTAL_COUNTERS = 4
+
+def bucket_index(value):
+    if (value < SUB_BUCKETS):
+        return max(value, 0)
+    exponent = value.bit_length() - SUB_BITS - 1
+    return min(SUB_BUCKETS + exponent * SUB_BUCKETS + (value >> exponent) - SUB_BUCKETS, TOTAL_BUCKETS - 1)
+
+def bucket_upper_bounds():
+    idx = np.arange(TOTAL_BUCKETS, dtype=np.int64)
+    exponent = np.maximum(idx // SUB_BUCKETS - 1, 0)
+    mantissa = np.where(idx < SUB_BUCKETS, idx, idx % SUB_BUCKETS + SUB_BUCKETS)
+    return ((mantissa + 1) << exponent) - 1
+
+class LatencyStats():
+    '''
+        Per-TTI stage latencies and deadline misses, per HARQ worker, in shared memory.
+        Every (worker, stage) row has a single writer process, so recording is a few plain
+        increments, without locks. Readers (latency_stats.py CLI) take snapshots while the system runs.
+        deadlines_us holds the deadline of every stage, 0 disables the deadline of the stage.
+    '''
+
+    def __init__(self, total_workers, deadlines_us = (1000, 1000, 0, 1000), memory_name = 'latency_stats') -> None:
+        self.total_workers = total_workers
+        self.deadlines_us = deadlines_us
+        self.memory_name = memory_name
+        self.shm = None
+
+    def __getstate__(self):
+        # the arrays are views on the shared memory, every process attaches by itself
+        state = self.__dict__.copy()
+        for name in ['shm', 'histograms', 'counters', 'deadlines', 'context_timestamps']:
+            state.pop(name, None)
+        state['shm'] = None
+        return state
+
+    def attach(self):
+        total_stages = len(STAGE_NAMES)
+        shapes = [('deadlines', (total_stages, )),
+                  ('context_timestamps', (self.total_workers, )),
+                  ('counters', (self.total_workers, total_stages, TOTAL_COUNTERS)),
+                  ('histograms', (self.total_workers, total_stages, TOTAL_BUCKETS))]
+        size = int(np.sum([np.prod(shape) for _, shape in shapes])) * np.dtype(np.int64).itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=True, size=size)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=False, size=size)
+        offset = 0
+        for name, shape in shapes:
+            setattr(self, name, np.ndarray(shape=shape, dtype=np.int64, buffer=self.shm.buf, offset=offset))
+            offset += int(np.prod(shape)) * np.dtype(np.int64).itemsize
+        return self
+
+    def reset(self):
+        ## called once at startup, stats left by a previous run are discarded
+        self.histograms[:] = 0
+        self.counters[:] = 0
+        self.context_timestamps[:] = 0
+        self.deadlines[:] = np.array(self.deadlines_us, dtype=np.int64) * 1000
+        return self
+
+    def context_published(self, worker_num, timestamp):
+        self.context_timestamps[worker_num] = timestamp
+
+    def record(self, stage, worker_num, latency):
+        ## latency in ns
+        counters = self.counters[worker_num, stage]
+        counters[COUNTER_TOTAL] += 1
+        counters[COUNTER_SUM] += latency
+        if (latency > counters[COUNTER_MAX]):
+            counters[COUNTER_MAX] = latency
+        deadline = self.deadlines[stage]
+        if (deadline > 0 and latency > deadline):
+            counters[COUNTER_MISSES] += 1
+        self.histograms[worker_num, stage, bucket_index(latency)] += 1
+
+    def record_since(self, stage, worker_num, start):
+        now = time.monotonic_ns()
+        self.record(stage, worker_num, now - start)
+        return now
+
+    def record_since_context(self, stage, worker_num):
+        start = self.context_timestamps[worker_num]
+        if (start > 0):
+            self.record(stage, worker_num, time.monotonic_ns() - int(start))
+
+    def snapshot(self):
+        return self.counters.copy(), self.histograms.copy()
+
+def percentiles(histogram, quantiles, upper_bounds):
+    total = histogram.sum()
+    if (total == 0):
+        return [0] * len(quantiles)
+    cumulative = np.cumsum(histogram)
+    return [int(upper_bounds[np.searchsorted(cumulative, q * total, side='left')]) for q in quantiles]
+
+def format_snapshot(counters, histograms, deadlines, per_worker = False):
+    quantiles = [0.5, 0.9, 0.99, 0.999]
+    upper_bounds = bucket_upper_bounds()
+    lines = ['{:<10} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'stage', 'worker', 'count', 'mean_us', 'p50_us', 'p90_us', 'p99_us', 'p99.9_us', 'max_us', 'misses')]
+    rows = [('all', counters.sum(axis=0), histograms.sum(axis=0), counters[:, :, COUNTER_MAX].max(axis=0))]
+    if (per_worker):
+        rows += [(str(worker), counters[worker], histograms[worker], counters[worker, :, COUNTER_MAX])
+                 for worker in range(len(counters))]
+    for stage, stage_name in enumerate(STAGE_NAMES):
+        for worker, stage_counters, stage_histograms, stage_max in rows:
+            total = stage_counters[stage, COUNTER_TOTAL]
+            mean = stage_counters[stage, COUNTER_SUM] / total if (total > 0) else 0
+            # the bucket upper bounds never report above the recorded maximum
+            values = [mean] + [min(value, stage_max[stage]) for value in percentiles(stage_histograms[stage], quantiles, upper_bounds)] + [stage_max[stage]]
+            misses = stage_counters[stage, COUNTER_MISSES] if (deadlines[stage] > 0) else '-'
+            lines.append('{:<10} {:>6} {:>10} '.format(stage_name, worker, total)
+                         + ' '.join('{:>10.1f}'.format(value / 1000) for value in values) + ' {:>8}'.format(misses))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    from common_utils import untrack_shared_memory
+    parser = argparse.ArgumentParser(description='Snapshot the per-TTI latency histograms of a running ATHENA scheduler')
+    parser.add_argument('--agents', type=int, dest='agents', default=8)
+    parser.add_argument('--per_worker', action='store_true', dest='per_worker')
+    parser.add_argument('--watch', type=float, dest='watch', help='refresh every WATCH seconds')
+    args = parser.parse_args()
+
+    try:
+        shm = shared_memory.SharedMemory(name=namespaced('latency_stats'), create=False)
+    except FileNotFoundError:
+        raise Exception('No latency stats found, is athena_ml.py running with --latency_stats?')
+    untrack_shared_memory(shm)
+    shm.close()
+    stats = LatencyStats(args.agents).attach()
+    untrack_shared_memory(stats.shm)
+    while (True):
+        counters, histograms = stats.snapshot()
+        print(format_snapshot(counters, histograms, stats.deadlines, args.per_worker))
+        if (args.watch is None):
+            break
+        time.sleep(args.watch)
+        print()
@@ -1,6 +1,9 @@
 import multiprocessing as mp
 import queue
 from common_utils import MODE_SCHEDULING_RANDOM
+from experience_ring import ExperienceRingReader
+from results_format import ResultsWriter
+from placement import Placement, apply_placement, ROLE_LOG
 
 class LogProcess(mp.Process):
     '''
@@ -8,11 +11,19 @@ class LogProcess(mp.Process):
         There are two scheduling samples:
         1) Data returned by a scheduler running infinitely that will be further processed for training
         2) Data returned by the ATHENA/srsRAN scheduler that are used to evaluate the solutions
+        The samples are received from the log queue, or read from the experience rings of the HARQ agents.
+        They are written as pipe-delimited text, or as a binary columnar file (log_format 'npy', see results_format).
     '''
 
-    def __init__(self, log_queue: mp.Queue, scheduling_mode, log_file, stop_flag: mp.Value):
+    def __init__(self, log_queue: mp.Queue, scheduling_mode, log_file, stop_flag: mp.Value,
+                 experience_ring: ExperienceRingReader = None,
+                 log_format = 'text', flush_interval = 10, placement: Placement = None):
         super(LogProcess, self).__init__()
+        self.placement = placement
         self.log_queue = log_queue
+        self.experience_ring = experience_ring
+        self.log_format = log_format
+        self.flush_interval = flush_interval
         self.scheduling_mode = scheduling_mode
         self.log_file = log_file
         self.stop_flag = stop_flag
@@ -21,7 +32,12 @@ class LogProcess(mp.Process):
         import signal
         signal.signal(signal.SIGINT , self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
-        if (self.scheduling_mode == MODE_SCHEDULING_RANDOM):
+        apply_placement(self.placement, ROLE_LOG)
+        if (self.experience_ring is not None):
+            self.experience_ring.attach()
+        if (self.log_format == 'npy'):
+            self.sched_mode_binary()
+        elif (self.scheduling_mode == MODE_SCHEDULING_RANDOM):
             self.sched_mode_random()
         else:
             self.sched_mode_inference()
@@ -30,36 +46,62 @@ class LogProcess(mp.Process):
     def exit_gracefully(self, signum, frame):
         self.stop_flag.value = 1
 
+    def receive_samples(self):
+        # the ring records are indexed by field name, like the sample dicts of the queue
+        if (self.experience_ring is not None):
+            return [sample for records in self.experience_ring.wait(timeout=2) for sample in records]
+        return [self.log_queue.get(block = True, timeout = 2)]
+
+    def sched_mode_binary(self):
+        # same columns as the text files of the scheduling mode, written in large chunks
+        import time
+        with ResultsWriter(self.log_file, self.scheduling_mode) as writer:
+            last_flush = time.time()
+            while self.stop_flag.value == 0:
+                try:
+                    if (self.experience_ring is not None):
+                        for records in self.experience_ring.wait(timeout=2):
+                            writer.append_records(records)
+                    else:
+                        writer.append(self.log_queue.get(block = True, timeout = 2))
+                except queue.Empty:
+                    pass
+                if (time.time() - last_flush > self.flush_interval):
+                    writer.flush()
+                    last_flush = time.time()
+            print('Log thread -> {} samples written to {}'.format(writer.total_rows + writer.rows, self.log_file))
+
     def sched_mode_random(self):
         with open(self.log_file, 'w') as file:
-            file.write('|'.join(['cpu', 'snr', 'mcs', 'prb', 'crc', 'decoding_time', 'snr_decode', 'noise_decode', 'snr_decode_custom', 'gain']) + '\n')
+            file.write('|'.join(['cpu', 'snr', 'mcs', 'prb', 'crc', 'decoding_time', 'snr_decode', 'noise_decode', 'snr_decode_custom', 'gain', 'rnti']) + '\n')
             sample_idx = 0
             while self.stop_flag.value == 0:
                 try:
-                    sample = self.log_queue.get(block = True, timeout = 2)
-                    timestamp = sample['timestamp']
-                    tti       = sample['tti']
-                    hrq       = sample['hrq']
-                    mcs       = sample['mcs']
-                    prb       = sample['prb']
-                    tbs       = sample['tbs']
-                    crc       = sample['crc']
-                    dec_time  = sample['dec_time']
-                    cpu       = sample['cpu']
-                    snr       = sample['snr']
-                    gain      = sample['gain']
-                    snr_decode       = sample['snr_decode']
-                    noise_decode       = sample['noise_decode']
-                    snr_custom       = sample['snr_custom']
+                    for sample in self.receive_samples():
+                        timestamp = sample['timestamp']
+                        tti       = sample['tti']
+                        hrq       = sample['hrq']
+                        rnti      = sample['rnti']
+                        mcs       = sample['mcs']
+                        prb       = sample['prb']
+                        tbs       = sample['tbs']
+                        crc       = sample['crc']
+                        dec_time  = sample['dec_time']
+                        cpu       = sample['cpu']
+                        snr       = sample['snr']
+                        gain      = sample['gain']
+                        snr_decode       = sample['snr_decode']
+                        noise_decode       = sample['noise_decode']
+                        snr_custom       = sample['snr_custom']
 
-                    fields = [cpu, snr, mcs, prb, crc, dec_time, snr_decode, noise_decode, snr_custom, gain]
-                    record = [str(x) for x in fields]
+                        fields = [cpu, snr, mcs, prb, crc, dec_time, snr_decode, noise_decode, snr_custom, gain, rnti]
+                        record = [str(x) for x in fields]
                     
-                    file.write('|'.join(record) + '\n')
-                    sample_idx += 1
-                    if (sample_idx == 10):
-                        file.flush()
-                        sample_idx = 0
+                        file.write('|'.join(record) + '\n')
+                        sample_idx += 1
+                        if (sample_idx == 10):
+                            file.flush()
+                            sample_idx = 0
                 except queue.Empty:
                     pass
 
@@ -68,38 +110,39 @@ class LogProcess(mp.Process):
                 'timestamp', 'tti', 'hrq', 
                 'mcs', 'prb', 'tbs', 
                 'crc' , 'dec_time', 
-                'cpu', 'snr', 'gain', 'snr_decode', 'noise_decode', 'snr_decode_custom']
+                'cpu', 'snr', 'gain', 'snr_decode', 'noise_decode', 'snr_decode_custom', 'rnti']
         with open(self.log_file, 'w') as file:
             file.write('|'.join(columns) + '\n')
             sample_idx = 0
             while self.stop_flag.value == 0:
                 try:
-                    sample = self.log_queue.get(block = True, timeout = 2)
-                    timestamp = sample['timestamp']
-                    tti       = sample['tti']
-                    hrq       = sample['hrq']
-                    mcs       = sample['mcs']
-                    prb       = sample['prb']
-                    tbs       = sample['tbs']
-                    crc       = sample['crc']
-                    dec_time  = sample['dec_time']
-                    cpu       = sample['cpu']
-                    snr       = sample['snr']
-                    gain      = sample['gain']
-                    snr_decode       = sample['snr_decode']
-                    noise_decode       = sample['noise_decode']
-                    snr_custom       = sample['snr_custom']
-                    fields = [
-                        timestamp, tti, hrq,
-                        mcs, prb, tbs,
-                        crc, dec_time,
-                        cpu, snr, gain, snr_decode, noise_decode, snr_custom
-                    ]
-                    record = [str(x) for x in fields]
-                    file.write('|'.join(record) + '\n')
-                    sample_idx += 1
-                    if (sample_idx == 10):
-                        file.flush()
-                        sample_idx = 0
+                    for sample in self.receive_samples():
+                        timestamp = sample['timestamp']
+                        tti       = sample['tti']
+                        hrq       = sample['hrq']
+                        rnti      = sample['rnti']
+                        mcs       = sample['mcs']
+                        prb       = sample['prb']
+                        tbs       = sample['tbs']
+                        crc       = sample['crc']
+                        dec_time  = sample['dec_time']
+                        cpu       = sample['cpu']
+                        snr       = sample['snr']
+                        gain      = sample['gain']
+                        snr_decode       = sample['snr_decode']
+                        noise_decode       = sample['noise_decode']
+                        snr_custom       = sample['snr_custom']
+                        fields = [
+                            timestamp, tti, hrq,
+                            mcs, prb, tbs,
+                            crc, dec_time,
+                            cpu, snr, gain, snr_decode, noise_decode, snr_custom, rnti
+                        ]
+                        record = [str(x) for x in fields]
+                        file.write('|'.join(record) + '\n')
+                        sample_idx += 1
+                        if (sample_idx == 10):
+                            file.flush()
+                            sample_idx = 0
                 except queue.Empty:
                     pass
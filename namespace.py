@@ -0,0 +1,72 @@
+import os
+from multiprocessing import shared_memory
+
+# Cell (instance) namespace of the shared memory segments and FIFOs, so that several ATHENA
+# instances run side by side on one host. Set by athena_ml.py --cell and inherited by every
+# process it starts; the command line tools read it from the environment as well.
+CELL_ENV = 'ATHENA_CELL'
+# held by the athena_ml.py instance of the cell (and the processes it forks) as long as it runs
+CELL_LOCK_PATH = '/tmp/athena.lock'
+
+# every segment of an instance, the experience rings are added per HARQ agent
+SEGMENT_NAMES = [
+    'observation', 'context_batch', 'action', 'verify_action', 'result', 'ue_slots',
+    'model_actor', 'model_critic', 'model_actor_quantized', 'model_critic_quantized', 'policy_table', 'inference_requests',
+    'latency_stats', 'fallback_stats'
+]
+
+def get_cell():
+    return os.environ.get(CELL_ENV, '')
+
+def set_cell(cell):
+    if (cell is not None):
+        os.environ[CELL_ENV] = cell
+
+def namespaced(name):
+    ## shared memory segment name in the namespace of the cell (unchanged without a cell)
+    cell = get_cell()
+    if (cell == ''):
+        return name
+    return '{}_{}'.format(cell, name)
+
+def namespaced_path(path):
+    ## FIFO path in the namespace of the cell: /tmp/actor_in -> /tmp/<cell>_actor_in
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, namespaced(file_name))
+
+def segment_names(total_agents, experience_memory_name = 'experience'):
+    return [namespaced(name) for name in SEGMENT_NAMES] + \
+           [namespaced('{}_{}'.format(experience_memory_name, worker_num)) for worker_num in range(total_agents)]
+
+def unlink_segments(total_agents, reason = 'Removing'):
+    ## unlinks the segments of the cell that exist, returns their names
+    removed = []
+    for name in segment_names(total_agents):
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=False)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+        removed.append(name)
+    if (len(removed) > 0):
+        print('{} shared memory segments: {}'.format(reason, ', '.join(removed)))
+    return removed
+
+def lock_cell():
+    ## takes the lock of the cell, raises if another instance holds it; the lock lasts as long as the returned file is open
+    import fcntl
+    lock_path = namespaced_path(CELL_LOCK_PATH)
+    lock_file = open(lock_path, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.seek(0)
+        owner = lock_file.read().strip()
+        lock_file.close()
+        raise Exception('Cell \'{}\' is in use by the athena_ml.py instance with pid {} ({})'.format(get_cell(), owner or 'unknown', lock_path))
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
@@ -0,0 +1,75 @@
+import os
+import select
+from multiprocessing import context, reduction
+
+class Notifier():
+    '''
+        Wakes up a process waiting for data published in shared memory, replacing the
+        (mp.Condition, flag) polling pairs. Backed by an eventfd, or by a pipe where eventfd
+        is not available. The flag in shared memory stays the source of truth: a notification
+        sent before the wait is kept (no lost wake-up), a stale one only causes an extra flag check.
+
+            producer: write the data, set the flag, notify()
+            consumer: while flag == 0: wait()
+    '''
+
+    def __init__(self) -> None:
+        if (hasattr(os, 'eventfd')):
+            self.read_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.write_fd = self.read_fd
+            self.is_eventfd = True
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+            self.is_eventfd = False
+        self.poller = None
+
+    def __getstate__(self):
+        # like the multiprocessing synchronization primitives, it can only be inherited by a child process
+        context.assert_spawning(self)
+        state = self.__dict__.copy()
+        state['poller'] = None
+        state['read_fd'] = reduction.DupFd(self.read_fd)
+        state['write_fd'] = state['read_fd'] if (self.is_eventfd) else reduction.DupFd(self.write_fd)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.read_fd = state['read_fd'].detach()
+        self.write_fd = self.read_fd if (self.is_eventfd) else state['write_fd'].detach()
+
+    def fileno(self):
+        return self.read_fd
+
+    def notify(self):
+        try:
+            if (self.is_eventfd):
+                os.eventfd_write(self.write_fd, 1)
+            else:
+                os.write(self.write_fd, b'\x01')
+        except BlockingIOError:
+            # the counter (or the pipe) is full of notifications the consumer has not seen yet
+            pass
+
+    def clear(self):
+        try:
+            if (self.is_eventfd):
+                os.eventfd_read(self.read_fd)
+            else:
+                while (len(os.read(self.read_fd, 4096)) == 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout = None):
+        ## blocks until notified or timeout (seconds) expires, returns True if notified
+        if (self.poller is None):
+            # created lazily, the poll object lives in the waiting process
+            self.poller = select.poll()
+            self.poller.register(self.read_fd, select.POLLIN)
+        events = self.poller.poll(None if (timeout is None) else timeout * 1000)
+        if (len(events) == 0):
+            return False
+        self.clear()
+        return True
@@ -0,0 +1,296 @@
+import numpy as np
+from agent_ddpg import HIDDEN_LAYERS
+from shared_weights import VersionedWeights
+
+ACTIVATION_LINEAR  = 0
+ACTIVATION_SIGMOID = 1
+
+QUANTIZATION_NONE    = 'none'
+QUANTIZATION_FLOAT16 = 'float16'
+QUANTIZATION_INT8    = 'int8'
+QUANTIZATION_MODES   = [QUANTIZATION_NONE, QUANTIZATION_FLOAT16, QUANTIZATION_INT8]
+# percentiles of |kernel| tried as the int8 clipping range of every output channel when calibrating
+CLIP_PERCENTILES = [100, 99.99, 99.9, 99.5, 99]
+
+def mlp_weight_shapes(input_size, output_size):
+    ## shapes of the Keras get_weights() list of the DDPGAgent networks: kernel, bias per dense layer
+    shapes = []
+    for units in HIDDEN_LAYERS + [output_size]:
+        shapes.append((input_size, units))
+        shapes.append((units, ))
+        input_size = units
+    return shapes
+
+def quantize_kernel(kernel, quantization, inputs = None):
+    ## (quantized kernel, per output channel scales or None) of a (inputs, units) kernel
+    if (quantization == QUANTIZATION_FLOAT16):
+        return kernel.astype(np.float16), None
+    abs_kernel = np.abs(kernel)
+    if (inputs is None):
+        candidates = [abs_kernel.max(axis=0)]
+    else:
+        candidates = [np.percentile(abs_kernel, percentile, axis=0) for percentile in CLIP_PERCENTILES]
+        reference = inputs @ kernel
+    best = None
+    for clip in candidates:
+        scales = np.where(clip > 0, clip / 127, 1).astype(np.float32)
+        quantized = np.clip(np.round(kernel / scales), -127, 127).astype(np.int8)
+        if (inputs is None):
+            return quantized, scales
+        # the clipping range that best reproduces the layer outputs over the calibration inputs
+        error = np.mean(np.square(inputs @ (quantized * scales) - reference))
+        if (best is None or error < best[0]):
+            best = (error, quantized, scales)
+    return best[1], best[2]
+
+def quantize_weights(weights, quantization, calibration_inputs = None):
+    ## weight-only quantization of a Keras get_weights() list: [(quantized kernel, scales), bias, ...]
+    ## the calibration inputs are propagated through the float layers to calibrate every kernel
+    quantized_weights = []
+    inputs = None if (calibration_inputs is None) else np.asarray(calibration_inputs, dtype=np.float32)
+    total_layers = len(weights) // 2
+    for idx in range(total_layers):
+        kernel, bias = np.asarray(weights[2 * idx], dtype=np.float32), np.asarray(weights[2 * idx + 1], dtype=np.float32)
+        quantized_weights.append(quantize_kernel(kernel, quantization, inputs))
+        quantized_weights.append(bias)
+        if (inputs is not None and idx < total_layers - 1):
+            inputs = np.maximum(inputs @ kernel + bias, 0)
+    return quantized_weights
+
+def flatten_quantized(quantized_weights):
+    ## the arrays of quantize_weights in the order of quantized_layout
+    arrays = []
+    for weight in quantized_weights:
+        if (isinstance(weight, tuple)):
+            arrays += [array for array in weight if (array is not None)]
+        else:
+            arrays.append(weight)
+    return arrays
+
+def quantized_layout(shapes, quantization):
+    ## (shapes, dtypes) of the published quantized weights: kernel, int8 scales per output channel, float32 bias per layer
+    layout_shapes, dtypes = [], []
+    for kernel_shape, bias_shape in zip(shapes[0::2], shapes[1::2]):
+        if (quantization == QUANTIZATION_FLOAT16):
+            layout_shapes.append(kernel_shape)
+            dtypes.append(np.float16)
+        else:
+            layout_shapes += [kernel_shape, bias_shape]
+            dtypes += [np.int8, np.float32]
+        layout_shapes.append(bias_shape)
+        dtypes.append(np.float32)
+    return layout_shapes, dtypes
+
+def limit_blas_threads(threads):
+    # threadpoolctl is optional, without it the BLAS thread pool is left as configured by the environment
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print('threadpoolctl is not installed, cannot limit the BLAS threads to {}'.format(threads))
+        return None
+    return threadpool_limits(limits=threads, user_api='blas')
+
+class NumpyMLP():
+    '''
+        Forward pass of the DDPGAgent actor/critic with NumPy matmuls.
+        The intermediate activations are preallocated per batch size and reused across calls,
+        so the returned array is only valid until the next call with the same batch size.
+    '''
+
+    def __init__(self, shapes, output_activation = ACTIVATION_LINEAR, dtype = np.float32, quantization = QUANTIZATION_NONE) -> None:
+        self.dtype = np.dtype(dtype)
+        self.kernels = [np.zeros(shape=shape, dtype=self.dtype) for shape in shapes[0::2]]
+        self.biases  = [np.zeros(shape=shape, dtype=self.dtype) for shape in shapes[1::2]]
+        self.input_size = self.kernels[0].shape[0]
+        self.output_activation = output_activation
+        self.quantization = quantization
+        self.buffers = {}
+
+    def set_weights(self, weights):
+        # same interface as keras.Model.set_weights, the arrays are copied (and cast) in place.
+        # When quantized, the weights are the arrays of quantized_layout, already quantized by the publisher
+        # (WeightQuantizer); NumPy has no float16/int8 matmul kernels, so the kernels are dequantized in place
+        # and the products still run in the compute dtype
+        if (self.quantization == QUANTIZATION_INT8):
+            for idx, kernel in enumerate(self.kernels):
+                np.multiply(weights[3 * idx], weights[3 * idx + 1], out=kernel)
+                np.copyto(self.biases[idx], weights[3 * idx + 2], casting='unsafe')
+            return
+        for kernel, w in zip(self.kernels, weights[0::2]):
+            np.copyto(kernel, w, casting='unsafe')
+        for bias, b in zip(self.biases, weights[1::2]):
+            np.copyto(bias, b, casting='unsafe')
+
+    def get_buffers(self, batch_size):
+        buffers = self.buffers.get(batch_size)
+        if (buffers is None):
+            buffers = [np.zeros(shape=(batch_size, self.input_size), dtype=self.dtype)]
+            buffers += [np.zeros(shape=(batch_size, kernel.shape[1]), dtype=self.dtype) for kernel in self.kernels]
+            self.buffers[batch_size] = buffers
+        return buffers
+
+    def __call__(self, inputs):
+        # the critic receives [context, action], concatenated as in the Keras Concatenate layer
+        if (isinstance(inputs, (list, tuple))):
+            batch_size = len(inputs[0])
+            buffers = self.get_buffers(batch_size)
+            offset = 0
+            for model_input in inputs:
+                width = model_input.shape[1]
+                buffers[0][:, offset: offset + width] = model_input
+                offset += width
+        else:
+            batch_size = len(inputs)
+            buffers = self.get_buffers(batch_size)
+            buffers[0][:] = inputs
+
+        total_layers = len(self.kernels)
+        for idx in range(total_layers):
+            x, y = buffers[idx], buffers[idx + 1]
+            np.matmul(x, self.kernels[idx], out=y)
+            y += self.biases[idx]
+            if (idx < total_layers - 1):
+                np.maximum(y, 0, out=y)
+            elif (self.output_activation == ACTIVATION_SIGMOID):
+                np.negative(y, out=y)
+                np.exp(y, out=y)
+                y += 1
+                np.reciprocal(y, out=y)
+        return buffers[-1]
+
+class WeightQuantizer():
+    '''
+        Quantizes the weights of one network into the arrays of quantized_layout, once per published generation.
+        The int8 clipping ranges are calibrated on the (normalized) network inputs of logged samples, when given.
+    '''
+
+    def __init__(self, shapes, quantization, calibration_inputs = None) -> None:
+        self.quantization = quantization
+        self.calibration_inputs = calibration_inputs
+        self.shapes, self.dtypes = quantized_layout(shapes, quantization)
+
+    def __call__(self, weights):
+        return flatten_quantized(quantize_weights(weights, self.quantization, self.calibration_inputs))
+
+    def get_store(self, memory_name):
+        return VersionedWeights(self.shapes, self.dtypes, memory_name)
+
+def quantized_memory_name(memory_name):
+    return memory_name + '_quantized'
+
+def get_numpy_models(ddpg_agent, dtype = np.float32, quantization = QUANTIZATION_NONE):
+    ## the NumPy networks of the DDPGAgent, set with float weights or with the arrays of a WeightQuantizer
+    context_size, action_size = ddpg_agent.context_size, ddpg_agent.action_size
+    actor  = NumpyMLP(mlp_weight_shapes(context_size, action_size), ACTIVATION_SIGMOID, dtype, quantization)
+    critic = NumpyMLP(mlp_weight_shapes(context_size + action_size, 1), ACTIVATION_LINEAR, dtype, quantization)
+    return actor, critic
+
+def get_quantizers(ddpg_agent, quantization, calibration = None):
+    ## the WeightQuantizer of the actor and the critic; calibration: (contexts, actions) of logged samples
+    context_size, action_size = ddpg_agent.context_size, ddpg_agent.action_size
+    actor_inputs, critic_inputs = None, None
+    if (calibration is not None):
+        contexts, actions = calibration
+        actor_inputs = ddpg_agent.normalize_context(np.asarray(contexts, dtype=np.float32))
+        actions = np.asarray(actions, dtype=np.float32)
+        actions = ddpg_agent.adjust_action_for_critic(ddpg_agent.normalize_action(actions[:, :action_size]))
+        critic_inputs = np.concatenate([actor_inputs, actions], axis=1)
+    actor_quantizer  = WeightQuantizer(mlp_weight_shapes(context_size, action_size), quantization, actor_inputs)
+    critic_quantizer = WeightQuantizer(mlp_weight_shapes(context_size + action_size, 1), quantization, critic_inputs)
+    return actor_quantizer, critic_quantizer
+
+def load_calibration(path, total_samples = 1024, seed = 0):
+    ## (contexts, actions) of total_samples samples of a dataset_builder.py dataset, drawn across its context bins
+    from dataset_builder import ResultsDataset
+    dataset = ResultsDataset(path)
+    random = np.random.default_rng(seed)
+    bins = np.flatnonzero(dataset.bin_sizes())
+    idx = np.array([random.choice(dataset.rows_in_bin(b)) for b in random.choice(bins, size=total_samples)])
+    return np.asarray(dataset.contexts[idx]), np.asarray(dataset.actions[idx])
+
+def load_numpy_models(ddpg_agent, actor_memory_name, critic_memory_name, dtype = np.float32, quantization = QUANTIZATION_NONE):
+    ## build the NumPy networks of the DDPGAgent and attach to the weights published by the MainAgent, without TensorFlow;
+    ## when quantized, only the quantized weights the MainAgent publishes next to the float ones are mapped
+    context_size, action_size = ddpg_agent.context_size, ddpg_agent.action_size
+    actor_shapes  = mlp_weight_shapes(context_size, action_size)
+    critic_shapes = mlp_weight_shapes(context_size + action_size, 1)
+    ddpg_agent.actor, ddpg_agent.critic = get_numpy_models(ddpg_agent, dtype, quantization)
+    if (quantization != QUANTIZATION_NONE):
+        actor_quantizer, critic_quantizer = get_quantizers(ddpg_agent, quantization)
+        actor_weights  = actor_quantizer.get_store(quantized_memory_name(actor_memory_name)).attach()
+        critic_weights = critic_quantizer.get_store(quantized_memory_name(critic_memory_name)).attach()
+        return actor_weights, critic_weights
+    actor_weights  = VersionedWeights(actor_shapes, np.float32, actor_memory_name).attach()
+    critic_weights = VersionedWeights(critic_shapes, np.float32, critic_memory_name).attach()
+    return actor_weights, critic_weights
+
+def decision_mismatches(reference, decisions, action_space):
+    ## share of the contexts with a different (mcs, prb), mcs or prb than the reference, and the mean tbs difference
+    reference_mcs, reference_prb = reference
+    mcs, prb = decisions
+    differs = (mcs != reference_mcs) | (prb != reference_prb)
+    tbs_difference = np.abs(action_space.tbs[mcs, prb].astype(np.int64) - action_space.tbs[reference_mcs, reference_prb])
+    return {
+        'mismatch': float(np.mean(differs)),
+        'mcs_mismatch': float(np.mean(mcs != reference_mcs)),
+        'prb_mismatch': float(np.mean(prb != reference_prb)),
+        'mean_tbs_difference': float(tbs_difference.mean())
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    from common_utils import import_tensorflow, get_action_space
+    from agent_ddpg import DDPGAgent
+    from policy_table import PolicyTable
+
+    parser = argparse.ArgumentParser(description='Accuracy of the quantized NumPy ATHENA policy against the float model')
+    parser.add_argument('--actions', type=int, choices=range(1,3), dest='actions', required=True)
+    parser.add_argument('--actor_weights', dest='actor_weights', required=True)
+    parser.add_argument('--critic_weights', dest='critic_weights', required=True)
+    parser.add_argument('--dataset', dest='dataset', help='dataset_builder.py dataset of logged contexts (calibration and reference contexts)')
+    parser.add_argument('--calibration_samples', type=int, dest='calibration_samples', default=1024)
+    parser.add_argument('--reference_samples', type=int, dest='reference_samples', default=10000)
+    parser.add_argument('--cpu_step', type=float, dest='cpu_step', default=10, help='reference grid without a dataset')
+    parser.add_argument('--snr_step', type=float, dest='snr_step', default=0.5, help='reference grid without a dataset')
+    parser.add_argument('--quantization', nargs='+', choices=QUANTIZATION_MODES, dest='quantization', default=QUANTIZATION_MODES)
+    parser.add_argument('-k', type=int, dest='k', default=9)
+    args = parser.parse_args()
+
+    tf, _, _ = import_tensorflow('3', False)
+    action_space = get_action_space()
+    float_agent = DDPGAgent(tf, 2, args.actions)
+    float_agent.set_action_array(action_space.action_array.copy())
+    float_agent.load_actor()
+    float_agent.load_critic()
+    float_agent.load_actor_weights(args.actor_weights)
+    float_agent.load_critic_weights(args.critic_weights)
+
+    calibration = None
+    if (args.dataset is not None):
+        calibration = load_calibration(args.dataset, args.calibration_samples, seed=0)
+        contexts, _ = load_calibration(args.dataset, args.reference_samples, seed=1)
+    else:
+        contexts = PolicyTable(cpu_step=args.cpu_step, snr_step=args.snr_step).grid_contexts()
+    print('Reference: float model over {} contexts{}'.format(len(contexts), '' if (calibration is None) else ', calibrated on {} logged samples'.format(args.calibration_samples)))
+    reference = float_agent.decide_batch(contexts, args.k)
+
+    print('{:<10} {:>12} {:>10} {:>14} {:>14} {:>16}'.format('mode', 'weights_B', 'mismatch', 'mcs_mismatch', 'prb_mismatch', 'mean_tbs_diff'))
+    for quantization in args.quantization:
+        quantized_agent = DDPGAgent(None, 2, args.actions)
+        quantized_agent.set_action_array(action_space.action_array.copy())
+        quantized_agent.actor, quantized_agent.critic = get_numpy_models(quantized_agent, np.float32, quantization)
+        quantizers = [None, None] if (quantization == QUANTIZATION_NONE) else get_quantizers(quantized_agent, quantization, calibration)
+        size = 0
+        # the same arrays (and bytes) the MainAgent publishes to the workers
+        for model, keras_model, quantizer in zip([quantized_agent.actor, quantized_agent.critic], [float_agent.actor, float_agent.critic], quantizers):
+            weights = keras_model.get_weights()
+            if (quantizer is not None):
+                weights = quantizer(weights)
+                size += quantizer.get_store(None).nbytes()
+            else:
+                size += sum(w.nbytes for w in weights)
+            model.set_weights(weights)
+        mismatches = decision_mismatches(reference, quantized_agent.decide_batch(contexts, args.k), action_space)
+        print('{:<10} {:>12} {:>9.2%} {:>13.2%} {:>13.2%} {:>16.1f}'.format(
+            quantization, size, mismatches['mismatch'], mismatches['mcs_mismatch'], mismatches['prb_mismatch'], mismatches['mean_tbs_difference']))
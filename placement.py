@@ -0,0 +1,176 @@
+import os
+import json
+from common_utils import parse_cores, set_tensorflow_threads
+
+ROLE_PARENT      = 'athena_ml'
+ROLE_MAIN        = 'main'
+ROLE_HARQ        = 'harq'
+ROLE_INFERENCE   = 'inference_server'
+ROLE_SCHEDULER   = 'scheduler_intf'
+ROLE_DECODER     = 'decoder_intf'
+ROLE_COORDINATOR = 'coordinator_intf'
+ROLE_LOG         = 'log'
+ROLES = [ROLE_PARENT, ROLE_MAIN, ROLE_HARQ, ROLE_INFERENCE, ROLE_SCHEDULER, ROLE_DECODER, ROLE_COORDINATOR, ROLE_LOG]
+
+ROLE_KEYS = ['cores', 'per_process', 'realtime', 'threads']
+
+class Placement():
+    '''
+        Placement of the scheduler processes on the cores of the vRAN host, one entry per role:
+
+            {
+                "harq":           {"cores": "4-11", "per_process": true, "threads": 1},
+                "scheduler_intf": {"cores": "2", "realtime": 50},
+                "decoder_intf":   {"cores": "3", "realtime": 50},
+                "main":           {"cores": "12-13", "threads": 2},
+                "log":            {"cores": "14"}
+            }
+
+        cores: the cores of the processes of the role ('2,3' or '4-7'); with per_process, the i-th
+        process of the role is pinned to a single core, the i-th of the set (round robin).
+        realtime: SCHED_FIFO priority (1-99), needs CAP_SYS_NICE.
+        threads: cap of the TensorFlow intra-op and inter-op thread pools of every process, and of its
+        BLAS/OpenMP thread pools through threadpoolctl (numpy is already loaded, the environment is too late).
+        With --startup forkserver, the agents share the TensorFlow runtime of the template, sized by the
+        harq threads (or by --learner_threads when training); the other sizes only print a warning.
+        The roles left out keep the affinity inherited from athena_ml.py and the default thread pools.
+    '''
+
+    def __init__(self, roles = None) -> None:
+        self.roles = {}
+        for role, entry in (roles or {}).items():
+            if (role not in ROLES):
+                raise Exception('Unknown placement role {}, expected one of {}'.format(role, ', '.join(ROLES)))
+            unknown = [key for key in entry if key not in ROLE_KEYS]
+            if (len(unknown) > 0):
+                raise Exception('Unknown placement keys {} of {}, expected {}'.format(', '.join(unknown), role, ', '.join(ROLE_KEYS)))
+            realtime = entry.get('realtime')
+            if (realtime is not None and not 1 <= int(realtime) <= 99):
+                raise Exception('SCHED_FIFO priority of {} must be within 1-99, got {}'.format(role, realtime))
+            self.roles[role] = {
+                'cores': parse_cores(entry.get('cores')),
+                'per_process': bool(entry.get('per_process', False)),
+                'realtime': None if (realtime is None) else int(realtime),
+                'threads': entry.get('threads')
+            }
+        self.blas_limits = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['blas_limits'] = None
+        return state
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as file:
+            return Placement(json.load(file))
+
+    def cores_of(self, role, index = None):
+        ## the cores of the index-th process of the role, None if left to the OS
+        entry = self.roles.get(role)
+        if (entry is None or entry['cores'] is None):
+            return None
+        cores = entry['cores']
+        if (entry['per_process'] and index is not None):
+            return [cores[index % len(cores)]]
+        return cores
+
+    def threads_of(self, role):
+        entry = self.roles.get(role)
+        return None if (entry is None) else entry['threads']
+
+    def apply(self, role, index = None):
+        ## pins the calling process, sets its scheduling policy and caps its thread pools
+        entry = self.roles.get(role)
+        if (entry is None):
+            return
+        name = role if (index is None) else '{}[{}]'.format(role, index)
+        cores = self.cores_of(role, index)
+        applied = []
+        if (cores is not None):
+            try:
+                os.sched_setaffinity(0, set(cores))
+                applied.append('cores {}'.format(sorted(os.sched_getaffinity(0))))
+            except OSError as e:
+                applied.append('cores {} not available ({}), kept {}'.format(cores, e, sorted(os.sched_getaffinity(0))))
+        if (entry['realtime'] is not None):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(entry['realtime']))
+                applied.append('SCHED_FIFO {}'.format(entry['realtime']))
+            except PermissionError:
+                applied.append('SCHED_FIFO {} not permitted (needs CAP_SYS_NICE)'.format(entry['realtime']))
+        if (entry['threads'] is not None):
+            from numpy_inference import limit_blas_threads
+            self.blas_limits = limit_blas_threads(entry['threads'])
+            if (self.blas_limits is None):
+                applied.append('{} threads (TensorFlow only, the BLAS threads are only capped by threadpoolctl)'.format(entry['threads']))
+            else:
+                applied.append('{} threads'.format(entry['threads']))
+        print('{} (pid {}) -> {}'.format(name, os.getpid(), ', '.join(applied)))
+
+    def limit_tensorflow(self, role, tf):
+        # must run right after importing TensorFlow, before its first operation; a process forked from
+        # the forkserver template keeps the thread pools of the template, with a warning
+        threads = self.threads_of(role)
+        if (threads is None):
+            return
+        set_tensorflow_threads(tf, threads, threads, role)
+
+    def processes(self, total_agents = 8, coordinator = 'processes', inference_server = False):
+        ## (role, index) of every process athena_ml.py starts with these options
+        processes = [(ROLE_PARENT, None), (ROLE_LOG, None)]
+        if (coordinator == 'asyncio'):
+            processes.append((ROLE_COORDINATOR, None))
+        else:
+            processes += [(ROLE_SCHEDULER, None), (ROLE_DECODER, None)]
+        processes.append((ROLE_MAIN, None))
+        if (inference_server):
+            processes.append((ROLE_INFERENCE, None))
+        processes += [(ROLE_HARQ, idx) for idx in range(total_agents)]
+        return processes
+
+    def describe(self, total_agents = 8, coordinator = 'processes', inference_server = False):
+        ## the planned topology: cores, policy and threads per process, and the cores left to srsENB
+        available = sorted(os.sched_getaffinity(0)) if (hasattr(os, 'sched_getaffinity')) else list(range(os.cpu_count()))
+        lines = ['Placement on cores {} ({} cores)'.format(available, os.cpu_count())]
+        lines.append('{:<22} {:<16} {:<14} {:>8}'.format('process', 'cores', 'policy', 'threads'))
+        used = {}
+        for role, index in self.processes(total_agents, coordinator, inference_server):
+            entry = self.roles.get(role, {})
+            cores = self.cores_of(role, index)
+            name = role if (index is None) else '{}[{}]'.format(role, index)
+            policy = 'SCHED_FIFO {}'.format(entry['realtime']) if (entry.get('realtime') is not None) else 'default'
+            lines.append('{:<22} {:<16} {:<14} {:>8}'.format(
+                name, 'any' if (cores is None) else ','.join(str(core) for core in cores), policy,
+                'default' if (entry.get('threads') is None) else entry['threads']))
+            for core in (cores or []):
+                used.setdefault(core, []).append((name, entry.get('realtime') is not None))
+            unavailable = [core for core in (cores or []) if core not in available]
+            if (len(unavailable) > 0):
+                lines.append('Warning: {} is placed on unavailable cores {}'.format(name, unavailable))
+        for core, names in sorted(used.items()):
+            # a realtime process starves whatever shares its core
+            if (len(names) > 1 and any(realtime for _, realtime in names)):
+                lines.append('Warning: core {} is shared by a realtime process: {}'.format(core, ', '.join(name for name, _ in names)))
+        free = [core for core in available if core not in used]
+        lines.append('Cores left for srsENB: {}'.format(free if (len(free) > 0) else 'none'))
+        return '\n'.join(lines)
+
+def apply_placement(placement, role, index = None):
+    if (placement is not None):
+        placement.apply(role, index)
+
+def limit_tensorflow_threads(placement, role, tf):
+    if (placement is not None):
+        placement.limit_tensorflow(role, tf)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the process topology of an ATHENA placement file')
+    parser.add_argument('placement')
+    parser.add_argument('--agents', type=int, dest='agents', default=8)
+    parser.add_argument('--coordinator', choices=['processes', 'asyncio'], dest='coordinator', default='processes')
+    parser.add_argument('--inference_server', action='store_true', dest='inference_server')
+    args = parser.parse_args()
+    print(Placement.load(args.placement).describe(args.agents, args.coordinator, args.inference_server))
@@ -0,0 +1,112 @@
+import numpy as np
+from shared_weights import VersionedWeights
+
+# seqlock retries of a lookup before it is left unanswered (the publisher died mid-publish)
+LOOKUP_RETRIES = 1000
+
+class PolicyTable():
+    '''
+        Compiled ATHENA policy. The context seen by the policy is (cpu, snr), so the whole
+        actor -> k-NN -> critic pipeline is evaluated offline over a quantized grid of contexts
+        and every TTI is answered with a table lookup.
+        Contexts that fall outside the grid, or looked up while a publication never completes,
+        are not answered by the table (lookup returns None), so the caller can fall back to the exact DDPG decision.
+        The table is published double-buffered, so it can be recompiled under live traffic.
+    '''
+
+    def __init__(self,
+                 cpu_step = 5, snr_step = 0.25,
+                 context_min = (0, 18), context_max = (1000, 49),
+                 memory_name = 'policy_table') -> None:
+        self.grid_min  = np.array(context_min, dtype=np.float32)
+        self.grid_max  = np.array(context_max, dtype=np.float32)
+        self.grid_step = np.array([cpu_step, snr_step], dtype=np.float32)
+        self.grid_size = (np.round((self.grid_max - self.grid_min) / self.grid_step).astype(np.int32) + 1)
+        self.memory_name = memory_name
+        self.store = None
+        self.table = None
+
+    def grid_contexts(self):
+        cpu_values = self.grid_min[0] + self.grid_step[0] * np.arange(self.grid_size[0], dtype=np.float32)
+        snr_values = self.grid_min[1] + self.grid_step[1] * np.arange(self.grid_size[1], dtype=np.float32)
+        cpu_grid, snr_grid = np.meshgrid(cpu_values, snr_values, indexing='ij')
+        return np.stack([cpu_grid.ravel(), snr_grid.ravel()], axis=1)
+
+    def table_shape(self):
+        return (self.grid_size[0], self.grid_size[1], 2)
+
+    def attach(self, create = True):
+        # the table is laid out as (cpu, snr, [mcs, prb])
+        self.store = VersionedWeights([self.table_shape()], np.int32, self.memory_name).attach(create)
+        return self.store
+
+    def publish(self, table=None):
+        return self.store.publish([self.table if table is None else table])
+
+    def build(self, ddpg_agent, batch_size = 1024):
+        if (self.table is None):
+            self.table = np.zeros(shape=self.table_shape(), dtype=np.int32)
+        contexts = self.grid_contexts()
+        flat_table = self.table.reshape(-1, 2)
+        for start in range(0, len(contexts), batch_size):
+            mcs, prb = ddpg_agent.decide_batch(contexts[start: start + batch_size])
+            flat_table[start: start + batch_size, 0] = mcs
+            flat_table[start: start + batch_size, 1] = prb
+        return self.table
+
+    def save(self, path):
+        np.savez(path, table=self.table, grid_min=self.grid_min, grid_max=self.grid_max, grid_step=self.grid_step)
+
+    def load(self, path):
+        stored = np.load(path)
+        if (not np.allclose(stored['grid_min'], self.grid_min)
+                or not np.allclose(stored['grid_max'], self.grid_max)
+                or not np.allclose(stored['grid_step'], self.grid_step)):
+            raise Exception('Policy table {} was compiled for a different context grid'.format(path))
+        if (self.table is None):
+            self.table = np.zeros(shape=self.table_shape(), dtype=np.int32)
+        self.table[:] = stored['table']
+        return self.table
+
+    def lookup(self, context):
+        cpu_idx = int(round(float((context[0] - self.grid_min[0]) / self.grid_step[0])))
+        snr_idx = int(round(float((context[1] - self.grid_min[1]) / self.grid_step[1])))
+        if (cpu_idx < 0 or cpu_idx >= self.grid_size[0] or snr_idx < 0 or snr_idx >= self.grid_size[1]):
+            return None
+        store = self.store
+        for _ in range(LOOKUP_RETRIES):
+            generation = store.generation()
+            mcs, prb = store.active_views()[0][cpu_idx, snr_idx]
+            # same seqlock check as VersionedWeights.read for a single entry
+            if (generation % 2 == 0 and store.generation() <= generation + 2):
+                return int(mcs), int(prb)
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+    from common_utils import import_tensorflow, get_action_array
+    from agent_ddpg import DDPGAgent
+
+    parser = argparse.ArgumentParser(description='Compile the ATHENA policy into a context lookup table')
+    parser.add_argument('--actions', type=int, choices=range(1,3), dest='actions', required=True)
+    parser.add_argument('--actor_weights', dest='actor_weights', required=True)
+    parser.add_argument('--critic_weights', dest='critic_weights', required=True)
+    parser.add_argument('--cpu_step', type=float, dest='cpu_step', default=5)
+    parser.add_argument('--snr_step', type=float, dest='snr_step', default=0.25)
+    parser.add_argument('-o', '--output', dest='output', required=True)
+    args = parser.parse_args()
+
+    tf, _, _ = import_tensorflow('3', False)
+    ddpg_agent = DDPGAgent(tf, 2, args.actions)
+    ddpg_agent.set_action_array(get_action_array())
+    ddpg_agent.load_actor()
+    ddpg_agent.load_critic()
+    ddpg_agent.load_actor_weights(args.actor_weights)
+    ddpg_agent.load_critic_weights(args.critic_weights)
+
+    policy_table = PolicyTable(cpu_step=args.cpu_step, snr_step=args.snr_step)
+    print('Compiling policy over {}x{} contexts...'.format(*policy_table.grid_size), end='')
+    policy_table.build(ddpg_agent)
+    policy_table.save(args.output)
+    print('Done')
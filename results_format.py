@@ -0,0 +1,158 @@
+'''
+    Binary columnar results file written by the LogProcess (--log_format npy).
+    Layout: MAGIC, uint32 header length, JSON header (scheduling mode, column names and dtypes),
+    followed by chunks. Each chunk is one .npy array per column, in the order of the header.
+'''
+import json
+import numpy as np
+from common_utils import MODE_SCHEDULING_RANDOM
+
+MAGIC = b'ATHENARES\x01'
+
+# (column, sample key, dtype): the column names are the ones of the pipe-delimited text files
+RANDOM_COLUMNS = [
+    ('cpu', 'cpu', 'float32'),
+    ('snr', 'snr', 'float32'),
+    ('mcs', 'mcs', 'int32'),
+    ('prb', 'prb', 'int32'),
+    ('crc', 'crc', 'int32'),
+    ('decoding_time', 'dec_time', 'int32'),
+    ('snr_decode', 'snr_decode', 'float64'),
+    ('noise_decode', 'noise_decode', 'float64'),
+    ('snr_decode_custom', 'snr_custom', 'float64'),
+    ('gain', 'gain', 'int32'),
+    ('rnti', 'rnti', 'int32')
+]
+
+INFERENCE_COLUMNS = [
+    ('timestamp', 'timestamp', 'int64'),
+    ('tti', 'tti', 'int32'),
+    ('hrq', 'hrq', 'int32'),
+    ('mcs', 'mcs', 'int32'),
+    ('prb', 'prb', 'int32'),
+    ('tbs', 'tbs', 'int32'),
+    ('crc', 'crc', 'int32'),
+    ('dec_time', 'dec_time', 'int32'),
+    ('cpu', 'cpu', 'float32'),
+    ('snr', 'snr', 'float32'),
+    ('gain', 'gain', 'int32'),
+    ('snr_decode', 'snr_decode', 'float64'),
+    ('noise_decode', 'noise_decode', 'float64'),
+    ('snr_decode_custom', 'snr_custom', 'float64'),
+    ('rnti', 'rnti', 'int32')
+]
+
+def get_columns(scheduling_mode):
+    if (scheduling_mode == MODE_SCHEDULING_RANDOM):
+        return RANDOM_COLUMNS
+    return INFERENCE_COLUMNS
+
+class ResultsWriter():
+    '''
+        Accumulates the samples into preallocated column buffers and writes them chunk_size rows at a time.
+    '''
+
+    def __init__(self, path, scheduling_mode, chunk_size = 65536) -> None:
+        self.path = path
+        self.scheduling_mode = scheduling_mode
+        self.columns = get_columns(scheduling_mode)
+        self.chunk_size = chunk_size
+        self.buffers = [np.zeros(shape=(chunk_size, ), dtype=dtype) for _, _, dtype in self.columns]
+        self.keys = [key for _, key, _ in self.columns]
+        self.rows = 0
+        self.total_rows = 0
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        header = json.dumps({
+            'scheduling_mode': self.scheduling_mode,
+            'columns': [[name, dtype] for name, _, dtype in self.columns]
+        }).encode()
+        self.file.write(MAGIC)
+        self.file.write(np.uint32(len(header)).tobytes())
+        self.file.write(header)
+        return self
+
+    def append(self, sample):
+        row = self.rows
+        for buffer, key in zip(self.buffers, self.keys):
+            buffer[row] = sample[key]
+        self.rows += 1
+        if (self.rows == self.chunk_size):
+            self.flush()
+
+    def append_records(self, records):
+        ## vectorized append of a batch of experience ring records (or any array indexed by the sample keys)
+        start = 0
+        while (start < len(records)):
+            total = min(len(records) - start, self.chunk_size - self.rows)
+            for buffer, key in zip(self.buffers, self.keys):
+                buffer[self.rows: self.rows + total] = records[key][start: start + total]
+            self.rows += total
+            start += total
+            if (self.rows == self.chunk_size):
+                self.flush()
+
+    def flush(self):
+        if (self.rows == 0):
+            return
+        for buffer in self.buffers:
+            np.save(self.file, buffer[:self.rows], allow_pickle=False)
+        self.file.flush()
+        self.total_rows += self.rows
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def read_header(file):
+    if (file.read(len(MAGIC)) != MAGIC):
+        raise Exception('{} is not an ATHENA results file'.format(file.name))
+    header_length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+    return json.loads(file.read(header_length).decode())
+
+def load_header(path):
+    with open(path, 'rb') as file:
+        return read_header(file)
+
+def iter_chunks(path):
+    ## yields one {column: array} dict per chunk
+    with open(path, 'rb') as file:
+        names = [name for name, _ in read_header(file)['columns']]
+        while (len(file.peek(1)) > 0):
+            yield {name: np.load(file, allow_pickle=False) for name in names}
+
+def load_results(path):
+    ## all the chunks concatenated into one array per column
+    header = load_header(path)
+    chunks = list(iter_chunks(path))
+    columns = {}
+    for name, dtype in header['columns']:
+        columns[name] = np.concatenate([chunk[name] for chunk in chunks]) if (len(chunks) > 0) else np.zeros(shape=(0, ), dtype=dtype)
+    return header, columns
+
+def to_text(path, output_path):
+    ## converts back to the pipe-delimited text format of the LogProcess
+    names = [name for name, _ in load_header(path)['columns']]
+    with open(output_path, 'w') as output:
+        output.write('|'.join(names) + '\n')
+        for chunk in iter_chunks(path):
+            # astype(str) formats like str() on the numpy scalars the text writer used
+            columns = [chunk[name].astype(str) for name in names]
+            output.writelines('|'.join(row) + '\n' for row in zip(*columns))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert an ATHENA binary results file to the pipe-delimited text format')
+    parser.add_argument('input')
+    parser.add_argument('-o', '--output', dest='output', required=True)
+    args = parser.parse_args()
+    to_text(args.input, args.output)
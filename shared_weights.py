@@ -0,0 +1,172 @@
+import numpy as np
+import time
+from multiprocessing import shared_memory
+from common_utils import map_weights_to_shared_memory_buffer, untrack_shared_memory
+from namespace import namespaced
+
+HEADER_GENERATION = 0
+HEADER_ACTIVE     = 1
+HEADER_SIZE       = 2
+# a publisher that died mid-publish leaves the generation odd (or the actor and critic apart) for good:
+# the readers give up after this long and keep their current weights
+READ_TIMEOUT_S    = 0.05
+
+class VersionedWeights():
+    '''
+        Double-buffered list of arrays (model weights, policy table) in shared memory.
+        Layout: int64 header [generation, active buffer], followed by two flat copies of the arrays.
+        dtype is the dtype of all the arrays, or a list with the dtype of every array (e.g. int8 kernels
+        and float32 scales); the arrays of mixed dtypes are laid out at 8 byte aligned offsets.
+        The publisher copies the new arrays into the inactive buffer, then flips the active buffer.
+        The generation works as a seqlock: it is odd while a publication is in progress and it
+        advances by 2 with every publication, so readers detect both new versions and torn reads.
+    '''
+
+    def __init__(self, shapes, dtype, memory_name) -> None:
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.mixed = isinstance(dtype, (list, tuple))
+        self.dtypes = [np.dtype(d) for d in dtype] if (self.mixed) else [np.dtype(dtype)] * len(self.shapes)
+        self.dtype = None if (self.mixed) else np.dtype(dtype)
+        self.memory_name = memory_name
+        self.variables = int(np.sum([np.prod(shape) for shape in self.shapes]))
+        self.shm = None
+
+    def nbytes(self):
+        ## bytes of one copy of the arrays
+        if (not self.mixed):
+            return self.variables * self.dtype.itemsize
+        return self.offsets()[-1]
+
+    def offsets(self):
+        ## byte offset of every array of mixed dtypes within a copy, and the size of the copy last
+        offsets = [0]
+        for shape, dtype in zip(self.shapes, self.dtypes):
+            end = offsets[-1] + int(np.prod(shape)) * dtype.itemsize
+            offsets.append((end + 7) // 8 * 8)
+        return offsets
+
+    def attach(self, create = True):
+        ## with create False, a missing segment raises FileNotFoundError instead of being created
+        header_bytes = HEADER_SIZE * np.dtype(np.int64).itemsize
+        buffer_bytes = self.nbytes()
+        size = header_bytes + 2 * buffer_bytes
+        try:
+            if (not create):
+                raise FileExistsError
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=True, size=size)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=False, size=size)
+        self.header = np.ndarray(shape=(HEADER_SIZE, ), dtype=np.int64, buffer=self.shm.buf)
+        if (self.mixed):
+            offsets = self.offsets()
+            self.views = [[np.ndarray(shape=shape, dtype=dtype, buffer=self.shm.buf, offset=header_bytes + idx * buffer_bytes + offset)
+                           for shape, dtype, offset in zip(self.shapes, self.dtypes, offsets)]
+                          for idx in range(2)]
+            return self
+        self.buffers = [
+            np.ndarray(shape=(self.variables, ), dtype=self.dtype, buffer=self.shm.buf, offset=header_bytes + idx * buffer_bytes)
+            for idx in range(2)]
+        placeholders = [np.empty(shape=shape, dtype=self.dtype) for shape in self.shapes]
+        self.views = [map_weights_to_shared_memory_buffer(list(placeholders), buffer) for buffer in self.buffers]
+        return self
+
+    def generation(self):
+        return int(self.header[HEADER_GENERATION])
+
+    def publish(self, arrays):
+        generation = self.generation()
+        target = 1 - int(self.header[HEADER_ACTIVE])
+        self.header[HEADER_GENERATION] = generation + 1
+        for view, array in zip(self.views[target], arrays):
+            np.copyto(view, array, casting='same_kind')
+        self.header[HEADER_ACTIVE] = target
+        self.header[HEADER_GENERATION] = generation + 2
+        return generation + 2
+
+    def active_views(self):
+        return self.views[int(self.header[HEADER_ACTIVE])]
+
+    def read(self, consumer, timeout = None):
+        ## hands the active arrays to consumer (which copies them) and returns the generation read;
+        ## None when no complete publication could be read within the timeout, consumer may then hold a torn copy
+        deadline = None if (timeout is None) else time.monotonic() + timeout
+        while (True):
+            generation = self.generation()
+            if (generation % 2 == 0):
+                consumer(self.active_views())
+                # one more publication only writes the other buffer, a second one overwrites the one read
+                if (self.generation() <= generation + 2):
+                    return generation
+            if (deadline is not None and time.monotonic() > deadline):
+                return None
+
+def get_model_weights_store(model, memory_name, create = True):
+    return VersionedWeights([w.shape for w in model.get_weights()], np.dtype(model.dtype), memory_name).attach(create)
+
+def read_weight_pair(actor_weights, actor_consumer, critic_weights, critic_consumer, timeout = READ_TIMEOUT_S):
+    ## hands an actor and a critic of the same publication to the consumers, returns their generations;
+    ## (None, None) when no such pair is read within the timeout, the consumers are then not called
+    deadline = time.monotonic() + timeout
+    copies = {}
+    while (True):
+        # read into copies first, so a failed read never leaves the consumers with a torn or mismatched pair
+        actor_generation = actor_weights.read(lambda arrays: copies.update(actor=[array.copy() for array in arrays]),
+                                              max(deadline - time.monotonic(), 0))
+        critic_generation = critic_weights.read(lambda arrays: copies.update(critic=[array.copy() for array in arrays]),
+                                                max(deadline - time.monotonic(), 0))
+        # both are always published together, one after the other, so they advance in lockstep:
+        # different generations mean a publication happened in between, the pair is read again
+        if (actor_generation is not None and actor_generation == critic_generation):
+            actor_consumer(copies['actor'])
+            critic_consumer(copies['critic'])
+            return actor_generation, critic_generation
+        if (time.monotonic() > deadline):
+            return None, None
+
+
+if __name__ == '__main__':
+    import argparse
+    from namespace import get_cell
+    from common_utils import import_tensorflow, get_action_array
+    from agent_ddpg import DDPGAgent
+    from policy_table import PolicyTable
+
+    parser = argparse.ArgumentParser(description='Publish new actor/critic weights to a running ATHENA scheduler')
+    parser.add_argument('--actions', type=int, choices=range(1,3), dest='actions', required=True)
+    parser.add_argument('--actor_weights', dest='actor_weights', required=True)
+    parser.add_argument('--critic_weights', dest='critic_weights', required=True)
+    parser.add_argument('--compiled_policy', action='store_true', dest='compiled_policy')
+    parser.add_argument('--cpu_step', type=float, dest='cpu_step', default=5)
+    parser.add_argument('--snr_step', type=float, dest='snr_step', default=0.25)
+    args = parser.parse_args()
+
+    tf, _, _ = import_tensorflow('3', False)
+    ddpg_agent = DDPGAgent(tf, 2, args.actions)
+    ddpg_agent.load_actor()
+    ddpg_agent.load_critic()
+    ddpg_agent.load_actor_weights(args.actor_weights)
+    ddpg_agent.load_critic_weights(args.critic_weights)
+
+    # only the segments of a running scheduler are published to, nothing is created;
+    # each one is untracked as soon as it is attached, the scheduler keeps owning it
+    try:
+        actor_weights  = get_model_weights_store(ddpg_agent.actor, 'model_actor', create=False)
+        untrack_shared_memory(actor_weights.shm)
+        critic_weights = get_model_weights_store(ddpg_agent.critic, 'model_critic', create=False)
+        untrack_shared_memory(critic_weights.shm)
+        policy_table = None
+        if (args.compiled_policy):
+            policy_table = PolicyTable(cpu_step=args.cpu_step, snr_step=args.snr_step)
+            untrack_shared_memory(policy_table.attach(create=False).shm)
+    except FileNotFoundError as e:
+        print('No running scheduler in cell \'{}\' ({}), nothing published'.format(get_cell(), e))
+        raise SystemExit(1)
+
+    if (policy_table is not None):
+        # the workers answer from the table, it has to follow the new weights
+        ddpg_agent.set_action_array(get_action_array())
+        policy_table.build(ddpg_agent)
+        policy_table.publish()
+    actor_generation  = actor_weights.publish(ddpg_agent.actor.get_weights())
+    critic_generation = critic_weights.publish(ddpg_agent.critic.get_weights())
+    print('Published actor generation {}, critic generation {}'.format(actor_generation, critic_generation))
@@ -0,0 +1,179 @@
+'''
+    Offline DDPG training of the ATHENA actor and critic on a dataset built by dataset_builder.py
+    from random mode results files. The networks are the ones of DDPGAgent.load_actor/load_critic and
+    the updates the ones of the online DDPGLearner, so the weights written at the end can be given
+    to athena_ml.py --actor_weights/--critic_weights as they are.
+    The batches are sampled from the memory-mapped dataset by a parallel tf.data pipeline that
+    prefetches them while the previous batch trains.
+'''
+import os
+import time
+import numpy as np
+from common_utils import import_tensorflow, get_action_array
+from agent_ddpg import DDPGAgent
+from dataset_builder import ResultsDataset, build_dataset
+
+SAMPLING_UNIFORM = 'uniform'
+SAMPLING_BINS    = 'bins'
+
+class BatchSampler():
+    '''
+        Draws the batch of every training step from the dataset. The random generator is seeded with
+        (seed, step), so the batches do not depend on the order the pipeline threads produce them in
+        and a resumed run samples the same batches.
+        uniform: every sample is equally likely; bins: every (cpu, snr) context bin is equally likely,
+        so the contexts seen rarely during the collection are not drowned by the common ones.
+    '''
+
+    def __init__(self, dataset, learner, batch_size, sampling = SAMPLING_UNIFORM, seed = 0) -> None:
+        self.dataset = dataset
+        self.learner = learner
+        self.batch_size = batch_size
+        self.sampling = sampling
+        self.seed = seed
+        bin_sizes = dataset.bin_sizes()
+        self.bins = np.flatnonzero(bin_sizes)
+        self.bin_sizes = bin_sizes[self.bins]
+        self.bin_offsets = dataset.bin_offsets[self.bins]
+
+    def indexes(self, step):
+        random = np.random.default_rng([self.seed, int(step)])
+        if (self.sampling == SAMPLING_BINS):
+            bins = random.integers(0, len(self.bins), size=self.batch_size)
+            offsets = self.bin_offsets[bins] + (random.random(size=self.batch_size) * self.bin_sizes[bins]).astype(np.int64)
+            idx = self.dataset.bin_order[offsets]
+        else:
+            idx = random.integers(0, len(self.dataset), size=self.batch_size)
+        # sorted indexes read the memory-mapped pages in order
+        return np.sort(idx)
+
+    def __call__(self, step):
+        ## (contexts, actions, rewards) network inputs of the batch of a training step
+        idx = self.indexes(step)
+        actions = self.dataset.actions[idx]
+        contexts, actions = self.learner.normalize_batch(self.dataset.contexts[idx], actions[:, 0], actions[:, 1])
+        rewards = self.dataset.rewards[idx].reshape(-1, 1)
+        return contexts.astype(np.float32), actions.astype(np.float32), rewards.astype(np.float32)
+
+def get_input_pipeline(tf, sampler, first_step, total_steps, input_threads = 0, prefetch = 0):
+    ## tf.data pipeline of the batches of the steps first_step..total_steps, built by parallel numpy_function calls
+    context_size = sampler.learner.ddpg_agent.context_size
+    action_size = sampler.learner.ddpg_agent.action_size
+    batch_size = sampler.batch_size
+
+    def sample(step):
+        contexts, actions, rewards = tf.numpy_function(sampler, [step], [tf.float32, tf.float32, tf.float32])
+        contexts.set_shape((batch_size, context_size))
+        actions.set_shape((batch_size, action_size))
+        rewards.set_shape((batch_size, 1))
+        return contexts, actions, rewards
+
+    pipeline = tf.data.Dataset.range(first_step, total_steps)
+    pipeline = pipeline.map(sample, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    pipeline = pipeline.prefetch(prefetch if (prefetch > 0) else tf.data.AUTOTUNE)
+    if (input_threads > 0):
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = input_threads
+        pipeline = pipeline.with_options(options)
+    return pipeline
+
+def set_threading(tf, intra_op_threads, inter_op_threads):
+    # 0 lets TensorFlow use all the cores; must run before the first operation
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    print('TensorFlow threads: intra-op {}, inter-op {} ({} cores)'.format(
+        intra_op_threads if (intra_op_threads > 0) else 'all', inter_op_threads if (inter_op_threads > 0) else 'all', os.cpu_count()))
+
+def save_weights(ddpg_agent, output_path):
+    ## writes the weights loadable by athena_ml.py --actor_weights/--critic_weights, returns their paths
+    os.makedirs(output_path, exist_ok=True)
+    actor_path  = os.path.join(output_path, 'actor.weights.h5')
+    critic_path = os.path.join(output_path, 'critic.weights.h5')
+    ddpg_agent.actor.save_weights(actor_path)
+    ddpg_agent.critic.save_weights(critic_path)
+    return actor_path, critic_path
+
+def train(tf, dataset, action_size, output_path, total_steps = 100000, batch_size = 256,
+          sampling = SAMPLING_UNIFORM, seed = 0, checkpoint_every = 5000, log_every = 1000,
+          input_threads = 0, prefetch = 0, actor_weights = None, critic_weights = None,
+          actor_learning_rate = 1e-4, critic_learning_rate = 1e-3):
+    from ddpg_learner import DDPGLearner
+    ddpg_agent = DDPGAgent(tf, 2, action_size)
+    ddpg_agent.set_action_array(get_action_array())
+    ddpg_agent.load_actor()
+    ddpg_agent.load_critic()
+    if (actor_weights is not None):
+        ddpg_agent.load_actor_weights(actor_weights)
+    if (critic_weights is not None):
+        ddpg_agent.load_critic_weights(critic_weights)
+    # the samples come from the dataset, the replay buffer of the online learner is not used
+    learner = DDPGLearner(ddpg_agent, batch_size=batch_size, replay_size=0,
+                          actor_learning_rate=actor_learning_rate, critic_learning_rate=critic_learning_rate)
+
+    step = tf.Variable(0, dtype=tf.int64)
+    checkpoint = tf.train.Checkpoint(step=step, actor=ddpg_agent.actor, critic=ddpg_agent.critic,
+                                     actor_optimizer=learner.actor_optimizer, critic_optimizer=learner.critic_optimizer)
+    manager = tf.train.CheckpointManager(checkpoint, os.path.join(output_path, 'checkpoints'), max_to_keep=3)
+    if (manager.latest_checkpoint is not None):
+        checkpoint.restore(manager.latest_checkpoint)
+        print('Resuming from {} at step {}'.format(manager.latest_checkpoint, int(step.numpy())))
+
+    sampler = BatchSampler(dataset, learner, batch_size, sampling, seed)
+    pipeline = get_input_pipeline(tf, sampler, int(step.numpy()), total_steps, input_threads, prefetch)
+    print('Training on {} samples ({} context bins, {} sampling), batch {}, {} steps'.format(
+        len(dataset), len(sampler.bins), sampling, batch_size, total_steps))
+    start = time.time()
+    first_step = int(step.numpy())
+    critic_loss, actor_loss = None, None
+    for contexts, actions, rewards in pipeline:
+        critic_loss, actor_loss = learner.train_step(contexts, actions, rewards)
+        current_step = int(step.assign_add(1).numpy())
+        if (current_step % log_every == 0):
+            elapsed = time.time() - start
+            print('Step {}, critic loss {:.4f}, actor loss {:.4f}, {:.1f} steps/s'.format(
+                current_step, float(critic_loss), float(actor_loss), (current_step - first_step) / elapsed))
+        if (current_step % checkpoint_every == 0):
+            print('Checkpoint {}'.format(manager.save()))
+    if (critic_loss is not None and int(step.numpy()) % checkpoint_every != 0):
+        manager.save()
+    actor_path, critic_path = save_weights(ddpg_agent, output_path)
+    print('Weights written to {} and {}'.format(actor_path, critic_path))
+    return ddpg_agent, actor_path, critic_path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Offline DDPG training of the ATHENA actor and critic')
+    parser.add_argument('dataset', help='dataset directory of dataset_builder.py')
+    parser.add_argument('--logs', nargs='+', dest='logs', help='build the dataset from these results files first')
+    parser.add_argument('--actions', type=int, choices=range(1,3), dest='actions', required=True)
+    parser.add_argument('-o', '--output', dest='output', required=True, help='directory of the weights and the checkpoints')
+    parser.add_argument('--steps', type=int, dest='steps', default=100000)
+    parser.add_argument('--batch_size', type=int, dest='batch_size', default=256)
+    parser.add_argument('--sampling', choices=[SAMPLING_UNIFORM, SAMPLING_BINS], dest='sampling', default=SAMPLING_UNIFORM)
+    parser.add_argument('--actor_learning_rate', type=float, dest='actor_learning_rate', default=1e-4)
+    parser.add_argument('--critic_learning_rate', type=float, dest='critic_learning_rate', default=1e-3)
+    parser.add_argument('--actor_weights', dest='actor_weights', help='initial actor weights')
+    parser.add_argument('--critic_weights', dest='critic_weights', help='initial critic weights')
+    parser.add_argument('--checkpoint_every', type=int, dest='checkpoint_every', default=5000)
+    parser.add_argument('--log_every', type=int, dest='log_every', default=1000)
+    parser.add_argument('--intra_op_threads', type=int, dest='intra_op_threads', default=0, help='0 for all the cores')
+    parser.add_argument('--inter_op_threads', type=int, dest='inter_op_threads', default=0, help='0 for all the cores')
+    parser.add_argument('--input_threads', type=int, dest='input_threads', default=0, help='threads of the input pipeline, 0 for the TensorFlow default')
+    parser.add_argument('--prefetch', type=int, dest='prefetch', default=0, help='batches prefetched, 0 to autotune')
+    parser.add_argument('--seed', type=int, dest='seed', default=0)
+    args = parser.parse_args()
+
+    if (args.logs is not None):
+        build_dataset(args.logs, args.dataset)
+    dataset = ResultsDataset(args.dataset)
+
+    tf, _, _ = import_tensorflow('3', False)
+    set_threading(tf, args.intra_op_threads, args.inter_op_threads)
+    tf.random.set_seed(args.seed)
+    _, actor_path, critic_path = train(tf, dataset, args.actions, args.output, total_steps=args.steps, batch_size=args.batch_size,
+                                       sampling=args.sampling, seed=args.seed, checkpoint_every=args.checkpoint_every,
+                                       log_every=args.log_every, input_threads=args.input_threads, prefetch=args.prefetch,
+                                       actor_weights=args.actor_weights, critic_weights=args.critic_weights,
+                                       actor_learning_rate=args.actor_learning_rate, critic_learning_rate=args.critic_learning_rate)
+    print('python3 athena_ml.py -m athena --actions {} --actor_weights {} --critic_weights {}'.format(args.actions, actor_path, critic_path))
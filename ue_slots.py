@@ -0,0 +1,72 @@
+import numpy as np
+from multiprocessing import shared_memory
+from namespace import namespaced
+
+FREE_RNTI = 0 # not a valid C-RNTI
+
+class UeSlots():
+    '''
+        RNTI -> UE index table shared by the scheduler and the decoder interfaces.
+        The shared memory buffers hold one slot per (UE, HARQ process), at ue * total_harq + harq.
+        A UE is attached to a free index when its first context arrives. It is detached lazily:
+        its index is given to a new RNTI once it has not been seen for ue_timeout_ms, long after
+        its last reward. Only the scheduler interface attaches and detaches, the decoder only looks up.
+    '''
+
+    def __init__(self, max_ues = 1, total_harq = 8, ue_timeout_ms = 1000, memory_name = 'ue_slots') -> None:
+        self.max_ues = max_ues
+        self.total_harq = total_harq
+        self.ue_timeout_ns = ue_timeout_ms * 1000000
+        self.memory_name = memory_name
+        self.shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['shm', 'rntis', 'last_seen', 'ue_of_rnti']:
+            state.pop(name, None)
+        state['shm'] = None
+        return state
+
+    def total_slots(self):
+        return self.max_ues * self.total_harq
+
+    def attach(self):
+        size = 2 * self.max_ues * np.dtype(np.int64).itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=True, size=size)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=namespaced(self.memory_name), create=False, size=size)
+        self.rntis = np.ndarray(shape=(self.max_ues, ), dtype=np.int64, buffer=self.shm.buf)
+        self.last_seen = np.ndarray(shape=(self.max_ues, ), dtype=np.int64, buffer=self.shm.buf, offset=self.max_ues * np.dtype(np.int64).itemsize)
+        # private index of the attaching process, the shared table is what the other processes read
+        self.ue_of_rnti = {int(rnti): ue for ue, rnti in enumerate(self.rntis.tolist()) if (rnti != FREE_RNTI)}
+        return self
+
+    def reset(self):
+        self.rntis[:] = FREE_RNTI
+        self.last_seen[:] = 0
+        self.ue_of_rnti = {}
+        return self
+
+    def assign(self, rnti, now):
+        ## UE index of rnti, attaching it if needed; -1 if all the indexes are in use
+        ue = self.ue_of_rnti.get(rnti)
+        if (ue is None):
+            idle = np.flatnonzero((self.rntis == FREE_RNTI) | (now - self.last_seen > self.ue_timeout_ns))
+            if (len(idle) == 0):
+                return -1
+            ue = int(idle[0])
+            detached = int(self.rntis[ue])
+            if (detached != FREE_RNTI):
+                del self.ue_of_rnti[detached]
+                print('UE 0x{:x} detached from slot {}'.format(detached, ue))
+            self.rntis[ue] = rnti
+            self.ue_of_rnti[rnti] = ue
+            print('UE 0x{:x} attached to slot {}'.format(rnti, ue))
+        self.last_seen[ue] = now
+        return ue
+
+    def lookup(self, rntis):
+        ## UE indexes of an array of rntis, -1 for the ones not attached
+        matches = np.asarray(rntis, dtype=np.int64)[:, np.newaxis] == self.rntis[np.newaxis, :]
+        return np.where(matches.any(axis=1), matches.argmax(axis=1), -1)